@@ -1,13 +1,18 @@
+from bisect import bisect_left
 from collections import OrderedDict
-from math import log
+import heapq
+from math import log, sqrt
 import random
 import operator
+import time
 
 import pygame
 
 import constants
 import entity
 import event
+import overlay
+import profiler
 import util
 import world as world_module
 
@@ -27,6 +32,13 @@ class BaseController:
         self.behaviour_tree = None
         self._suppressed_behaviour = False
 
+        # set while a task is moving the entity, so it is ticked every frame by the scheduler
+        self.steering = False
+
+        # frames and seconds since the behaviour tree was last ticked, including the current frame, see AIScheduler
+        self.ai_frames_waited = None
+        self.ai_time_waited = 0
+
     def suppress_ai(self, suppressed):
         """
         :param suppressed: Should the behaviour tree be suppressed, ie is this entity being controlled from elsewhere
@@ -39,7 +51,7 @@ class BaseController:
             return
 
         if not self._suppressed_behaviour:
-            self.behaviour_tree.tick()
+            constants.STATEMANAGER.ai_scheduler.tick(self)
 
     def handle_event(self, e):
         """
@@ -75,6 +87,7 @@ class BaseController:
         """
         Releases all keys, and stops the entity
         """
+        self.steering = False
         for k in self.wasd:
             self.handle(False, k)
         self._move_entity()
@@ -183,6 +196,22 @@ class InputController:
             constants.RUNNING = False
             consumed = True
 
+        elif e.type == pygame.KEYDOWN and e.key == constants.Input.DEBUG_OVERLAY:
+            constants.SCREEN.debug_overlay = not constants.SCREEN.debug_overlay
+            consumed = True
+
+        elif e.type == pygame.KEYDOWN and e.key == constants.Input.MINIMAP:
+            constants.SCREEN.show_minimap = not constants.SCREEN.show_minimap
+            consumed = True
+
+        elif e.type == pygame.KEYDOWN and e.key in constants.Input.DEBUG_WORLD_OVERLAYS:
+            overlay.toggle(constants.Input.DEBUG_WORLD_OVERLAYS[e.key])
+            consumed = True
+
+        elif e.type == pygame.KEYDOWN and e.key == constants.Input.PROFILER:
+            profiler.toggle()
+            consumed = True
+
         return consumed
 
     def handle_global_game_event(self, e):
@@ -311,9 +340,10 @@ class InputController:
                     util.debug_block(self.entity.rect.centre, self.entity.world)
 
                 elif key == pygame.K_n:
-                    for b in self.entity.world.buildings:
-                        for w in b.windows.keys():
-                            b.set_window(w, random.random() < 0.5)
+                    self.entity.world.set_windows(lambda b: (random.random() < 0.5 for _ in b.window_positions))
+                elif key == pygame.K_m:
+                    world = self.entity.world
+                    world.set_lights(not any(any(b.window_states) for b in world.buildings))
                 elif key == pygame.K_g:
                     h = entity.create_entity(self.entity.world, constants.EntityType.HUMAN)
                     h.move_entity(self.entity.rect.centre)
@@ -325,6 +355,12 @@ class InputController:
                 elif key == pygame.K_l:
                     print(self.entity.get_current_tile())
 
+                elif key == pygame.K_f:
+                    goal = self.entity.get_current_tile()
+                    for e in self.entity.world.entities:
+                        if e != self.entity and e.entitytype == constants.EntityType.HUMAN:
+                            e.controller.flow_to_goal(goal)
+
                 elif key == pygame.K_y:
                     entity.EntityLoader.load_all()
                     print("reloaded")
@@ -458,7 +494,7 @@ class HumanController(GeneralEntityController):
         # walk = EntityMoveToLocation(self, (random.randrange(13, 19), random.randrange(6, 12)))
         # debug = DebugPrint("I, %r, am hereby debugged" % hex(id(self.entity)))
 
-        self.behaviour_tree = BehaviourTree(self, Repeater(EntityWander(self, move=False)))
+        self.behaviour_tree = BehaviourTree(self, WANDER_TREE)
 
     def tick(self):
         BaseController.tick(self)
@@ -471,62 +507,53 @@ class HumanController(GeneralEntityController):
         if not path:
             return
 
-        self.behaviour_tree.set_root(Sequence(HumanFollowPath(self, path), self.behaviour_tree.get_root()))
+        # already walking somewhere, so carry on along the new path instead
+        if self.behaviour_tree.get_root() is FOLLOW_PATH_TREE:
+            HumanFollowPath.retarget(self.behaviour_tree, path)
+            return
+
+        self.behaviour_tree.blackboard["path"] = path
+        self.behaviour_tree.push_root(FOLLOW_PATH_TREE)
+
+    def flow_to_goal(self, goal_tile_pos):
+        """
+        Walks to the given goal using the shared flow field towards it, instead of a path of its own.
+        Whether or not the goal is reached, the current behaviour resumes afterwards
+        """
+        self.behaviour_tree.blackboard["destination"] = tuple(goal_tile_pos)
+        self.behaviour_tree.push_root(FOLLOW_FLOW_FIELD_TREE)
 
     def roam(self):
-        self.behaviour_tree.set_root(Repeater(HumanRoam(self)))
+        self.behaviour_tree.set_root(ROAM_TREE)
 
 
 class _Engine:
-    class Graph:
-        ID = 0
-
-        def __init__(self):
-            self.values = []
-            self.index = 0
-            self.id = _Engine.Graph.ID
-            _Engine.Graph.ID += 1
+    class Curve:
+        """
+        Speed multipliers at each time step of accelerating or braking, always increasing from 0 to 1.
+        Curves are shared between all engines with the same rates, so must never be changed
+        """
 
-        def generate_values(self, func, time_step):
+        def __init__(self, func, time_step):
+            values = [0]
             step_x = 0
-            running = True
-            self.values.append(0)
-            while running:
+            while True:
                 y = func(step_x)
-
                 if y >= 1:
-                    y = 1
-                    running = False
-
-                self.values.append(y)
-                step_x += time_step
-
-        def get(self):
-            return self.values[self.index]
-
-        def catch_up(self, other_graph):
-            self._catch_up_to_value(other_graph.get())
-
-        def _catch_up_to_value(self, value):
-            done = False
-            for i in xrange(len(self.values)):
-                v = self.values[i]
-                if v >= value:
-                    self.index = i
-                    done = True
+                    values.append(1)
                     break
 
-            if not done:
-                self.index = 0
-
-        def slow(self, fraction):
-            self._catch_up_to_value(self.get() * fraction)
+                values.append(y)
+                step_x += time_step
 
-        def __eq__(self, other):
-            return isinstance(other, _Engine.Graph) and other.id == self.id
+            self.values = tuple(values)
 
-        def __hash__(self):
-            return self.id
+        def find_index(self, value):
+            """
+            :return: The index of the first value not less than the given value, or 0 if there is none
+            """
+            index = bisect_left(self.values, value)
+            return index if index < len(self.values) else 0
 
         def __len__(self):
             return len(self.values)
@@ -534,8 +561,8 @@ class _Engine:
         def __getitem__(self, item):
             return self.values[item]
 
-        def __repr__(self):
-            return "{%d}" % self.id
+    # (accelerate rate, brake rate, time step) -> (accelerate curve, brake curve)
+    _CURVES = {}
 
     def __init__(self, max_speed, accelerate_rate=10., brake_rate=10.):
         """
@@ -543,63 +570,93 @@ class _Engine:
         :param accelerate_rate: The acceleration rate: lower values = faster acceleration. Negative = instant
         :param brake_rate: The braking rate: lower values = faster braking
         """
-        self._state = VehicleController.STOPPED
-
         self.max_speed = max_speed
         self.min_speed = max_speed / 10
         self.last_speed = 0
 
         self._time_applied = 0
+        self._time_step = 0.25
 
-        self.accelerate_graph = _Engine.Graph()
-        self.brake_graph = _Engine.Graph()
-        self._speeds = {VehicleController.ACCELERATING: (1, self.accelerate_graph),
-                        VehicleController.BRAKING: (-4, self.brake_graph),
-                        VehicleController.DRIFTING: (-2, self.brake_graph),
-                        VehicleController.CRASHED: (None, self.accelerate_graph),
-                        VehicleController.STOPPED: (None, self.accelerate_graph)}
+        self.accelerate_curve, self.brake_curve = _Engine.get_curves(accelerate_rate, brake_rate, self._time_step)
+        self.curve = self.accelerate_curve
+        self.index = 0
 
-        self.current_graph = self.accelerate_graph
+    @staticmethod
+    def get_curves(accelerate_rate, brake_rate, time_step):
+        """
+        :return: The shared accelerate and brake curves for the given rates, which are generated on first use
+        """
+        key = (accelerate_rate, brake_rate, time_step)
+        curves = _Engine._CURVES.get(key)
+        if curves is None:
+            # instant acceleration
+            if accelerate_rate < 0:
+                accelerate = lambda x: 1
+            else:
+                accelerate = lambda x: 1 + log((x / accelerate_rate) + 0.05) * 0.3
 
-        # instant acceleration
-        if accelerate_rate < 0:
-            accelerate = lambda x: 1
-        else:
-            accelerate = lambda x: 1 + log((x / accelerate_rate) + 0.05) * 0.3
+            brake = lambda x: x / brake_rate
 
-        brake = lambda x: x / brake_rate
+            curves = (_Engine.Curve(accelerate, time_step), _Engine.Curve(brake, time_step))
+            _Engine._CURVES[key] = curves
 
-        self._time_step = 0.25
+        return curves
+
+    def _switch_curve(self, curve):
+        """
+        Switches to the given curve, at the index with the closest matching speed
+        """
+        if curve is not self.curve:
+            self.index = curve.find_index(self.curve[self.index])
+            self.curve = curve
+
+    def boost(self):
+        """
+        Moves one step further along the acceleration curve, if accelerating
+        """
+        if self.curve is self.accelerate_curve:
+            self.index = min(self.index + 1, len(self.curve) - 1)
+            self._update_speed()
+
+    def slow(self, fraction):
+        """
+        Drops the current speed to the given fraction of itself
+        """
+        self.index = self.curve.find_index(self.curve[self.index] * fraction)
+        self._update_speed()
 
-        self.accelerate_graph.generate_values(accelerate, self._time_step)
-        self.brake_graph.generate_values(brake, self._time_step)
+    def _update_speed(self):
+        self.last_speed = self.curve[self.index] * self.max_speed
 
     def get_speed(self, state):
         self._time_applied += constants.DELTA
 
-        if self._time_applied >= self._time_step:
-            self._time_applied = 0
+        # the speed only changes once per time step
+        if self._time_applied < self._time_step:
+            return self.last_speed
 
-            index_delta, graph = self._speeds[state]
-            length = len(graph)
-
-            # changing speed values
-            if graph != self.current_graph:
-                graph.catch_up(self.current_graph)
-                self.current_graph = graph
+        self._time_applied = 0
 
-            # stopped, so index must be 0
-            if index_delta is None:
-                index = 0
-            else:
-                index = self.current_graph.index + index_delta
+        if state == VehicleController.ACCELERATING:
+            index_delta, curve = 1, self.accelerate_curve
+        elif state == VehicleController.BRAKING:
+            index_delta, curve = -4, self.brake_curve
+        elif state == VehicleController.DRIFTING:
+            index_delta, curve = -2, self.brake_curve
+        else:
+            index_delta, curve = None, self.accelerate_curve
 
-            self.current_graph.index = util.clamp(index, 0, length - 1)
+        # changing speed values
+        self._switch_curve(curve)
 
-        speed = self.current_graph.get() * self.max_speed
-        self.last_speed = speed
+        # stopped, so index must be 0
+        if index_delta is None:
+            self.index = 0
+        else:
+            self.index = util.clamp(self.index + index_delta, 0, len(curve) - 1)
 
-        return speed
+        self._update_speed()
+        return self.last_speed
 
 
 class VehicleController(BaseController):
@@ -661,7 +718,7 @@ class VehicleController(BaseController):
         return 0
 
     def slow(self, speed_multiple):
-        self.engine.current_graph.slow(speed_multiple)
+        self.engine.slow(speed_multiple)
 
     def tick(self):
         # todo: only change direction to opposite if stopped, otherwise brake
@@ -693,7 +750,7 @@ class VehicleController(BaseController):
 
                 # start with small boost
                 if self.last_state == VehicleController.STOPPED:
-                    self.engine.accelerate_graph.index += 1
+                    self.engine.boost()
 
         # check for crashing
         pos = self.entity.transform.as_tuple()
@@ -795,142 +852,232 @@ class VehicleController(BaseController):
 
 
 class NavigationGraph:
-    OUT_OF_RANGE = 100
-    WRONG_BLOCK_TYPE = 101
+    PATH_CACHE_SIZE = 256
+    FLOW_FIELD_CACHE_SIZE = 16
 
     def __init__(self, the_world):
         assert isinstance(the_world, world_module.World)  # just for pavement
 
         self.world = the_world
         self.graph = None
+        self.timings = OrderedDict()
         self.debug_nodes = []
         self.debug_rects = []
 
-    def _valid(self, pos, blocktype):
+        # incremented every time the graph changes
+        self.version = 0
+
+        self._blocktype = None
+        self._weight_lookup = {}
+        self._weights = None
+        self._rects = {}
+        self._rect_grid = None
+        self._next_rect_id = 0
+        self._node_owners = {}
+
+        # (start node, goal node): node path, and node: keys of all cached paths through it
+        self._path_cache = OrderedDict()
+        self._paths_through = {}
+
+        # destination tile: FlowField
+        self._flow_fields = OrderedDict()
+
+        self.world.add_block_listener(self._on_block_change)
+
+    def _build_tile_tables(self, blocktype, secondary_blocktypes):
         """
-        :param blocktype: If None, only checks for out of world
-        :return:    WRONG_BLOCK_TYPE = wrong block
-                    OUT_OF_RANGE     = out of world
-                    1                = valid
+        Walks the terrain once, building the tables that the rest of the generation works from
+
+        :param blocktype: Main blocktype: weight 1
+        :param secondary_blocktypes: {Other blocktype: weight, ...}
+        :return: Grid of tile weights (None if not walkable),
+                 grid of run lengths of the main blocktype towards the east
         """
-        # out of world
-        if not self.world.is_in_range(*pos):
-            return NavigationGraph.OUT_OF_RANGE
+        weight_lookup = dict(secondary_blocktypes) if secondary_blocktypes else {}
+        weight_lookup[blocktype] = 1
 
-        block = self.world.get_block(*pos)
+        width = self.world.tile_width
+        terrain = self.world.layers["terrain"]
+        weights = []
+        runs = []
 
-        # wrong blocktype
-        if blocktype is not None and block.blocktype != blocktype:
-            return NavigationGraph.WRONG_BLOCK_TYPE
+        for y in xrange(self.world.tile_height):
+            row = terrain[y]
+            weights.append([weight_lookup.get(b.blocktype) if b else None for b in row])
 
-        return True
+            # count backwards, so each run length is the previous plus one
+            run_row = [0] * (width + 1)
+            for x in xrange(width - 1, -1, -1):
+                b = row[x]
+                if b and b.blocktype == blocktype:
+                    run_row[x] = run_row[x + 1] + 1
+            runs.append(run_row)
+
+        return weights, runs
 
-    def _max_expansion(self, tile_pos, blocktype, func=None):
+    def _decompose(self, runs):
         """
-        Expands as much as possible to fill all blocks of the given blocktype
+        Splits all tiles of the main blocktype into rectangles, in a single row-major pass.
+        Each unclaimed tile starts a rectangle, which is stretched east as far as possible, then south while the whole span
+        is still valid. Tiles below the current row can never already be claimed inside the span, so only the run lengths
+        need to be checked when stretching south
 
-        :param blocktype: The blocktype to expand into, or None for all blocktypes
-        :param func: Optional checking after each expansion, if returns True then the expansion is halted and the rectangle returned
-        :return: The expanded rectangle
+        :param runs: Grid of run lengths, from _build_tile_tables
         """
+        width = self.world.tile_width
+        height = self.world.tile_height
+
+        for y in xrange(height):
+            run_row = runs[y]
+            owner_row = self._rect_grid[y]
+            x = 0
+
+            while x < width:
+                run = run_row[x]
+                if not run or owner_row[x] is not None:
+                    x += 1
+                    continue
+
+                # stretch east, stopping at tiles claimed by rectangles from above
+                w = 1
+                while w < run and owner_row[x + w] is None:
+                    w += 1
+
+                # stretch south
+                h = 1
+                while y + h < height and runs[y + h][x] >= w:
+                    h += 1
 
-        def check_rect(r):
-            valid = False
-            try:
-                for x, y, b in self.world.iterate_rectangle(r):
-                    valid = True
-                    if self._valid((x, y), blocktype) != 1:
-                        return False
-            except IndexError:
-                return False
+                self._claim_rect(util.Rect(x, y, w, h))
+                x += w
 
-            return valid
+    def _decompose_area(self, area):
+        """
+        Splits the unclaimed tiles of the main blocktype inside the given area into rectangles, like _decompose but without
+        relying on run lengths, which are not kept up to date after generation
+
+        :return: Nodes that did not previously exist
+        """
+        x1, y1, x2, y2 = area
+        new_nodes = []
 
-        rect = util.Rect(tile_pos, (1, 1))
-        directions = [True for _ in constants.Direction.VALUES]
+        def free(tx, ty):
+            b = self.world.get_block(tx, ty)
+            return b and b.blocktype == self._blocktype and self._rect_grid[ty][tx] is None
 
-        while True:
-            all_expired = True
+        for y in xrange(y1, y2):
+            for x in xrange(x1, x2):
+                if not free(x, y):
+                    continue
 
-            for d in (x for x in constants.Direction.VALUES if directions[x]):
-                all_expired = False
-                rect.expand(d, 1)
+                w = 1
+                while x + w < x2 and free(x + w, y):
+                    w += 1
 
-                # check if this was unsuccessful
-                if not check_rect(rect):
-                    rect.expand(d, -1)
-                    directions[d] = False
+                h = 1
+                while y + h < y2 and all(free(tx, y + h) for tx in xrange(x, x + w)):
+                    h += 1
 
-                else:
-                    if func is not None and func(rect):
-                        return rect
+                new_nodes.extend(self._claim_rect(util.Rect(x, y, w, h)))
 
-            # all directions done
-            if all_expired:
-                return rect
+        return new_nodes
 
-    def _connect_nodes(self, nodes, primary_blocktype, secondary_blocktypes=None):
+    @staticmethod
+    def _rect_nodes(rect):
         """
-        Probes in every direction from every node, connecting nodes with edges
-        :param nodes: Set of nodes
-        :param primary_blocktype: Main blocktype: every edge will have weight 1
-        :param secondary_blocktypes: {Other blocktype: weight, ...}
+        :return: The nodes of the given rectangle: its start, and the start of the square at its far end
         """
-        # add nodes to graph
-        graph = {n: set() for n in nodes}
+        if rect.width > rect.height:
+            end = rect.x + rect.width - rect.height, rect.y
+        else:
+            end = rect.x, rect.y + rect.height - rect.width
+        return (rect.x, rect.y), end
 
-        # represent nodes in a 2d grid
-        grid = [[None] * self.world.tile_width for _ in xrange(self.world.tile_height)]
-        for n in nodes:
-            grid[n[1]][n[0]] = n
+    def _claim_rect(self, rect):
+        """
+        Registers the given rectangle and its nodes
+        :return: Nodes that did not previously exist
+        """
+        rect_id = self._next_rect_id
+        self._next_rect_id += 1
+        self._rects[rect_id] = rect
 
-        # raycast from each
-        for n in nodes:
+        claim = [rect_id] * rect.width
+        for y in xrange(rect.y, rect.y + rect.height):
+            self._rect_grid[y][rect.x:rect.x + rect.width] = claim
 
-            # check all directions
-            for d in constants.Direction.VALUES:
-                pos = n
-                total_weight = 0
+        new_nodes = []
+        for node in set(self._rect_nodes(rect)):
+            count = self._node_owners.get(node, 0)
+            if not count:
+                new_nodes.append(node)
+            self._node_owners[node] = count + 1
 
-                while True:
-                    pos = util.add_direction(pos, d, 1)
-                    weight = None
+        return new_nodes
 
-                    # invalid tile
-                    primary_check = self._valid(pos, primary_blocktype)
+    def _release_rect(self, rect_id):
+        """
+        Unregisters the given rectangle and its nodes
+        :return: Nodes that are no longer owned by any rectangle
+        """
+        rect = self._rects.pop(rect_id)
 
-                    # out of world: instant fail
-                    if primary_check == NavigationGraph.OUT_OF_RANGE:
-                        break
+        release = [None] * rect.width
+        for y in xrange(rect.y, rect.y + rect.height):
+            self._rect_grid[y][rect.x:rect.x + rect.width] = release
 
-                    # secondary blocktype checks
-                    elif secondary_blocktypes and primary_check == NavigationGraph.WRONG_BLOCK_TYPE:
-                        for bt, w in secondary_blocktypes.items():
-                            secondary_check = self._valid(pos, bt)
-                            if secondary_check == 1:
-                                weight = w
-                                break
+        old_nodes = []
+        for node in set(self._rect_nodes(rect)):
+            count = self._node_owners[node] - 1
+            if count:
+                self._node_owners[node] = count
+            else:
+                del self._node_owners[node]
+                old_nodes.append(node)
 
-                        # still invalid blocktype
-                        if weight is None:
-                            break
+        return old_nodes
 
-                    elif primary_check == 1:
-                        weight = 1
+    @staticmethod
+    def _connect_line(graph, line, node_indices, to_node):
+        """
+        Connects each pair of consecutive nodes along a single row or column, if nothing unwalkable lies between them
 
-                    total_weight += weight
+        :param line: Tile weights along the row or column
+        :param node_indices: Sorted indices of the nodes along this line
+        :param to_node: Function converting an index on this line to a node
+        """
+        for a, b in zip(node_indices, node_indices[1:]):
+            between = line[a + 1:b + 1]
+            if None in between:
+                continue
 
-                    # check for another node reached
-                    other = grid[pos[1]][pos[0]]
+            total_weight = sum(between)
+            node, other = to_node(a), to_node(b)
+            graph[node].add((other, total_weight))
+            graph[other].add((node, total_weight))
 
-                    if other is None:
-                        continue
+    def _connect_nodes(self, nodes):
+        """
+        Connects every node to the nearest visible node in every direction, by scanning each row and column that holds a node
+        :param nodes: Set of nodes
+        """
+        # add nodes to graph
+        graph = {n: set() for n in nodes}
 
-                    # connect the two
-                    graph[n].add((other, total_weight))
-                    graph[other].add((n, total_weight))
+        rows = {}
+        columns = {}
+        for x, y in nodes:
+            rows.setdefault(y, []).append(x)
+            columns.setdefault(x, []).append(y)
 
-                    break
+        for y, xs in rows.items():
+            self._connect_line(graph, self._weights[y], sorted(xs), lambda i: (i, y))
+
+        # columns are only built if needed
+        if columns:
+            transposed = zip(*self._weights)
+            for x, ys in columns.items():
+                self._connect_line(graph, transposed[x], sorted(ys), lambda i: (x, i))
 
         self.graph = graph
 
@@ -940,76 +1087,210 @@ class NavigationGraph:
         :param blocktype: Main blocktype: every edge will have weight 1
         :param secondary_blocktypes: {Other blocktype: weight, ...}
         """
-        rects = []
+        self.timings = OrderedDict()
+        phase_start = [time.time()]
 
-        # collect all positions
-        positions = set((x, y) for x, y, b in self.world.iterate_blocks() if b.blocktype == blocktype)
+        def end_phase(name):
+            now = time.time()
+            self.timings[name] = now - phase_start[0]
+            phase_start[0] = now
 
-        # keep going until no more left
-        while positions:
-            # pop the first position
-            next_pos = next(iter(positions))
+        self._blocktype = blocktype
+        self._weight_lookup = dict(secondary_blocktypes) if secondary_blocktypes else {}
+        self._weight_lookup[blocktype] = 1
 
-            # create rect
-            rect = self._max_expansion(next_pos, blocktype)
+        self._weights, runs = self._build_tile_tables(blocktype, secondary_blocktypes)
+        end_phase("tables")
 
-            # remove all selected tiles from set
-            for x in xrange(rect.x, rect.x + rect.width):
-                for y in xrange(rect.y, rect.y + rect.height):
-                    try:
-                        positions.remove((x, y))
-                    except KeyError:
-                        pass
+        self._rects = {}
+        self._rect_grid = [[None] * self.world.tile_width for _ in xrange(self.world.tile_height)]
+        self._next_rect_id = 0
+        self._node_owners = {}
+        self._decompose(runs)
+        end_phase("rectangles")
 
-            rects.append(rect)
-            # self.debug_rects.append(rect.to_pixel())
+        # connect nodes
+        self._connect_nodes(set(self._node_owners))
+        end_phase("edges")
 
-        # find all nodes (without duplicates)
-        nodes = set()
-        register_node = lambda rect: nodes.add(rect.position())
-        for r in rects:
-            # start
-            register_node(r)
+        self.debug_nodes = set(self.graph)
+        self._path_cache.clear()
+        self._paths_through.clear()
+        self.version += 1
 
-            # end
-            horizontal_length = r.width > r.height
-            shift_to_end = (r.width - r.height, 0) if horizontal_length else (0, r.height - r.width)
-            r.translate(shift_to_end)
-            register_node(r)
+        for phase, duration in self.timings.items():
+            constants.LOGGER.debug("Navigation graph phase '%s' took %.2fms" % (phase, duration * 1000))
 
-        # connect nodes
-        self._connect_nodes(nodes, blocktype, secondary_blocktypes)
+    def _walkable_span(self, pos, horizontal, changed=None):
+        """
+        :param horizontal: Span along the row if True, otherwise along the column
+        :param changed: Optional (position, weight) to use instead of the stored weight of that tile
+        :return: Inclusive (start, end) indices of the walkable span containing the given position, or None if unwalkable
+        """
+        axis = 0 if horizontal else 1
+        length = self.world.tile_width if horizontal else self.world.tile_height
 
-        self.debug_nodes = nodes
+        def weight(i):
+            tile = (i, pos[1]) if horizontal else (pos[0], i)
+            if changed and tile == changed[0]:
+                return changed[1]
+            return self._weights[tile[1]][tile[0]]
+
+        index = pos[axis]
+        if weight(index) is None:
+            return None
+
+        start = end = index
+        while start > 0 and weight(start - 1) is not None:
+            start -= 1
+        while end < length - 1 and weight(end + 1) is not None:
+            end += 1
+
+        return start, end
+
+    def _on_block_change(self, x, y, block, layer):
+        """
+        Block listener that repairs the graph around a changed terrain block.
+        Only the rectangles touching the block are split up again, and only the walkable spans of the rows and columns
+        that hold the block or a changed node are reconnected
+        """
+        if layer != "terrain" or self.graph is None:
+            return
+
+        pos = (x, y)
+        old_weight = self._weights[y][x]
+        new_weight = self._weight_lookup.get(block.blocktype) if block else None
+        was_primary = self._rect_grid[y][x] is not None
+        is_primary = bool(block) and block.blocktype == self._blocktype
+
+        if old_weight == new_weight and was_primary == is_primary:
+            return
+
+        # split up the rectangles that touch the tile, and cover their area again
+        old_nodes = []
+        new_nodes = []
+        if was_primary or is_primary:
+            rect_ids = set([self._rect_grid[y][x]]) if was_primary else set()
+            if is_primary:
+                for _, (nx, ny), _ in self.world.get_surrounding_blocks(pos):
+                    rect_ids.add(self._rect_grid[ny][nx])
+                rect_ids.discard(None)
+
+            area = [x, y, x + 1, y + 1]
+            for rect_id in rect_ids:
+                r = self._rects[rect_id]
+                area = [min(area[0], r.x), min(area[1], r.y), max(area[2], r.x + r.width), max(area[3], r.y + r.height)]
+                old_nodes.extend(self._release_rect(rect_id))
+
+            new_nodes = self._decompose_area(area)
+
+        # nodes that were released and then claimed again are unchanged
+        reclaimed = set(old_nodes).intersection(new_nodes)
+        old_nodes = [n for n in old_nodes if n not in reclaimed]
+        new_nodes = [n for n in new_nodes if n not in reclaimed]
+
+        # find the spans to reconnect, before and after the change
+        spans = {}
+        changed = (pos, old_weight)
+        self._weights[y][x] = new_weight
+
+        for p in [pos] + old_nodes + new_nodes:
+            for horizontal in (True, False):
+                line = (horizontal, p[1] if horizontal else p[0])
+                for span in (self._walkable_span(p, horizontal, changed), self._walkable_span(p, horizontal)):
+                    if span:
+                        spans.setdefault(line, []).append(span)
+
+        # remove old nodes entirely
+        for n in old_nodes:
+            for other, w in self.graph.pop(n):
+                self.graph[other].discard((n, w))
+            self.debug_nodes.discard(n)
+
+        for n in new_nodes:
+            self.graph[n] = set()
+            self.debug_nodes.add(n)
+
+        # reconnect each span from scratch
+        touched = set(old_nodes)
+        for (horizontal, fixed), line_spans in spans.items():
+            start = min(s[0] for s in line_spans)
+            end = max(s[1] for s in line_spans)
+            to_node = (lambda i: (start + i, fixed)) if horizontal else (lambda i: (fixed, start + i))
+            axis = 1 if horizontal else 0
+
+            indices = []
+            for i in xrange(end - start + 1):
+                n = to_node(i)
+                neighbours = self.graph.get(n)
+                if neighbours is None:
+                    continue
+
+                indices.append(i)
+                touched.add(n)
+
+                # drop edges along this line
+                for edge in [e for e in neighbours if e[0][axis] == fixed]:
+                    neighbours.discard(edge)
+                    self.graph[edge[0]].discard((n, edge[1]))
+
+            if horizontal:
+                line = self._weights[fixed][start:end + 1]
+            else:
+                line = [self._weights[i][fixed] for i in xrange(start, end + 1)]
+
+            self._connect_line(self.graph, line, indices, to_node)
+
+        self._invalidate_paths(touched)
+        self.version += 1
 
     def _find(self, start, goal):
-        frontier = util.Heap(lambda a, b: util.compare(heuristic(a), heuristic(b)), len(self.graph))
-        frontier.add(start)
+        """
+        A* from the start node to the goal node
+        :return: (goal, {node: node it was reached from}), or None if the goal can't be reached
+        """
+        # every tile costs at least 1 to walk on, and edges are straight lines
+        heuristic = lambda n: abs(n[0] - goal[0]) + abs(n[1] - goal[1])
+
+        frontier = [(heuristic(start), start)]
         came_from = {}
         costs = {start: 0}
-        heuristic = lambda n: util.distance(n, goal)
+        done = set()
 
-        while not frontier.empty():
-            current = frontier.pop()
+        while frontier:
+            _, current = heapq.heappop(frontier)
 
             if current == goal:
                 return goal, came_from
 
+            # already reached more cheaply
+            if current in done:
+                continue
+            done.add(current)
+
+            cost = costs[current]
             for neighbour, weight in self.graph[current]:
-                new_cost = costs[current] + weight
-                if neighbour not in costs or new_cost < costs[neighbour]:
+                new_cost = cost + weight
+                old_cost = costs.get(neighbour)
+                if old_cost is None or new_cost < old_cost:
                     costs[neighbour] = new_cost
-                    # priority = new_cost + heuristic(neighbour)
-                    # frontier.put(neighbour, priority)
-                    frontier.add(neighbour)
                     came_from[neighbour] = current
+                    heapq.heappush(frontier, (new_cost + heuristic(neighbour), neighbour))
 
         return None
 
     def _find_path(self, start, goal):
         """
-        Finds a path using A* from the start node to the goal node
+        Finds a path using A* from the start node to the goal node, or reuses a cached path if still valid
         """
+        key = start, goal
+        path = self._path_cache.get(key)
+        if path is not None:
+            # most recently used goes to the back
+            del self._path_cache[key]
+            self._path_cache[key] = path
+            return list(path)
+
         result = self._find(start, goal)
         if result is None:
             return None
@@ -1021,59 +1302,123 @@ class NavigationGraph:
             node = trace[node]
             path.append(node)
 
-        return path[::-1]
+        path.reverse()
+        self._cache_path(key, path)
+        return list(path)
+
+    def _cache_path(self, key, path):
+        """
+        Caches the given path, evicting the least recently used if the cache is full
+        """
+        if len(self._path_cache) >= NavigationGraph.PATH_CACHE_SIZE:
+            old_key, old_path = self._path_cache.popitem(last=False)
+            for n in old_path:
+                keys = self._paths_through.get(n)
+                if keys:
+                    keys.discard(old_key)
+
+        self._path_cache[key] = path
+        for n in path:
+            self._paths_through.setdefault(n, set()).add(key)
+
+    def _invalidate_paths(self, nodes):
+        """
+        Drops all cached paths that pass through any of the given nodes
+        """
+        for n in nodes:
+            for key in self._paths_through.pop(n, ()):
+                self._path_cache.pop(key, None)
+
+    def _find_nearest_rect(self, tile_pos):
+        """
+        Searches outwards from the given tile a square ring at a time, through the table of which rectangle owns each tile
+        :return: The id of the nearest rectangle to the given tile, or None if there are none
+        """
+        if not self._rects:
+            return None
+
+        x, y = tile_pos
+        width, height = self.world.tile_width, self.world.tile_height
 
-    def _find_nearest_node(self, tile_pos, blocktype=None):
-        def find_node(rect):
-            for x, y, _ in self.world.iterate_rectangle(rect):
-                if (x, y) in self.graph:
-                    return x, y
+        for radius in xrange(1, max(width, height)):
+            x1, x2 = max(0, x - radius), min(width - 1, x + radius)
+            y1, y2 = max(0, y - radius), min(height - 1, y + radius)
 
-        rect = self._max_expansion(tile_pos, blocktype, find_node)
+            ring = []
+            for ty in (y - radius, y + radius):
+                if 0 <= ty < height:
+                    ring.extend((tx, ty) for tx in xrange(x1, x2 + 1))
+            for tx in (x - radius, x + radius):
+                if 0 <= tx < width:
+                    ring.extend((tx, ty) for ty in xrange(y1, y2 + 1))
 
-        # try again with all directions
-        if rect.size() == (1, 1):
-            rect = self._max_expansion(tile_pos, None, find_node)
+            owned = [t for t in ring if self._rect_grid[t[1]][t[0]] is not None]
+            if owned:
+                nearest = min(owned, key=lambda t: util.distance_sqrd(t, tile_pos))
+                return self._rect_grid[nearest[1]][nearest[0]]
+
+        return None
 
-            # rekt
-            if not rect:
+    def _find_nearest_node(self, tile_pos):
+        """
+        :return: The nearest node of the rectangle that holds the given tile, or of the nearest rectangle if the tile is not
+                 of the main blocktype. None if there are no nodes
+        """
+        rect_id = self._rect_grid[tile_pos[1]][tile_pos[0]]
+        if rect_id is None:
+            rect_id = self._find_nearest_rect(tile_pos)
+            if rect_id is None:
                 return None
 
-        return find_node(rect)
+        return min(self._rect_nodes(self._rects[rect_id]), key=lambda n: util.distance_sqrd(n, tile_pos))
 
-    def _find_direct_path(self, src_tile, dest_tile):
-        path = [src_tile]
-        current = src_tile
+    @staticmethod
+    def _corners_only(points):
+        """
+        :return: The given points without duplicates or points in the middle of straight lines
+        """
+        corners = []
+        for p in points:
+            if corners and corners[-1] == p:
+                continue
 
-        while tuple(current) != dest_tile:
-            direction = constants.Direction.get_direction_between(current, dest_tile)
-            current = tuple(util.add_direction(current, direction))
-            path.append(current)
+            if len(corners) >= 2:
+                a, b = corners[-2], corners[-1]
+                if a[0] == b[0] == p[0] or a[1] == b[1] == p[1]:
+                    corners[-1] = p
+                    continue
 
-        return path
+            corners.append(p)
+
+        return corners
 
+    @profiler.profiled("pathfinding")
     def find_walking_path(self, src, dest):
+        """
+        :return: The corners of a walking path from src to dest, each in a straight line from the last, or None if
+                 there is no path
+        """
 
         # find nodes (in all directions)
-        start_node = self._find_nearest_node(src, world_module.BlockType.PAVEMENT)
-        end_node = self._find_nearest_node(dest, world_module.BlockType.PAVEMENT)
+        start_node = self._find_nearest_node(src)
+        end_node = self._find_nearest_node(dest)
 
         if start_node is None or end_node is None:
             return None
 
         # todo if src is closer to dest than start, then walk direct
 
-        prefix_path = self._find_direct_path(src, start_node)
         main_path = self._find_path(start_node, end_node)
-        suffix_path = self._find_direct_path(end_node, dest)
 
         # no path
-        if not main_path or not prefix_path or not suffix_path:
+        if not main_path:
             return None
 
-        path = prefix_path
-        path.extend(main_path[1:])
-        path.extend(suffix_path[1:])
+        # the nearest nodes share a rectangle with src and dest, so can be walked to directly
+        path = [tuple(src)]
+        path.extend(main_path)
+        path.append(tuple(dest))
+        path = self._corners_only(path)
 
         # debug remove all from graph except this path: NO OTHER SEARCHES WILL BE POSSIBLE
         show_path = False
@@ -1095,184 +1440,358 @@ class NavigationGraph:
 
         return path
 
-    def debug_render(self):
-        # for n in self.debug_nodes:
-        # constants.SCREEN.draw_rect(util.Rect(util.tile_to_pixel(n), constants.TILE_DIMENSION))
-        #
-        for r in self.debug_rects:
-            constants.SCREEN.draw_rect(r, filled=False)
-
-        min_w = min(w for neighbours in self.graph.values() for _, w in neighbours)
-        max_w = max(w for neighbours in self.graph.values() for _, w in neighbours)
-
-        for node, neighbours in self.graph.items():
-            node_pos = util.tile_to_pixel(node)
-            constants.SCREEN.draw_rect(util.Rect(node_pos, constants.TILE_DIMENSION), filled=False, colour=(0, 180, 20))
+    def get_flow_field(self, destination):
+        """
+        :param destination: Destination tile
+        :return: The flow field towards the given destination, from the cache if it is still up to date
+        """
+        field = self._flow_fields.pop(destination, None)
+        if field is None or field.version != self.version:
+            field = FlowField(self, destination)
 
-            for n, weight in neighbours:
-                edge = util.tile_to_pixel(map(lambda x: x + 0.5, n))
-                node_pos = util.tile_to_pixel(map(lambda x: x + 0.5, node))
-                edge_c = util.lerp_colours((0, 0, 255), (255, 0, 0), util.convert_to_range((min_w, max_w), (0, 1), weight))
-                constants.SCREEN.draw_line(node_pos, edge, colour=edge_c)
+            if len(self._flow_fields) >= NavigationGraph.FLOW_FIELD_CACHE_SIZE:
+                self._flow_fields.popitem(last=False)
 
-                label = str(weight)
-                constants.SCREEN.draw_string(label, util.midpoint(node_pos, edge), colour=(255, 255, 255), absolute=False)
+        # most recently used goes to the back
+        self._flow_fields[destination] = field
+        return field
 
 
-# behaviour tree goodness
-class BehaviourTree:
+class FlowField:
     """
-    Behaviour tree, containing a hierarchy of behaviours
+    Cost of reaching a single destination from every tile, and the direction to take from each tile to get there.
+    One field is shared by any number of entities heading to the same destination
     """
+    NO_DIRECTION = 0xFF
 
-    def __init__(self, entity_controller, tree):
+    def __init__(self, nav_graph, destination):
         """
-        :param tree: Root task
+        :param nav_graph: The navigation graph, whose tile weights are used as the cost of entering each tile
+        :param destination: Destination tile
         """
-        self._root = None
-        self.current = None
-        # self.data_context = {}
-        self.controller = entity_controller
+        self.destination = tuple(destination)
+        self.version = nav_graph.version
+        self.width = nav_graph.world.tile_width
+        self.height = nav_graph.world.tile_height
 
-        self.set_root(tree)
+        self.costs = [[None] * self.width for _ in xrange(self.height)]
+        self.directions = [bytearray([FlowField.NO_DIRECTION] * self.width) for _ in xrange(self.height)]
 
-    def set_root(self, node):
-        if self.current:
-            self.current.end()
+        self._integrate(nav_graph._weights)
 
-        self._root = node
-        self.current = self._root
+    @profiler.profiled("flow_field")
+    def _integrate(self, weights):
+        """
+        Dijkstra outwards from the destination, over all walkable tiles
+        """
+        costs = self.costs
+        directions = self.directions
+        offsets = list(enumerate(util.SURROUNDING_OFFSETS))
 
-        self.current.init()
+        dx, dy = self.destination
+        costs[dy][dx] = 0
+        frontier = [(0, self.destination)]
 
-    def get_root(self):
-        return self._root
+        while frontier:
+            cost, (x, y) = heapq.heappop(frontier)
+            if cost > costs[y][x]:
+                continue
 
-    def tick(self):
-        # todo: don't traverse the tree each frame
-        # todo: INTERRUPTIONS?!
-        self.current.process()
+            # the destination may be unwalkable, such as a door
+            new_cost = cost + (weights[y][x] or 1)
 
+            for direction, (ox, oy) in offsets:
+                nx, ny = x + ox, y + oy
+                if not (0 <= nx < self.width and 0 <= ny < self.height) or weights[ny][nx] is None:
+                    continue
 
-class Task:
-    """
-    Base task
-    """
-    RUNNING = 0
-    FAILURE = 1
-    SUCCESS = 2
+                old_cost = costs[ny][nx]
+                if old_cost is None or new_cost < old_cost:
+                    costs[ny][nx] = new_cost
+                    directions[ny][nx] = constants.Direction.opposite(direction)
+                    heapq.heappush(frontier, (new_cost, (nx, ny)))
 
-    def __init__(self, *children):
+    def get_cost(self, tile):
         """
-        :param children: All child nodes
+        :return: The cost of reaching the destination from the given tile, or None if it can't be reached
         """
-        # self.data_context = data_context
-        self.children_tasks = list(children)
+        return self.costs[tile[1]][tile[0]]
 
-    def init(self):
+    def get_direction(self, tile):
         """
-        Called once on start
+        :return: The direction to move in from the given tile, or None if the destination can't be reached.
+                 Unwalkable tiles point towards their cheapest walkable neighbour
         """
-        pass
+        direction = self.directions[tile[1]][tile[0]]
+        if direction != FlowField.NO_DIRECTION:
+            return direction
+
+        best = None
+        best_cost = None
+        for direction, (ox, oy) in enumerate(util.SURROUNDING_OFFSETS):
+            nx, ny = tile[0] + ox, tile[1] + oy
+            if 0 <= nx < self.width and 0 <= ny < self.height:
+                cost = self.costs[ny][nx]
+                if cost is not None and (best_cost is None or cost < best_cost):
+                    best, best_cost = direction, cost
+
+        return best
 
-    def end(self):
+
+class CrowdAvoidance:
+    """
+    Keeps pedestrians from walking through each other, by pushing apart any humans that are within each other's
+    personal space and sidestepping them past each other.
+    Every human in the world is handled in a single pass over the entity grid each frame
+    """
+
+    # offsets of the neighbouring grid cells still to be compared with a cell, so each pair is only checked once
+    _NEIGHBOUR_CELLS = ((1, 0), (-1, 1), (0, 1), (1, 1))
+
+    def __init__(self, world, radius=None, strength=None, sidestep=0.5):
         """
-        Called once on end
+        :param radius: Personal space radius in pixels, defaults to 3/4 of a tile
+        :param strength: Avoidance speed when two humans are on top of each other, which is also the maximum.
+                         Defaults to the minimum human speed
+        :param sidestep: Proportion of the push that is applied sideways, to walk around each other
         """
-        pass
+        self.world = world
+        self.radius = radius if radius else constants.TILE_SIZE * 0.75
+        self.strength = float(strength if strength else constants.Speed.HUMAN_MIN)
+        self.sidestep = sidestep
 
-    def process(self):
+    def tick(self):
         """
-        Called every frame that it is active
-        :return: New state
+        Updates the avoidance velocity of every human in the world
         """
-        pass
+        radius = self.radius
+        radius_sqrd = radius * radius
+        scale = self.strength / radius
+        sidestep = self.sidestep
+
+        humans = []
+        xs = []
+        ys = []
+        cells = {}
+
+        for e in self.world.entities:
+            if e.entitytype != constants.EntityType.HUMAN:
+                continue
+
+            if e.dead or not e.visible or not e.collisions_enabled:
+                e.avoidance.zero()
+                continue
+
+            cells.setdefault(e.grid_cell, []).append(len(humans))
+            humans.append(e)
+            xs.append(e.transform.x)
+            ys.append(e.transform.y)
+
+        push_x = [0.0] * len(humans)
+        push_y = [0.0] * len(humans)
+
+        for (cx, cy), members in cells.iteritems():
+            neighbours = []
+            for dx, dy in CrowdAvoidance._NEIGHBOUR_CELLS:
+                cell = cells.get((cx + dx, cy + dy))
+                if cell:
+                    neighbours.extend(cell)
+
+            for i in xrange(len(members)):
+                a = members[i]
+                ax = xs[a]
+                ay = ys[a]
+
+                # rest of this cell, then the neighbouring cells
+                for b in members[i + 1:] + neighbours:
+                    ox = ax - xs[b]
+                    oy = ay - ys[b]
+                    distance_sqrd = ox * ox + oy * oy
+                    if distance_sqrd >= radius_sqrd:
+                        continue
+
+                    # exactly on top of each other
+                    if distance_sqrd == 0:
+                        ox, oy, distance = 1.0, 0.0, 0.0
+                    else:
+                        distance = sqrt(distance_sqrd)
+                        ox /= distance
+                        oy /= distance
+
+                    # pushed apart, and along the perpendicular in opposite directions
+                    push = (radius - distance) * scale
+                    px = (ox - oy * sidestep) * push
+                    py = (oy + ox * sidestep) * push
+
+                    push_x[a] += px
+                    push_y[a] += py
+                    push_x[b] -= px
+                    push_y[b] -= py
+
+        max_speed_sqrd = self.strength * self.strength
+        for i, e in enumerate(humans):
+            # the controlled human is still avoided by everyone else, but is only moved by its controls
+            if e.controller and e.controller._suppressed_behaviour:
+                e.avoidance.zero()
+                continue
+
+            px = push_x[i]
+            py = push_y[i]
 
+            speed_sqrd = px * px + py * py
+            if speed_sqrd > max_speed_sqrd:
+                limit = self.strength / sqrt(speed_sqrd)
+                px *= limit
+                py *= limit
 
-class LeafTask(Task):
+            e.avoidance.x = px
+            e.avoidance.y = py
+
+
+class AIScheduler:
     """
-    Childless task, that executes an action
+    Spreads behaviour tree ticks over several frames, within a time budget per frame.
+
+    Entities that are steering are ticked every frame. Everyone else only makes decisions every few frames, more often
+    when near the camera, and is deferred to the next frame once the budget has been used
     """
 
     def __init__(self):
+        self.budget = constants.CONFIG["ai.budget-ms"] / 1000.0
+        self.near_interval = constants.CONFIG["ai.decision-interval.near"]
+        self.far_interval = constants.CONFIG["ai.decision-interval.far"]
+
+        # starvation guard: past this many frames, an entity is ticked regardless of the budget
+        self.max_wait = self.far_interval * 4
+
+        self.frame = 0
+        self._used = 0
+        self._stats = self._new_stats()
+        self.last_stats = self._new_stats()
+        self.total_overruns = 0
+
+    @staticmethod
+    def _new_stats():
+        return {"ticked": 0, "steering": 0, "deferred": 0, "over-budget": 0, "forced": 0, "asleep": 0, "used": 0}
+
+    def begin_frame(self):
         """
-        Leaves have no children
+        Called once per frame before any world is ticked
         """
-        Task.__init__(self)
+        self._stats["used"] = self._used
+        if self._used > self.budget:
+            self.total_overruns += 1
 
+        self.last_stats = self._stats
+        self._stats = self._new_stats()
+        self._used = 0
+        self.frame += 1
 
-class Composite(Task):
-    """
-    Task that holds several child tasks
-    """
+    def _is_near(self, the_entity):
+        """
+        :return: True if the entity is on screen, or within half a screen of it
+        """
+        camera = constants.SCREEN.camera
+        if not camera or camera.world != the_entity.world:
+            return False
 
-    def __init__(self, *children):
-        Task.__init__(self, *children)
-        self.children_stack = util.Stack()
+        return camera.is_visible(the_entity.transform, margin=(camera.view_size[0] / 2, camera.view_size[1] / 2))
 
-    def init(self):
-        for child in reversed(self.children_tasks):
-            # child.data_context = self.data_context
-            self.children_stack.push(child)
-        self.children_stack.top.init()
+    def tick(self, controller):
+        """
+        Ticks the given controller's behaviour tree, if it is due a tick this frame
+        """
+        stats = self._stats
 
-    def end(self):
-        self.children_stack.clear()
+        if controller.behaviour_tree.asleep:
+            stats["asleep"] += 1
+            return
 
-    def _process_current(self):
-        current = self.children_stack.top
-        return current.process()
+        if controller.ai_frames_waited is None:
+            # stagger new entities so they don't all make decisions on the same frame
+            controller.ai_frames_waited = random.randrange(self.far_interval)
 
+        controller.ai_frames_waited += 1
+        controller.ai_time_waited += constants.DELTA
 
-class Sequence(Composite):
-    """
-    Executes each child in order: if one of them fails, then returns failure
-    """
+        if controller.steering:
+            stats["steering"] += 1
 
-    def process(self):
-        state = self._process_current()
+        else:
+            near = self._is_near(controller.entity)
+            if controller.ai_frames_waited < (self.near_interval if near else self.far_interval):
+                stats["deferred"] += 1
+                return
 
-        # next sequence
-        if state == Task.SUCCESS:
+            if self._used >= self.budget:
+                if controller.ai_frames_waited < self.max_wait:
+                    stats["over-budget"] += 1
+                    return
+                stats["forced"] += 1
 
-            # end current
-            last_child = self.children_stack.pop()
-            last_child.end()
-            if not self.children_stack:
-                # all children complete
-                return Task.SUCCESS
-            else:
-                # running the next child
-                self.children_stack.top.init()
-                return Task.RUNNING
+        self._run(controller)
 
-        # either running or failure: propagate this state up to the parent
-        else:
-            return state
+    @profiler.profiled("behaviour_tree")
+    def _run(self, controller):
+        """
+        Ticks the behaviour tree. The delta is still that of a single frame, as steering is applied every frame, so
+        actions that need the time since the last decision should use controller.ai_time_waited
+        """
+        start = time.time()
+        controller.behaviour_tree.tick()
 
+        controller.ai_frames_waited = 0
+        controller.ai_time_waited = 0
 
-class Selector(Composite):
+        self._used += time.time() - start
+        self._stats["ticked"] += 1
+
+    def get_debug_lines(self):
+        """
+        :return: Statistics from the last frame, to be shown in the debug overlay
+        """
+        stats = self.last_stats
+        return ["AI %.2f/%.2fms (%d over)" % (stats["used"] * 1000, self.budget * 1000, self.total_overruns),
+                "AI ticked %d (%d steering) deferred %d over-budget %d forced %d asleep %d" %
+                (stats["ticked"], stats["steering"], stats["deferred"], stats["over-budget"], stats["forced"],
+                 stats["asleep"])]
+
+
+# behaviour tree goodness
+class Task:
     """
-    Returns a success if any children succeed, and doesn't execute any further children
+    Base task, used to define the structure of a behaviour tree before it is compiled
     """
+    RUNNING = 0
+    FAILURE = 1
+    SUCCESS = 2
 
-    def process(self):
-        state = self._process_current()
+    def __init__(self, *children):
+        """
+        :param children: All child nodes
+        """
+        self.children_tasks = list(children)
 
-        if state == Task.FAILURE:
-            self.children_stack.top.end()
-            self.children_stack.pop()
 
-            # all children failed
-            if not self.children_stack:
-                return Task.FAILURE
+class Composite(Task):
+    """
+    Task that holds several child tasks
+    """
+    pass
 
-            # start new child
-            self.children_stack.top.init()
 
-        # either success or running: propagate to parent
-        else:
-            return state
+class Sequence(Composite):
+    """
+    Executes each child in order: if one of them fails, then returns failure
+    """
+    pass
+
+
+class Selector(Composite):
+    """
+    Returns a success if any children succeed, and doesn't execute any further children
+    """
+    pass
 
 
 class Decorator(Task):
@@ -1281,53 +1800,21 @@ class Decorator(Task):
     """
 
     def __init__(self, child):
-        Task.__init__(self)
-        self.child = child
-        # if child:
-        # child.parent = self
-
-    def init(self):
-        self.child.init()
-
-    def end(self):
-        self.child.end()
+        Task.__init__(self, child)
 
 
 class Inverter(Decorator):
     """
     Inverts the result of child task
     """
-
-    def process(self):
-        state = self.child.process()
-
-        # still running
-        if state == Task.RUNNING:
-            return state
-
-        # invert
-        else:
-            if state == Task.SUCCESS:
-                return Task.FAILURE
-            else:
-                return Task.SUCCESS
+    pass
 
 
 class Succeeder(Decorator):
     """
     Always returns success, even if the child task fails
     """
-
-    def process(self):
-        state = self.child.process()
-
-        # still running
-        if state == Task.RUNNING:
-            return state
-
-        # always success
-        else:
-            return Task.SUCCESS
+    pass
 
 
 class Repeater(Decorator):
@@ -1342,246 +1829,517 @@ class Repeater(Decorator):
         Decorator.__init__(self, child)
         self.repeat_times = repeat_times
 
-    def process(self):
-        state = self.child.process()
 
-        # still running
-        if state == Task.RUNNING:
-            return state
+class Action(Task):
+    """
+    Childless task that executes an action.
+    A single instance is shared by every entity running the tree, so all per-entity state must be kept in the
+    given behaviour tree's blackboard
+    """
+
+    def __init__(self):
+        Task.__init__(self)
+
+    def init(self, tree):
+        """
+        Called once on start
+        """
+        pass
 
-        else:
-            # repeat a number of times
-            if self.repeat_times > 0:
-                self.repeat_times -= 1
-                if self.repeat_times == 0:
-                    return Task.SUCCESS
-
-        # restart
-        self.child.end()
-        self.child.init()
-        return Task.RUNNING
+    def end(self, tree):
+        """
+        Called once on end
+        """
+        pass
 
+    def process(self, tree):
+        """
+        Called every frame that it is active
+        :return: New state
+        """
+        pass
 
-# class RepeatUntilFail(Decorator):
-#     """
-#     Repeats the child task until it fails
-#     """
-#
-#     def process(self):
-#         state = self.child.process()
-#
-#         # restart child on success
-#         if state == Task.SUCCESS:
-#             self.child.init()
-#             return Task.RUNNING
-#
-#         # failure and running
-#         else:
-#             return state
+    @staticmethod
+    def _bool_to_condition(b):
+        """
+        :return: Success if b is True, otherwise failure
+        """
+        return Task.SUCCESS if b else Task.FAILURE
 
 
-# leaf tasks/actions
-class EntityLeafTask(LeafTask):
+class CompiledTree:
     """
-    Helper leaf task involving an entity and its controller
+    A behaviour tree definition flattened into arrays of node types and child indices, with the root at index 0.
+    It holds no per-entity state, so one instance is shared by every entity that runs it
     """
 
-    def __init__(self, entity_controller):
-        LeafTask.__init__(self)
-        self.entity = entity_controller.entity
-        self.controller = entity_controller
+    SEQUENCE = 0
+    SELECTOR = 1
+    INVERTER = 2
+    SUCCEEDER = 3
+    REPEATER = 4
+    ACTION = 5
 
-    def _bool_to_condition(self, b):
+    def __init__(self, root):
         """
-        :return: Success if b is True, otherwise failure
+        :param root: Root task of the definition
         """
-        return Task.SUCCESS if b else Task.FAILURE
+        self.types = []
+        self.children = []
+        self.params = []
+
+        self._flatten(root)
 
+    def _flatten(self, task):
+        """
+        Appends the given task and all of its children
+        :return: Index of the task
+        """
+        if isinstance(task, Action):
+            node_type, param = CompiledTree.ACTION, task
+        elif isinstance(task, Sequence):
+            node_type, param = CompiledTree.SEQUENCE, None
+        elif isinstance(task, Selector):
+            node_type, param = CompiledTree.SELECTOR, None
+        elif isinstance(task, Inverter):
+            node_type, param = CompiledTree.INVERTER, None
+        elif isinstance(task, Succeeder):
+            node_type, param = CompiledTree.SUCCEEDER, None
+        elif isinstance(task, Repeater):
+            node_type, param = CompiledTree.REPEATER, task.repeat_times
+        else:
+            raise TypeError("Cannot compile task %r" % task)
 
-class HumanWalkToLocation(EntityLeafTask):
+        if node_type != CompiledTree.ACTION and not task.children_tasks:
+            raise ValueError("%s has no children" % task.__class__.__name__)
+
+        index = len(self.types)
+        self.types.append(node_type)
+        self.children.append(None)
+        self.params.append(param)
+
+        self.children[index] = tuple(self._flatten(child) for child in task.children_tasks)
+        return index
+
+    def __len__(self):
+        return len(self.types)
+
+
+class BehaviourTree:
     """
-    Moves the child entity to the given location
+    Runs a compiled behaviour tree for a single entity.
+    The only state kept per entity is the blackboard, for the actions, and the state of each node: the current child of
+    composites and the remaining repetitions of repeaters
     """
 
-    def __init__(self, controller, target_tile):
-        EntityLeafTask.__init__(self, controller)
+    def __init__(self, entity_controller, tree):
+        """
+        :param tree: Compiled tree to run
+        """
+        self.controller = entity_controller
+        self.entity = entity_controller.entity
+        self.blackboard = {}
+
+        # not ticked at all while asleep, see sleep()
+        self.asleep = False
+        self._wake_timer = None
+
+        self._tree = None
+        self._state = None
+        self._finished = False
+
+        # root to return to once a temporary one has finished
+        self._resume = None
+
+        self.set_root(tree)
+
+    def set_root(self, tree):
+        self.wake()
+
+        if self._tree and not self._finished:
+            self._end(0)
+
+        # the new tree steers the entity itself, if it needs to
+        self.controller.steering = False
+
+        self._tree = tree
+        self._state = [0] * len(tree)
+        self._finished = False
+        self._resume = None
+
+        self._init(0)
+
+    def push_root(self, tree):
+        """
+        Runs the given tree until it finishes, either successfully or not, then restarts the current root
+        """
+        resume = self._resume or self._tree
+        self.set_root(tree)
+        self._resume = resume
+
+    def get_root(self):
+        return self._tree
+
+    def sleep(self, delay):
+        """
+        Stops the tree from being ticked until the given time has passed, or the root is changed
+
+        :param delay: Either constant seconds, or a (min, max) range for a random time
+        """
+        self.wake()
+        self.asleep = True
+        self._wake_timer = constants.TIMERS.schedule(delay, self.wake)
+
+    def wake(self):
+        if self._wake_timer:
+            self._wake_timer.cancel()
+            self._wake_timer = None
+        self.asleep = False
+
+    def _init(self, node):
+        """
+        Starts the given node, and its first descendants down to an action
+        """
+        tree = self._tree
+        types = tree.types
+
+        while types[node] != CompiledTree.ACTION:
+            self._state[node] = tree.params[node] if types[node] == CompiledTree.REPEATER else 0
+            node = tree.children[node][0]
+
+        tree.params[node].init(self)
+
+    def _end(self, node):
+        """
+        Ends the running action under the given node
+        """
+        tree = self._tree
+        types = tree.types
+
+        while types[node] != CompiledTree.ACTION:
+            children = tree.children[node]
+            if types[node] <= CompiledTree.SELECTOR:
+                if self._state[node] >= len(children):
+                    return
+                node = children[self._state[node]]
+            else:
+                node = children[0]
+
+        tree.params[node].end(self)
+
+    def tick(self):
+        if self._finished:
+            return
+
+        tree = self._tree
+        types = tree.types
+        children = tree.children
+        state = self._state
+
+        # find the running action
+        path = []
+        node = 0
+        while types[node] != CompiledTree.ACTION:
+            path.append(node)
+            node = children[node][state[node]] if types[node] <= CompiledTree.SELECTOR else children[node][0]
+
+        result = tree.params[node].process(self)
+
+        # propagate the result back up to the root
+        for node in reversed(path):
+            if result == Task.RUNNING:
+                return
+
+            node_type = types[node]
+
+            if node_type == CompiledTree.SEQUENCE or node_type == CompiledTree.SELECTOR:
+                # sequences continue on success, selectors on failure; otherwise the result is passed up
+                if (result == Task.SUCCESS) == (node_type == CompiledTree.SEQUENCE):
+                    self._end(children[node][state[node]])
+                    state[node] += 1
+
+                    if state[node] < len(children[node]):
+                        self._init(children[node][state[node]])
+                        result = Task.RUNNING
+
+            elif node_type == CompiledTree.INVERTER:
+                result = Task.FAILURE if result == Task.SUCCESS else Task.SUCCESS
+
+            elif node_type == CompiledTree.SUCCEEDER:
+                result = Task.SUCCESS
+
+            elif node_type == CompiledTree.REPEATER:
+                # repeat a number of times
+                if state[node] > 0:
+                    state[node] -= 1
+                    if state[node] == 0:
+                        result = Task.SUCCESS
+                        continue
 
-        self._target_location = None
-        self.path = []
+                # restart
+                child = children[node][0]
+                self._end(child)
+                self._init(child)
+                result = Task.RUNNING
 
-        self._last_direction = None
-        self.set_target_tile(target_tile)
+        # the root has finished
+        if result != Task.RUNNING:
+            self._finished = True
+            if self._resume:
+                self.set_root(self._resume)
 
-    def set_target_tile(self, tile):
-        self._target_location = tile
-        self._last_direction = None
 
-    def _find_appropriate_target(self):
+# leaf tasks/actions
+class HumanWalkToLocation(Action):
+    """
+    Moves the entity to the pixel location in the "target" entry of the blackboard
+    """
+
+    @staticmethod
+    def _find_appropriate_target(tree):
         """
         :return: Centre of target tile
         """
 
-        x, y = self._target_location
+        x, y = tree.blackboard["target"]
         x += constants.TILE_SIZE / 2
         y += constants.TILE_SIZE / 2
         return x, y
 
-    def process(self):
-        target = self._find_appropriate_target()
+    def process(self, tree):
+        the_entity = tree.entity
+        controller = tree.controller
+        target = self._find_appropriate_target(tree)
 
-        distance = util.distance(self.entity.rect.centre, target)
-        threshold = constants.DELTA * self.controller.get_speed() * 1.5
+        distance = util.distance(the_entity.rect.centre, target)
+        threshold = constants.DELTA * controller.get_speed() * 1.5
 
         if distance <= threshold:
-            self.entity.move_entity_to_tile(util.pixel_to_tile(self._target_location))
+            the_entity.move_entity_to_tile(util.pixel_to_tile(tree.blackboard["target"]))
             return Task.SUCCESS
 
-        # constants.LOGGER.debug("player tile %r : target tile %r distance %f" % (self.entity.get_current_tile(), util.pixel_to_tile(target), distance))
-        direction = constants.Direction.get_direction_between(self.entity.get_current_tile(), util.pixel_to_tile(target))
+        # head for the centre of the target, so any sideways drift from avoiding others is corrected
+        direction = constants.Direction.get_direction_between(the_entity.rect.centre, target)
 
-        if direction is None or (direction != self._last_direction and self._last_direction is not None):
+        if direction is None:
             return Task.RUNNING
 
-        # constants.LOGGER.debug((util.get_enum_name(constants.Direction, direction), (self.entity.rect.position()), self.target_location))
-        self.controller.move_in_direction(direction, True)
+        controller.move_in_direction(direction, True)
+        controller.steering = True
 
         return Task.RUNNING
 
 
-class HumanFollowPath(Decorator):
-    def __init__(self, controller, path):
-        Decorator.__init__(self, HumanWalkToLocation(controller, None))
-        self._index = 0
-        self._path = []
+class HumanFollowPath(HumanWalkToLocation):
+    """
+    Walks along the corners in the "path" entry of the blackboard, one tile at a time.
+    Only the corners are stored: the next tile is worked out from the current one when it is reached
+    """
+
+    def init(self, tree):
+        self.retarget(tree, tree.blackboard["path"])
+
+    @staticmethod
+    def retarget(tree, path):
+        """
+        Starts following the given path from its first corner, which should be the current tile
+        """
+        blackboard = tree.blackboard
+        blackboard["path"] = path
+        blackboard["corner"] = 0
+        blackboard["target_tile"] = path[0]
+        blackboard["target"] = util.tile_to_pixel(path[0])
+
+    @staticmethod
+    def _next_tile(blackboard):
+        """
+        Moves the path cursor on by a tile
+        :return: The next tile towards the next corner, or None if the end of the path has been reached
+        """
+        path = blackboard["path"]
+        corner = blackboard["corner"]
+        x, y = blackboard["target_tile"]
+
+        while corner < len(path) and path[corner] == (x, y):
+            corner += 1
+        blackboard["corner"] = corner
 
-        add_tile = lambda t: self._path.append(util.tile_to_pixel(t))
+        if corner == len(path):
+            return None
 
-        for i in xrange(len(path) - 1):
-            t0 = path[i]
-            t1 = path[i + 1]
+        # move along the biggest difference first
+        dx = path[corner][0] - x
+        dy = path[corner][1] - y
+        if abs(dx) >= abs(dy):
+            return x + (1 if dx > 0 else -1), y
+        else:
+            return x, y + (1 if dy > 0 else -1)
 
-            # adjacent
-            if util.find_difference(t0, t1, True) == [0, 1]:
-                add_tile(t0)
+    def process(self, tree):
+        state = HumanWalkToLocation.process(self, tree)
 
-            # interpolate between
-            else:
-                difference = util.find_difference(t1, t0, False)
+        # next
+        if state != Task.RUNNING:
+            blackboard = tree.blackboard
+            tile = self._next_tile(blackboard)
+
+            # all done
+            if tile is None:
+                tree.controller.halt()
+                return Task.SUCCESS
 
-                # start with biggest first
-                for axis in (0, 1) if abs(difference[0]) >= abs(difference[1]) else (1, 0):
-                    diff = t1[axis] - t0[axis]
+            blackboard["target_tile"] = tile
+            blackboard["target"] = util.tile_to_pixel(tile)
 
-                    if diff == 0:
-                        continue
+        return Task.RUNNING
+
+
+class HumanFollowFlowField(HumanWalkToLocation):
+    """
+    Walks to the tile in the "destination" entry of the blackboard one tile at a time, following the shared flow field
+    towards it
+    """
+
+    def init(self, tree):
+        blackboard = tree.blackboard
+        blackboard.pop("target", None)
+        blackboard["field"] = None
+
+        # the destination has no direction of its own, so would be stepped off and back onto
+        blackboard["arrived"] = tree.entity.get_current_tile() == blackboard["destination"]
+        if blackboard["arrived"]:
+            return
+
+        blackboard["field"] = tree.entity.world.nav_graph.get_flow_field(blackboard["destination"])
+        if not self._next_target(tree):
+            blackboard["field"] = None
+
+    @staticmethod
+    def _next_target(tree):
+        """
+        Sets the next tile along the flow field as the target
+        :return: False if the destination can't be reached from the current tile, otherwise True
+        """
+        tile = tree.entity.get_current_tile()
+        direction = tree.blackboard["field"].get_direction(tile)
+        if direction is None:
+            return False
 
-                    delta = diff / abs(diff)
-                    for j in xrange(abs(diff)):
-                        if axis == 0:
-                            next_tile = t0[0] + delta * j, t0[1]
-                        else:
-                            next_tile = t0[0], t0[1] + delta * j
-                        add_tile(next_tile)
+        tree.blackboard["target"] = util.tile_to_pixel(util.add_direction(tile, direction))
+        return True
 
-        if self._path[len(self._path) - 1] != path[len(path) - 1]:
-            add_tile(path[len(path) - 1])
+    def process(self, tree):
+        blackboard = tree.blackboard
+        if blackboard["arrived"]:
+            return Task.SUCCESS
 
-        self.child.set_target_tile(self._path[0])
+        if blackboard["field"] is None:
+            return Task.FAILURE
 
-    def process(self):
-        state = self.child.process()
+        state = HumanWalkToLocation.process(self, tree)
 
         # next
         if state != Task.RUNNING:
-            self._index += 1
-
-            # all done
-            if self._index >= len(self._path):
-                self.child.controller.halt()
+            if tree.entity.get_current_tile() == blackboard["destination"]:
+                tree.controller.halt()
                 return Task.SUCCESS
 
-            next_goal = self._path[self._index]
-            self.child.set_target_tile(next_goal)
+            # the graph has changed since the field was calculated
+            nav_graph = tree.entity.world.nav_graph
+            if blackboard["field"].version != nav_graph.version:
+                blackboard["field"] = nav_graph.get_flow_field(blackboard["destination"])
+
+            if not self._next_target(tree):
+                blackboard["field"] = None
+                tree.controller.halt()
+                return Task.FAILURE
 
         return Task.RUNNING
 
 
-class HumanRoam(Decorator):
-    def __init__(self, controller):
-        Decorator.__init__(self, None)
-        self._controller = controller
+class HumanRoam(HumanFollowPath):
+    """
+    Walks to a random node in the navigation graph
+    """
 
-    def init(self):
-        current_tile = self._controller.entity.get_current_tile()
+    def init(self, tree):
+        the_entity = tree.entity
+        current_tile = the_entity.get_current_tile()
         path = None
-        goal = None
 
         while path is None:
-            goal = random.choice(self._controller.entity.world.nav_graph.graph.keys())
+            goal = random.choice(the_entity.world.nav_graph.graph.keys())
             if goal == current_tile:
                 continue
 
-            path = self._controller.entity.world.nav_graph.find_walking_path(current_tile, goal)
-
-        self.child = HumanFollowPath(self._controller,
-                                     path)
+            path = the_entity.world.nav_graph.find_walking_path(current_tile, goal)
 
-    def process(self):
-        return self.child.process()
+        tree.blackboard["path"] = path
+        HumanFollowPath.init(self, tree)
 
 
-class EntityWander(EntityLeafTask):
+class EntityWander(Action):
     """
     Wanders/turns randomly, turning away from walls if encountered
     """
 
-    def __init__(self, entity_controller, move=True):
-        EntityLeafTask.__init__(self, entity_controller)
-        self.ticker = util.TimeTicker((0.1, 0.8))
+    # seconds between decisions, during which the tree sleeps
+    DECISION_INTERVAL = (0.1, 0.8)
+
+    def __init__(self, move=True):
+        Action.__init__(self)
         self.move = move
 
-    def init(self):
-        self.ticker.reset()
+    def init(self, tree):
+        tree.sleep(EntityWander.DECISION_INTERVAL)
 
-    def process(self):
+    def process(self, tree):
         # todo: is forever running
 
-        if self.ticker.tick():
-            if random.random() < 0.4:
-                direction = constants.Direction.random()
+        if random.random() < 0.4:
+            direction = constants.Direction.random()
 
-                if self.move:
-                    if self.entity.world.is_point_blocked(self.entity.get_current_tile(), direction):
-                        direction = constants.Direction.opposite(direction)
-                    self.controller.move_in_direction(direction)
+            if self.move:
+                if tree.entity.world.is_point_blocked(tree.entity.get_current_tile(), direction):
+                    direction = constants.Direction.opposite(direction)
+                tree.controller.move_in_direction(direction)
 
-                # simply face another direction
-                else:
-                    self.controller.entity.turn(direction)
+            # simply face another direction
             else:
-                self.controller.halt()
+                tree.entity.turn(direction)
+        else:
+            tree.controller.halt()
 
+        tree.sleep(EntityWander.DECISION_INTERVAL)
         return Task.RUNNING
 
 
-class NoObstacle(EntityLeafTask):
+class NoObstacle(Action):
     """
     Checks for a solid block in front of the entity
     """
 
-    def process(self):
-        return self._bool_to_condition(not self.entity.world.is_direction_blocked(self.entity.get_current_tile(), self.entity.direction))
+    def process(self, tree):
+        the_entity = tree.entity
+        return self._bool_to_condition(not the_entity.world.is_direction_blocked(the_entity.get_current_tile(), the_entity.direction))
 
 
-class DebugPrint(LeafTask):
+class DebugPrint(Action):
     """
     Prints a debug message to the console, then immediately succeeds
     """
 
     def __init__(self, msg):
-        LeafTask.__init__(self)
+        Action.__init__(self)
         self.msg = msg
 
-    def process(self):
+    def process(self, tree):
         print(self.msg)
         return Task.SUCCESS
+
+
+# shared tree definitions
+WANDER_TREE = CompiledTree(Repeater(EntityWander(move=False)))
+ROAM_TREE = CompiledTree(Repeater(HumanRoam()))
+FOLLOW_PATH_TREE = CompiledTree(HumanFollowPath())
+FOLLOW_FLOW_FIELD_TREE = CompiledTree(HumanFollowFlowField())
@@ -13,21 +13,88 @@ VEHICLE_DIMENSION = (64, 32)
 
 def clone(sheet):
     """
-    Clones the given spritesheet (and all frame surfaces of all sequences)
+    Clones the given spritesheet, copying all frames of all sequences into a new atlas of its own
     """
 
-    sheet_copy = copy.deepcopy(sheet)
-    for seqi in xrange(len(sheet.sprites)):
-        sequence = sheet.sprites[seqi]
-        for spritei in xrange(len(sequence)):
-            sprite = sequence[spritei]
-            sprite_copy = sprite.copy()
-            sheet_copy.sprites[seqi][spritei] = sprite_copy
-
-    sheet_copy.sheet = sheet.sheet.copy()
+    sheet_copy = copy.copy(sheet)
+    sheet_copy.atlas = SpriteAtlas.fit(sheet.sprites)
+    sheet_copy.sprites = sheet_copy.atlas.add_sequences(sheet.sprites)
     return sheet_copy
 
 
+class SpriteAtlas:
+    """
+    A surface that sprite frames are packed into, row by row, so that many frames can be drawn from few surfaces.
+    A frame is a tuple of (atlas surface, area)
+    """
+
+    SIZE = (512, 512)
+    SHARED = []
+
+    def __init__(self, size=SIZE):
+        self.surface = pygame.Surface(size, pygame.SRCALPHA, 32).convert_alpha()
+        self.surface.fill((0, 0, 0, 0))
+        self._x = self._y = self._row_height = 0
+
+    def add(self, surface, area=None):
+        """
+        Copies the given surface, or the given area of it, into the atlas
+
+        :return: The new frame, or None if there is no room left
+        """
+        area = pygame.Rect(area if area else surface.get_rect())
+        if self._x + area.width > self.surface.get_width():
+            self.next_row()
+
+        if self._y + area.height > self.surface.get_height() or area.width > self.surface.get_width():
+            return None
+
+        frame_area = pygame.Rect((self._x, self._y), area.size)
+        self.surface.blit(surface, frame_area, area)
+        self._x += area.width
+        self._row_height = max(self._row_height, area.height)
+        return self.surface, frame_area
+
+    def add_sequences(self, sequences):
+        """
+        Copies each sequence of frames onto its own row
+
+        :return: The new sequences of frames
+        """
+        new_sequences = []
+        for sequence in sequences:
+            new_sequences.append([self.add(*frame) for frame in sequence])
+            self.next_row()
+        return new_sequences
+
+    def next_row(self):
+        self._x = 0
+        self._y += self._row_height
+        self._row_height = 0
+
+    @staticmethod
+    def fit(sequences):
+        """
+        :return: A new atlas just big enough for the given sequences of frames, see add_sequences
+        """
+        width = max(sum(area.width for _, area in sequence) for sequence in sequences)
+        height = sum(max(area.height for _, area in sequence) for sequence in sequences)
+        return SpriteAtlas((width, height))
+
+    @staticmethod
+    def add_shared(surface, area=None):
+        """
+        Copies the given surface into the shared atlases, creating a new one if they are full
+
+        :return: The new frame
+        """
+        frame = SpriteAtlas.SHARED[-1].add(surface, area) if SpriteAtlas.SHARED else None
+        if not frame:
+            SpriteAtlas.SHARED.append(SpriteAtlas())
+            frame = SpriteAtlas.SHARED[-1].add(surface, area)
+        return frame
+
+
 class BaseSpriteSheet:
     """
     Base sprite sheet that contains animation sequences
@@ -45,6 +112,7 @@ class BaseSpriteSheet:
         self.nickname = path.split(os.sep)[-1][:-4] if not nickname else nickname
         self.sprites = [[] for _ in xrange(height)]
         self.sheet = pygame.image.load(path).convert_alpha()
+        self.atlas = None
         self.type = animation_type
         self.length = length
 
@@ -67,9 +135,7 @@ class BaseSpriteSheet:
 
         for y in xrange(start_y, height):
             for _ in xrange(self.length):
-                sprite = pygame.Surface(sprite_dimensions, 0, self.sheet).convert_alpha()
-                sprite.blit(self.sheet, (0, 0), rect.as_tuple())
-                self.sprites[y].append(sprite)
+                self.sprites[y].append(SpriteAtlas.add_shared(self.sheet, rect.as_tuple()))
                 rect.x += sprite_dimensions[0]
 
             rows += 1
@@ -78,25 +144,15 @@ class BaseSpriteSheet:
             rect.y += sprite_dimensions[1]
             rect.x = 0
 
-    def get_sequence(self, animator, index, starting_index=0):
+    def get_frame(self, index, progress):
         """
-        :param animator: The animator
         :param index: Animation sequence index
-        :param starting_index: Starting frame in sequence
-        :return: A generator function that loops the animation
+        :param progress: Number of frames into the looping animation
+        :return: The sprite and its frame index in the sequence
         """
         sequence = self.sprites[index]
-        i = starting_index
-        delta = 0
-        seq_len = len(sequence)
-        while True:
-            if i == seq_len:
-                i = 0
-            yield sequence[i], i
-            delta += constants.DELTA
-            if delta >= animator.animation_step:
-                delta = 0
-                i += 1
+        i = int(progress) % len(sequence)
+        return sequence[i], i
 
     def _rearrange_directional_sprites(self):
         """
@@ -157,9 +213,12 @@ class HumanSpriteSheet(BaseSpriteSheet):
             return int(surface.get_width() * scale), int(surface.get_height() * scale)
 
         blue = (51, 148, 213)
-        self.small_freeze_frames = [pygame.transform.scale(s[0], scale_dimensions(s[0], constants.PASSENGER_SCALE)) for s in self.sprites]
-        for s in self.small_freeze_frames:
-            util.blend_pixels(s, lambda p: p[3] > 0, lambda p: util.mix_colours(p, blue))
+        self.small_freeze_frames = []
+        for atlas, area in (s[0] for s in self.sprites):
+            frame = atlas.subsurface(area)
+            small = pygame.transform.scale(frame, scale_dimensions(frame, constants.PASSENGER_SCALE))
+            util.blend_pixels(small, lambda p: p[3] > 0, lambda p: util.mix_colours(p, blue))
+            self.small_freeze_frames.append(SpriteAtlas.add_shared(small))
 
 
 class VehicleSpriteSheet(BaseSpriteSheet):
@@ -182,30 +241,34 @@ class VehicleSpriteSheet(BaseSpriteSheet):
 
     def set_colour(self, colour):
         """
-        Sets the car's colour to the given colour
+        Sets the car's colour to the given colour, which should only be done to a clone with its own atlas
         """
-        for seq in self.sprites:
-            for sprite in seq:
-                util.blend_pixels(sprite, lambda p: all(map(lambda p: p == 127, p[:3])), lambda p: util.mix_colours([p[3]] * 3, colour))
+        util.blend_pixels(self.atlas.surface, lambda p: all(map(lambda p: p == 127, p[:3])), lambda p: util.mix_colours([p[3]] * 3, colour))
 
 
 class HumanAnimator:
     """
-    Handles drawing and animation of an entity
+    Handles drawing and animation of an entity.
+    The current frame is worked out from the global clock, so nothing is updated while the entity is off screen
     """
 
+    # pixels moved per frame of animation
+    PIXELS_PER_FRAME = 18.0
+
     def __init__(self, entity, spritesheet):
         self.entity = entity
         self.spritesheet = spritesheet
 
-        self.animation_step = 0
+        # progress through the animation = time * frame_rate + phase
+        self.frame_rate = 0
+        self.phase = 0
         self.sequence_index = 0
-        self.walk_gen = None
         self.current_frame = 0
         self.turn(0)
 
         self.was_moving = self.entity.is_moving()
         self.last_speed = self._get_speed()
+        self.frame_rate = self.last_speed / HumanAnimator.PIXELS_PER_FRAME
 
     def _get_speed(self):
         """
@@ -216,6 +279,16 @@ class HumanAnimator:
             return abs(v[0])
         return abs(v[1])
 
+    @staticmethod
+    def _get_time():
+        return constants.TIMERS.time
+
+    def _get_progress(self):
+        """
+        :return: Number of frames into the current animation sequence
+        """
+        return self._get_time() * self.frame_rate + self.phase
+
     def tick(self):
         """
         Advances animation and draws to screen
@@ -227,19 +300,22 @@ class HumanAnimator:
         """
         :return: The next sprite in the current animation sequence
         """
+        speed = self._get_speed()
+        if speed != self.last_speed:
+            # keep the same progress at the new rate
+            progress = self._get_progress()
+            self.last_speed = speed
+            self.frame_rate = speed / HumanAnimator.PIXELS_PER_FRAME
+            self.phase = progress - self._get_time() * self.frame_rate
+
         moving = self.entity.is_moving()
         if moving:
             if not self.was_moving:
                 self.turn(self.sequence_index, starting_index=1)
-            sprite, self.current_frame = self.walk_gen.next()
+            sprite, self.current_frame = self.spritesheet.get_frame(self.sequence_index, self._get_progress())
         else:
             sprite = self.spritesheet.sprites[self.sequence_index][0]
 
-        speed = self._get_speed()
-        if speed != self.last_speed:
-            self.last_speed = speed
-            self.animation_step = 18.0 / speed if speed else 0
-
         self.was_moving = moving
         return sprite
 
@@ -247,17 +323,18 @@ class HumanAnimator:
         """
         Renders the given sprite to the screen
         """
-        constants.SCREEN.draw_sprite(sprite, self.entity.rect)
+        atlas, area = sprite
+        constants.SCREEN.draw_sprite(atlas, self.entity.rect, area)
 
     def turn(self, index, starting_index=0):
         """
-        Updates animation generator
+        Switches animation sequence
 
         :param index: Sequence index
         :param starting_index: Starting frame in sequence
         """
         self.sequence_index = index
-        self.walk_gen = self.spritesheet.get_sequence(self, index, starting_index)
+        self.phase = starting_index - self._get_time() * self.frame_rate
         # self.current_frame = starting_index
 
     def halt(self):
@@ -0,0 +1,401 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+
+import ai
+import citygen
+import constants
+import entity
+import profiler
+import state
+import util
+import world as world_module
+from world import BlockType
+
+# relative change in a metric that counts as a regression, see compare
+TOLERANCE = 0.1
+
+
+def setup():
+    """
+    Initialises everything needed to create worlds, without starting the game
+    """
+    pygame.init()
+    constants.LOGGER = constants.Logger()
+    constants.ConfigLoader.load_config()
+    constants.LOGGER.set_level("WARNING")
+    constants.TIMERS = util.TimerWheel()
+    constants.set_window_size((1, 1))
+    constants.SCREEN.create_window()
+
+
+def timed(func, *args):
+    """
+    :return: The result of calling the given function, and how long it took in milliseconds
+    """
+    start = time.time()
+    result = func(*args)
+    return result, (time.time() - start) * 1000
+
+
+def build_grid_city(blocks, spacing=16, road_width=4):
+    """
+    :param blocks: Number of city blocks along each side
+    :param spacing: Tiles between the start of each road
+    :return: A new world of blocks x blocks city blocks of pavement, separated by roads of the given width,
+             and a position on a road to start road discovery from
+    """
+    size = blocks * spacing + road_width
+    world = world_module.World(size, size)
+
+    for y in xrange(size):
+        road_row = y % spacing < road_width
+        for x in xrange(size):
+            road = road_row or x % spacing < road_width
+            world.set_block_type(x, y, BlockType.ROAD if road else BlockType.PAVEMENT)
+
+    return world, (0, spacing / 2)
+
+
+def benchmark_roads(blocks, routes=200):
+    world, road_start = build_grid_city(blocks)
+    roadmap = world.roadmap
+
+    _, discovery_time = timed(roadmap.begin_discovery, road_start)
+    _, graph_time = timed(roadmap.build_graph)
+
+    random.seed(blocks)
+    nodes = roadmap.nodes.values()
+    pairs = [(random.choice(nodes), random.choice(nodes)) for _ in xrange(routes)]
+
+    def route_all():
+        for src, dest in pairs:
+            roadmap.find_route(src, dest)
+
+    _, cold_time = timed(route_all)
+    _, warm_time = timed(route_all)
+
+    print("roads %3dx%-3d %4d roads %5d nodes | discovery %7.1fms graph %7.1fms | %d routes cold %7.1fms warm %5.1fms" %
+          (world.tile_width, world.tile_height, len(roadmap.roads), len(roadmap.nodes),
+           discovery_time, graph_time, routes, cold_time, warm_time))
+
+    world_module.WORLDS.remove(world)
+
+
+def benchmark_engines(count=1000, frames=600, switch_every=30):
+    """
+    Times creating the given number of vehicle engines, then running them while they take turns to switch between
+    braking and accelerating
+    """
+    random.seed(count)
+
+    def create_all():
+        return [ai._Engine(constants.Speed.VEHICLE_MAX * random.uniform(0.75, 1), accelerate_rate=7, brake_rate=5)
+                for _ in xrange(count)]
+
+    engines, create_time = timed(create_all)
+    offsets = [random.randrange(switch_every * 2) for _ in xrange(count)]
+
+    def run_all():
+        constants.DELTA = 1 / 60.
+        for frame in xrange(frames):
+            for engine, offset in zip(engines, offsets):
+                braking = ((frame + offset) / switch_every) % 2
+                engine.get_speed(ai.VehicleController.BRAKING if braking else ai.VehicleController.ACCELERATING)
+
+    _, run_time = timed(run_all)
+
+    print("engines %d | create %7.1fms | %d frames %7.1fms (%.3fms per frame)" %
+          (count, create_time, frames, run_time, run_time / frames))
+
+
+def benchmark_traffic(blocks, cars, frames=600):
+    """
+    Times simulating the given number of cars driving around a grid city, without vehicle entities
+    """
+    world, road_start = build_grid_city(blocks)
+    world.roadmap.begin_discovery(road_start)
+    world.roadmap.build_graph()
+
+    random.seed(blocks)
+    spawned = sum(1 for _ in xrange(cars) if world.traffic.spawn())
+
+    def run_all():
+        constants.DELTA = 1 / 60.
+        for _ in xrange(frames):
+            world.traffic.tick(False)
+
+    _, run_time = timed(run_all)
+
+    print("traffic %3dx%-3d %4d cars | %d frames %7.1fms (%.3fms per frame) | %s" %
+          (world.tile_width, world.tile_height, spawned, frames, run_time, run_time / frames,
+           world.traffic.get_debug_lines()[0]))
+
+    world_module.WORLDS.remove(world)
+
+
+def load_grid_city(blocks, spacing=16, road_width=4):
+    """
+    :return: A new grid city, see build_grid_city, with its roads discovered and human and vehicle spawns, loaded as
+             if from a file
+    """
+    world, road_start = build_grid_city(blocks, spacing, road_width)
+
+    tile = constants.TILE_SIZE
+    block_size = (spacing - road_width) * tile
+    world.add_spawn(constants.EntityType.HUMAN, road_width * tile, road_width * tile, "S", block_size, block_size)
+    world.add_spawn(constants.EntityType.VEHICLE, road_start[0] * tile, road_start[1] * tile, "E")
+
+    world.roadmap.begin_discovery(road_start)
+    world.post_load()
+    return world
+
+
+def percentiles(values):
+    """
+    :return: Dict of the median, 95th and 99th percentiles and maximum of the given values
+    """
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def percentile(fraction):
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+
+    return {"p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99), "max": values[-1]}
+
+
+def get_peak_memory():
+    """
+    :return: The peak memory usage of this process so far in MB, or None if it can't be found on this platform
+    """
+    if not resource:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def benchmark_pathfinding(world, queries):
+    """
+    :return: The times of walking paths between the given number of random pairs of navigation graph nodes, in ms
+    """
+    nodes = world.nav_graph.graph.keys()
+    pairs = [(random.choice(nodes), random.choice(nodes)) for _ in xrange(queries)]
+
+    times = []
+    for src, dest in pairs:
+        _, path_time = timed(world.nav_graph.find_walking_path, src, dest)
+        times.append(path_time)
+    return times
+
+
+def run_scenario(name, load_world, humans, vehicles, interiors, frames=600, path_queries=200):
+    """
+    Loads a world, populates it, then simulates it headlessly for the given number of frames
+
+    :param load_world: Function that returns the loaded world
+    :param interiors: Number of buildings to put a human inside, so their interiors are simulated too
+    :return: Dict of results
+    """
+    random.seed(name)
+    worlds_before = list(world_module.WORLDS)
+    world, load_time = timed(load_world)
+
+    # populate
+    for _ in xrange(humans):
+        e = entity.create_entity(world, constants.EntityType.HUMAN)
+        e.controller.roam()
+
+    spawned = 0
+    for _ in xrange(vehicles):
+        vehicle = entity.create_entity(world, constants.EntityType.VEHICLE)
+        if not world.traffic.spawn(vehicle):
+            vehicle.kill()
+            break
+        spawned += 1
+
+    buildings = world.buildings[:interiors]
+    for building in buildings:
+        entity.create_entity(building.get_inside(), constants.EntityType.HUMAN)
+
+    def simulate():
+        constants.DELTA = 1 / 60.
+        for _ in xrange(frames):
+            profiler.next_frame()
+            constants.TIMERS.advance(constants.DELTA)
+            with profiler.scope("state"):
+                constants.STATEMANAGER.ai_scheduler.begin_frame()
+                for w in tuple(world_module.WORLDS):
+                    w.tick(render=False)
+        profiler.next_frame()
+
+    profiler.set_enabled(True)
+    _, run_time = timed(simulate)
+
+    # only the most recent frames are kept, which leaves out any warming up
+    subsystems = {}
+    for path, calls, p50, p95, max_ms in profiler.get_stats():
+        subsystems[path] = {"calls": calls, "p50": p50, "p95": p95, "max": max_ms}
+    profiler.set_enabled(False)
+
+    path_times = benchmark_pathfinding(world, path_queries)
+
+    result = {
+        "world": [world.tile_width, world.tile_height],
+        "humans": humans,
+        "vehicles": spawned,
+        "interiors": len(buildings),
+        "frames": frames,
+        "load_ms": load_time,
+        "ticks_per_second": frames / (run_time / 1000),
+        "subsystems_ms": subsystems,
+        "pathfinding_ms": percentiles(path_times),
+        "peak_memory_mb": get_peak_memory()
+    }
+
+    print("%-16s %4dx%-4d %4d humans %4d vehicles %2d interiors | load %7.1fms | %6.1f ticks/s | path p95 %6.2fms | "
+          "peak memory %s" % (name, world.tile_width, world.tile_height, humans, spawned, len(buildings), load_time,
+                              result["ticks_per_second"], result["pathfinding_ms"].get("p95", 0),
+                              "%.1fMB" % result["peak_memory_mb"] if resource else "unknown"))
+
+    world_module.WORLDS[:] = worlds_before
+    return result
+
+
+def run_scenario_process(name, load_world, humans, vehicles, interiors, frames=600):
+    """
+    Runs a scenario in a child process, so that its peak memory isn't that of any scenario run before it.
+    Runs it in this process instead where peak memory can't be found anyway
+
+    :return: Dict of results, see run_scenario
+    """
+    if not resource:
+        return run_scenario(name, load_world, humans, vehicles, interiors, frames)
+
+    results = multiprocessing.Queue()
+
+    def run():
+        result = None
+        try:
+            result = run_scenario(name, load_world, humans, vehicles, interiors, frames)
+        finally:
+            results.put(result)
+
+    process = multiprocessing.Process(target=run)
+    process.start()
+    result = results.get()
+    process.join()
+
+    if result is None:
+        raise StandardError("Scenario %s failed" % name)
+    return result
+
+
+# (name, function to load world, humans, vehicles, interiors)
+SCENARIOS = [
+    ("world.tmx", lambda: world_module.World.load_tmx("world.tmx"), 20, 20, 2),
+    ("grid-8", lambda: load_grid_city(8), 50, 50, 0),
+    ("grid-16", lambda: load_grid_city(16), 100, 100, 0),
+    ("city-256", lambda: citygen.CityGenerator(256, 256, seed=1).create_world(), 200, 200, 4),
+    ("city-512", lambda: citygen.CityGenerator(512, 512, seed=1).create_world(), 250, 250, 8)
+]
+
+
+def run_scenarios(names=None, frames=600):
+    """
+    :param names: Names of the scenarios to run, or None for all
+    :return: Dict of scenario name: results
+    """
+    entity.EntityLoader.load_all()
+    constants.STATEMANAGER = state.StateManager()
+
+    results = {}
+    for name, load_world, humans, vehicles, interiors in SCENARIOS:
+        if names is None or name in names:
+            results[name] = run_scenario_process(name, load_world, humans, vehicles, interiors, frames)
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Prints the change in each headline metric of every scenario since the given baseline
+
+    :return: List of (scenario name, metric) that got worse by more than the given tolerance
+    """
+    # metric: function to get it from results, and whether or not higher is better
+    metrics = {
+        "ticks/s": (lambda r: r["ticks_per_second"], True),
+        "load ms": (lambda r: r["load_ms"], False),
+        "path p95 ms": (lambda r: r["pathfinding_ms"].get("p95"), False),
+        "peak memory MB": (lambda r: r["peak_memory_mb"], False)
+    }
+
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+
+        for metric, (get, higher_is_better) in sorted(metrics.items()):
+            new, old = get(results[name]), get(baseline[name])
+            if not new or not old:
+                continue
+
+            change = float(new - old) / old
+            worse = -change if higher_is_better else change
+            regressed = worse > tolerance
+            if regressed:
+                regressions.append((name, metric))
+
+            print("%-16s %-16s %10.2f -> %10.2f %+6.1f%%%s" %
+                  (name, metric, old, new, change * 100, " REGRESSION" if regressed else ""))
+
+    return regressions
+
+
+def run_micro_benchmarks():
+    benchmark_engines()
+
+    for city_blocks in (2, 4, 8, 16, 32):
+        benchmark_roads(city_blocks)
+
+    for city_blocks, car_count in ((4, 50), (8, 300), (16, 1000)):
+        benchmark_traffic(city_blocks, car_count)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs benchmarks headlessly")
+    parser.add_argument("--micro", action="store_true", help="run the benchmarks of single subsystems instead of scenarios")
+    parser.add_argument("--scenario", action="append", help="name of a scenario to run, defaults to all")
+    parser.add_argument("--frames", type=int, default=600, help="frames to simulate in each scenario")
+    parser.add_argument("--output", help="file to write the scenario results to, as JSON")
+    parser.add_argument("--baseline", help="results file to compare the scenario results to")
+    args = parser.parse_args()
+
+    setup()
+
+    if args.micro:
+        run_micro_benchmarks()
+    else:
+        scenario_results = run_scenarios(args.scenario, args.frames)
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"scenarios": scenario_results}, f, indent=2, sort_keys=True)
+
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline_results = json.load(f)["scenarios"]
+
+            if compare(scenario_results, baseline_results):
+                raise SystemExit(1)
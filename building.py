@@ -15,16 +15,14 @@ class Building:
         self.world = world
         self.rect = util.Rect(x, y, width, height)
         self.doors = []
-        self.windows = {}
-        self.inside = world_module.BuildingWorld.load_tmx(name + ".tmx")
+
+        # the interior is only created while someone is inside
+        self.template = world_module.InteriorTemplate.get(name + ".tmx")
+        self.inside = None
 
         # find entrance mats inside
-        for bx, by, b in self.inside.iterate_blocks():
-            if b.blocktype == world_module.BlockType.ENTRANCE_MAT:
-                b.building = self
-                pixel_pos = util.tile_to_pixel((bx + 1, by))
-                self.doors.append([pixel_pos])
-                self.inside.add_spawn(constants.EntityType.HUMAN, *pixel_pos)
+        for bx, by in self.template.entrances:
+            self.doors.append([util.tile_to_pixel((bx + 1, by))])
 
         # find doors in terrain layer
         d = 0
@@ -38,12 +36,33 @@ class Building:
         if d != len(self.doors):
             raise StandardError("Mismatching entrances: %d doors but %d exit mats" % (d, len(self.doors)))
 
-        # find windows in overterrain layer
+        # find windows in overterrain layer, whose statuses are kept in the same order as their positions
+        self.window_positions = []
+        self.window_states = bytearray()
+        self._window_indices = {}
         for bx, by, b in self.iterate_blocks(layer="overterrain"):
             if b.blocktype == world_module.BlockType.BUILDING_WINDOW_OFF or b.blocktype == world_module.BlockType.BUILDING_WINDOW_ON:
-                # power = b.blocktype == world_module.BlockType.BUILDING_WINDOW_ON
-                power = random.random() < 0.5
-                self.set_window((bx, by), power)
+                self._window_indices[(bx, by)] = len(self.window_positions)
+                self.window_positions.append((bx, by))
+                self.window_states.append(b.blocktype == world_module.BlockType.BUILDING_WINDOW_ON)
+
+        power = bytearray(random.random() < 0.5 for _ in xrange(len(self.window_positions)))
+        self.world.set_blocks(self.set_windows(power), layer="overterrain")
+
+    def get_inside(self):
+        """
+        :return: The interior world, created from the template if nobody is inside
+        """
+        if not self.inside:
+            self.inside = self.template.instantiate(self)
+        return self.inside
+
+    def release_inside(self):
+        """
+        Discards the interior world, which should be empty
+        """
+        world_module.WORLDS.remove(self.inside)
+        self.inside = None
 
     def iterate_blocks(self, layer="terrain"):
         """
@@ -72,10 +91,11 @@ class Building:
         Places the given human in the building.
         If they are already inside, nothing happens
         """
-        if human not in self.inside.entities:
+        inside = self.get_inside()
+        if human not in inside.entities:
             human.visible = False
 
-            self.inside.spawn_entity_at_spawn(human, self._closest_door_index(human.transform, True), vary=False)
+            inside.spawn_entity_at_spawn(human, self._closest_door_index(human.transform, True), vary=False)
             human.turn(entity.constants.Direction.NORTH)
 
             event.call_human_building_movement(human, self, True)
@@ -98,16 +118,48 @@ class Building:
         except ValueError:
             pass
 
+    def _window_block(self, index):
+        """
+        :return: The block change for the window at the given index, see BaseWorld.set_blocks
+        """
+        x, y = self.window_positions[index]
+        new_blocktype = world_module.BlockType.BUILDING_WINDOW_ON if self.window_states[index] else world_module.BlockType.BUILDING_WINDOW_OFF
+        return x, y, new_blocktype
+
     def set_window(self, pos, new_status):  # todo state*, surely?
         """
         Turns on/off the window at the given position
         """
-        self.windows[pos] = new_status
-        new_blocktype = world_module.BlockType.BUILDING_WINDOW_ON if new_status else world_module.BlockType.BUILDING_WINDOW_OFF
-        self.world.set_block_type(pos[0], pos[1], new_blocktype, layer="overterrain")
+        index = self._window_indices[pos]
+        self.window_states[index] = new_status
+        self.world.set_blocks([self._window_block(index)], layer="overterrain")
 
     def get_window(self, pos):
         """
         :return: Whether or not the window at the given position is switched on
         """
-        return self.windows[pos]
+        return bool(self.window_states[self._window_indices[pos]])
+
+    def set_windows(self, new_states):
+        """
+        Turns on/off every window at once, without updating the world
+
+        :param new_states: The new status of each window, in the same order as window_positions
+        :return: The block changes for the windows that changed, to be applied with BaseWorld.set_blocks
+        """
+        old_states = self.window_states
+        self.window_states = bytearray(new_states)
+        return [self._window_block(i) for i in xrange(len(old_states)) if old_states[i] != self.window_states[i]]
+
+    def toggle_random_window(self):
+        """
+        Switches a random window, without updating the world
+
+        :return: The block change for the window, to be applied with BaseWorld.set_blocks, or None if there are no windows
+        """
+        if not self.window_positions:
+            return None
+
+        index = random.randrange(len(self.window_positions))
+        self.window_states[index] ^= 1
+        return self._window_block(index)
@@ -0,0 +1,332 @@
+import argparse
+import random
+from xml.etree import ElementTree
+
+import constants
+from building import Building
+import util
+import world as world_module
+
+# template world filename: list of building stamps, see load_stamps
+_STAMPS = {}
+
+
+class BuildingStamp:
+    """
+    The tiles of a building in every layer, cut out of a world so that its doors and windows match its interior
+    """
+
+    def __init__(self, name, width, height, layers):
+        """
+        :param name: Interior world file, without extension
+        :param layers: Layer name: rows of tmx gids
+        """
+        self.name = name
+        self.width = width
+        self.height = height
+        self.layers = layers
+
+
+def load_stamps(filename):
+    """
+    :return: A stamp of every building zone in the given world file, which is only loaded the first time
+    """
+    stamps = _STAMPS.get(filename)
+    if stamps is not None:
+        return stamps
+
+    root = ElementTree.parse(util.search_for_file(filename, "res/world")).getroot()
+
+    layers = {}
+    for layer in root.iter("layer"):
+        data = layer.find("data").text.strip()
+        layers[layer.attrib["name"]] = [map(int, line.strip().rstrip(",").split(",")) for line in data.splitlines()]
+
+    stamps = []
+    tileset_res = constants.TILESET_RESOLUTION
+    for group in root.iter("objectgroup"):
+        if group.get("name") != "_buildings":
+            continue
+
+        for o in group:
+            x = int(o.attrib["x"]) / tileset_res
+            y = int(o.attrib["y"]) / tileset_res
+            width = int(o.attrib["width"]) / tileset_res
+            height = int(o.attrib["height"]) / tileset_res
+            name = o.find("properties/property[@name='building']").attrib["value"]
+
+            tiles = {}
+            for layer_name, rows in layers.items():
+                tiles[layer_name] = [row[x:x + width] for row in rows[y:y + height]]
+            stamps.append(BuildingStamp(name, width, height, tiles))
+
+    _STAMPS[filename] = stamps
+    return stamps
+
+
+class CityGenerator:
+    """
+    Generates a city of roads around blocks of pavement, each holding either a row of buildings or a park of grass and
+    trees. The same seed always generates the same city.
+    Tiles are kept as rows of indices into a palette of tmx gids, so even the largest cities fit in memory
+    """
+
+    LAYERS = ("underterrain", "terrain", "overterrain")
+    TEMPLATE_WORLD = "world.tmx"
+
+    ROAD_WIDTH = 4
+    PAVEMENT_WIDTH = 2
+    BUILDING_GAP = 2
+
+    # tiles between roads
+    MIN_BLOCK_SIZE = 20
+    MAX_BLOCK_SIZE = 36
+
+    PARK_CHANCE = 0.25
+    TREE_CHANCE = 0.06
+
+    def __init__(self, width, height, seed=None):
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self._random = random.Random(seed)
+
+        # index: gid, where 0 is empty
+        self.palette = [0]
+        self._palette_indices = {0: 0}
+
+        # layer name: rows of palette indices
+        self.layers = {}
+
+        # all in tiles
+        self.trees = []
+        self.buildings = []
+        self.spawns = []
+        self.road_starts = []
+
+        self._generate()
+
+    def _get_index(self, gid):
+        """
+        :return: The palette index of the given gid, which is added if it is not there yet
+        """
+        index = self._palette_indices.get(gid)
+        if index is None:
+            index = len(self.palette)
+            if index > 255:
+                raise StandardError("Too many tile types for the palette")
+
+            self.palette.append(gid)
+            self._palette_indices[gid] = index
+        return index
+
+    def _get_blocktype_index(self, blocktype):
+        return self._get_index(blocktype + 1)
+
+    def _split(self, length):
+        """
+        :return: List of (start, end) of the city blocks along a side of the given length, with a road before, between
+                 and after them
+        """
+        road = CityGenerator.ROAD_WIDTH
+        low, high = CityGenerator.MIN_BLOCK_SIZE, CityGenerator.MAX_BLOCK_SIZE
+
+        blocks = []
+        start = road
+        while True:
+            space = length - road - start
+            if space < low:
+                raise StandardError("A city of length %d is too small for a single block" % length)
+
+            # the rest is too small to split again
+            if space <= high or space - road - low < low:
+                blocks.append((start, length - road))
+                return blocks
+
+            size = self._random.randint(low, min(high, space - road - low))
+            blocks.append((start, start + size))
+            start += size + road
+
+    def _generate(self):
+        blocks_across = self._split(self.width)
+        blocks_down = self._split(self.height)
+
+        # roads around every block of pavement
+        road = self._get_blocktype_index(world_module.BlockType.ROAD)
+        pavement = self._get_blocktype_index(world_module.BlockType.PAVEMENT)
+        road_row = bytearray([road]) * self.width
+        block_row = bytearray(road_row)
+        for start, end in blocks_across:
+            block_row[start:end] = bytearray([pavement]) * (end - start)
+
+        terrain = [bytearray(road_row) for _ in xrange(self.height)]
+        for start, end in blocks_down:
+            for y in xrange(start, end):
+                terrain[y][:] = block_row
+
+        self.layers["terrain"] = terrain
+        for name in CityGenerator.LAYERS:
+            if name not in self.layers:
+                self.layers[name] = [bytearray(self.width) for _ in xrange(self.height)]
+
+        stamps = load_stamps(CityGenerator.TEMPLATE_WORLD)
+        border = CityGenerator.PAVEMENT_WIDTH
+        for y1, y2 in blocks_down:
+            for x1, x2 in blocks_across:
+                inner = (x1 + border, y1 + border, x2 - x1 - border * 2, y2 - y1 - border * 2)
+                fitting = [s for s in stamps if s.width <= inner[2] and s.height <= inner[3]]
+
+                if fitting and self._random.random() >= CityGenerator.PARK_CHANCE:
+                    self._add_buildings(inner, fitting)
+                else:
+                    self._add_park(inner)
+
+        # roads are discovered from the left edge of the first road, beside the first block
+        first_x, first_y = blocks_across[0], blocks_down[0]
+        road_start = (0, (first_y[0] + first_y[1]) / 2)
+        self.road_starts.append(road_start)
+
+        # spawns along the pavement at the top of the first block, and on the first road
+        self.spawns.append((constants.EntityType.HUMAN, first_x[0], first_y[0], first_x[1] - first_x[0], border, "R"))
+        self.spawns.append((constants.EntityType.VEHICLE, road_start[0], road_start[1], CityGenerator.ROAD_WIDTH, 1, "S"))
+
+    def _add_buildings(self, inner, stamps):
+        """
+        Adds a row of random buildings along the top of the given area, with their doors facing the pavement below
+
+        :param inner: (x, y, width, height) in tiles
+        """
+        x, y, width, _ = inner
+        while True:
+            fitting = [s for s in stamps if x + s.width <= inner[0] + width]
+            if not fitting:
+                break
+
+            stamp = self._random.choice(fitting)
+            for name, rows in stamp.layers.items():
+                layer = self.layers[name]
+                for i, row in enumerate(rows):
+                    layer[y + i][x:x + stamp.width] = bytearray(self._get_index(gid) for gid in row)
+
+            self.buildings.append((x, y, stamp.width, stamp.height, stamp.name))
+            x += stamp.width + CityGenerator.BUILDING_GAP
+
+    def _add_park(self, inner):
+        """
+        Fills the given area with grass, with trees dotted around
+
+        :param inner: (x, y, width, height) in tiles
+        """
+        x1, y1, width, height = inner
+        grass = self._get_blocktype_index(world_module.BlockType.GRASS)
+        terrain = self.layers["terrain"]
+        for y in xrange(y1, y1 + height):
+            terrain[y][x1:x1 + width] = bytearray([grass]) * width
+
+            for x in xrange(x1, x1 + width):
+                if self._random.random() < CityGenerator.TREE_CHANCE:
+                    self.trees.append((x, y))
+
+    def _get_block_ids(self):
+        """
+        :return: The block id of each palette index, as loaded from a tmx file
+        """
+        return [gid - 1 if gid else 0 for gid in self.palette]
+
+    def create_world(self):
+        """
+        :return: A new world of the city, loaded as if it were read from a tmx file
+        """
+        world = world_module.World(self.width, self.height)
+        block_ids = self._get_block_ids()
+
+        for name in CityGenerator.LAYERS:
+            for y, row in enumerate(self.layers[name]):
+                for x, index in enumerate(row):
+                    world.set_tmx_block(x, y, block_ids[index], name)
+
+        tree = world_module.Block.HELPER.get_shared_instance(world_module.BlockType.TREE)
+        for x, y in self.trees:
+            world.set_block(x, y, tree, "objects")
+
+        for x, y, width, height, name in self.buildings:
+            world.buildings.append(Building(world, x, y, width, height, name))
+
+        tile = constants.TILE_SIZE
+        for entitytype, x, y, width, height, orientation in self.spawns:
+            world.add_spawn(entitytype, x * tile, y * tile, util.parse_orientation(orientation), width * tile, height * tile)
+
+        for road_start in self.road_starts:
+            world.roadmap.begin_discovery(road_start)
+
+        world.post_load()
+        return world
+
+    def write_tmx(self, path):
+        """
+        Writes the city to the given file in the same format as the other worlds, a row at a time
+        """
+        res = constants.TILESET_RESOLUTION
+        gids = map(str, self.palette)
+
+        with open(path, "w") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            f.write('<map version="1.0" orientation="orthogonal" renderorder="right-down" width="%d" height="%d" '
+                    'tilewidth="%d" tileheight="%d">\n' % (self.width, self.height, res, res))
+            f.write(' <tileset firstgid="1" name="tileset" tilewidth="%d" tileheight="%d">\n' % (res, res))
+            f.write('  <image source="tileset.png" width="160" height="160"/>\n')
+            f.write(' </tileset>\n')
+
+            for name in CityGenerator.LAYERS:
+                f.write(' <layer name="%s" width="%d" height="%d">\n' % (name, self.width, self.height))
+                f.write('  <data encoding="csv">\n')
+                rows = self.layers[name]
+                for y, row in enumerate(rows):
+                    f.write(",".join(map(gids.__getitem__, row)))
+                    f.write(",\n" if y < len(rows) - 1 else "\n")
+                f.write('</data>\n')
+                f.write(' </layer>\n')
+
+            # objects are positioned by their bottom left corner
+            f.write(' <objectgroup name="objects">\n')
+            for x, y in self.trees:
+                f.write('  <object gid="%d" x="%d" y="%d"/>\n' % (world_module.BlockType.TREE + 1, x * res, (y + 1) * res))
+            f.write(' </objectgroup>\n')
+
+            f.write(' <objectgroup name="_buildings">\n')
+            for x, y, width, height, name in self.buildings:
+                f.write('  <object x="%d" y="%d" width="%d" height="%d">\n' % (x * res, y * res, width * res, height * res))
+                f.write('   <properties>\n')
+                f.write('    <property name="building" value="%s"/>\n' % name)
+                f.write('   </properties>\n')
+                f.write('  </object>\n')
+            f.write(' </objectgroup>\n')
+
+            # spawns are loaded a tile lower than they are positioned
+            f.write(' <objectgroup name="_spawns">\n')
+            for entitytype, x, y, width, height, orientation in self.spawns:
+                f.write('  <object x="%d" y="%d" width="%d" height="%d">\n' % (x * res, (y - 1) * res, width * res, height * res))
+                f.write('   <properties>\n')
+                f.write('    <property name="entitytype" value="%s"/>\n' % util.get_enum_name(constants.EntityType, entitytype).lower())
+                f.write('    <property name="orientation" value="%s"/>\n' % orientation)
+                f.write('   </properties>\n')
+                f.write('  </object>\n')
+            f.write(' </objectgroup>\n')
+
+            f.write(' <objectgroup name="_road">\n')
+            for x, y in self.road_starts:
+                f.write('  <object x="%d" y="%d" width="%d" height="%d"/>\n' % (x * res, y * res, res, res))
+            f.write(' </objectgroup>\n')
+            f.write('</map>\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generates a city and writes it to a tmx file")
+    parser.add_argument("width", type=int, help="width in tiles")
+    parser.add_argument("height", type=int, help="height in tiles")
+    parser.add_argument("--seed", type=int, help="seed, which always generates the same city")
+    parser.add_argument("--output", help="file to write to, defaults to res/world/city-WIDTHxHEIGHT.tmx")
+    args = parser.parse_args()
+
+    output = args.output or util.get_relative_path("res/world/city-%dx%d.tmx" % (args.width, args.height))
+    CityGenerator(args.width, args.height, args.seed).write_tmx(output)
@@ -1,4 +1,5 @@
 from _yaml import ParserError
+from collections import OrderedDict
 import logging
 import os
 import random
@@ -18,10 +19,28 @@ class GameScreen:
     Handles all drawing to screen
     """
 
+    TEXT_CACHE_SIZE = 512
+    NUMERIC_CHARS = "0123456789.-"
+
     def __init__(self):
         self._window = None
         self.camera = None
         self.font = None
+        self.debug_overlay = False
+        self.show_minimap = False
+
+        # (string, colour, font): rendered surface, least recently used first
+        self._text_cache = OrderedDict()
+        # (colour, font): (surface of all numeric chars, char: area)
+        self._numeric_glyphs = {}
+
+        # sprites are queued up and drawn together in a single batch, see flush_sprites
+        self._sprite_batch = []
+        self._draw_calls = self._sprites_drawn = 0
+        self.last_frame_stats = 0, 0
+
+        # draw commands of the current frame, if they are being recorded instead of drawn, see begin_recording
+        self._recorded = None
 
     def create_window(self):
         """
@@ -48,11 +67,30 @@ class GameScreen:
         """
         self.camera = Camera(world)
 
+    def begin_recording(self):
+        """
+        From now on, draw commands are recorded instead of drawn to the window, so each frame can be replayed later by
+        another thread, see end_frame and replay
+        """
+        self._recorded = []
+
+    def _draw(self, func, *args):
+        """
+        Draws to the window with the given function, which takes it as its first argument, or records it for later if
+        recording
+
+        :param func: Function such as pygame.Surface.blit or pygame.draw.rect
+        """
+        if self._recorded is None:
+            func(self._window, *args)
+        else:
+            self._recorded.append((func, args))
+
     def fill(self, colour):
         """
         :param colour: The colour to fill the screen with
         """
-        self._window.fill(colour)
+        self._draw(pygame.Surface.fill, colour)
 
     def draw_rect(self, rect, colour=(255, 0, 0), filled=True):
         """
@@ -61,37 +99,105 @@ class GameScreen:
         :param filled: Outlined if False
         """
         dim = (rect[1][0], rect[1][1]) if len(rect) == 2 else (rect.width, rect.height)
-        pygame.draw.rect(self._window, colour, (self.camera.apply_rect(rect), dim), 0 if filled else 2)
+        self._draw(pygame.draw.rect, colour, (self.camera.apply_rect(rect), dim), 0 if filled else 2)
+        self._draw_calls += 1
 
     def draw_sprite(self, sprite, loc, area=None):
         """
-        Draws a sprite at the given world position
+        Queues a sprite to be drawn at the given world position, see flush_sprites
+
+        :param sprite: Surface to draw from, usually a sprite atlas
+        :param area: Area of the surface to draw
         """
-        self._window.blit(sprite, self.camera.apply_rect(loc), area)
+        self._sprite_batch.append((sprite, self.camera.apply_rect(loc), area))
 
     def draw_sprite_from_pos(self, sprite, loc, area=None):
-        self._window.blit(sprite, self.camera.apply(loc), area)
+        self._sprite_batch.append((sprite, self.camera.apply(loc), area))
+
+    def flush_sprites(self):
+        """
+        Draws all queued sprites in a single batch, in the order they were queued
+        """
+        if self._sprite_batch:
+            self._draw(pygame.Surface.blits, self._sprite_batch, 0)
+            self._draw_calls += 1
+            self._sprites_drawn += len(self._sprite_batch)
+            self._sprite_batch = []
+
+    def end_frame(self):
+        """
+        Records and resets the draw call counts of the frame
+
+        :return: The draw commands of the frame if recording, to be passed to replay, otherwise None
+        """
+        self.flush_sprites()
+        self.last_frame_stats = self._draw_calls, self._sprites_drawn
+        self._draw_calls = self._sprites_drawn = 0
+
+        frame = self._recorded
+        if frame is not None:
+            self._recorded = []
+        return frame
+
+    def replay(self, frame):
+        """
+        Replays the draw commands of the given recorded frame onto the window, which can be done on another thread
+        """
+        window = self._window
+        for func, args in frame:
+            func(window, *args)
+
+    def present(self):
+        """
+        Flips the display, which must be done on the main thread
+        """
+        pygame.display.flip()
+
+    def get_debug_lines(self):
+        """
+        :return: Lines of text to show in the debug overlay
+        """
+        return ["Draw calls: %d (%d sprites batched)" % self.last_frame_stats]
 
     def draw_block(self, block, loc, surface=None):
         """
         Draws a block to the given loc on the given surface (the window if None)
         """
         image = world_module.Block.HELPER.block_images[block.render_id]
-        s = surface if surface else self._window
-        s.blit(image, loc)
+        if surface:
+            surface.blit(image, loc)
+        else:
+            self._draw(pygame.Surface.blit, image, loc)
+            self._draw_calls += 1
+
+    def draw_blocks(self, blocks, surface=None):
+        """
+        Draws many blocks in a single batch to the given surface (the window if None)
+
+        :param blocks: List of (block, loc)
+        """
+        images = world_module.Block.HELPER.block_images
+        blits = [(images[block.render_id], loc) for block, loc in blocks]
+        if surface:
+            surface.blits(blits, 0)
+        else:
+            self._draw(pygame.Surface.blits, blits, 0)
+            self._draw_calls += 1
 
     def draw_line(self, start, end, colour=(255, 20, 20)):
         """
         Draws a line between the given points
         """
-        pygame.draw.line(self._window, colour, self.camera.apply(start), self.camera.apply(end), 1)
+        self._draw(pygame.draw.line, colour, self.camera.apply(start), self.camera.apply(end), 1)
+        self._draw_calls += 1
 
     def draw_circle(self, pos, colour=(0, 255, 100), radius=10, filled=True):
         """
         Draws a circle at the given position
         """
         camera_apply = tuple(map(int, self.camera.apply(pos)))
-        pygame.draw.circle(self._window, colour, camera_apply, radius, 0 if filled else 2)
+        self._draw(pygame.draw.circle, colour, camera_apply, radius, 0 if filled else 2)
+        self._draw_calls += 1
 
     def draw_circle_in_tile(self, pos, colour=(0, 255, 100), radius=10, filled=True):
         """
@@ -105,20 +211,112 @@ class GameScreen:
         """
         self.draw_string(str(int(fps)), (offset, WINDOW_SIZE[1] - offset))
 
+    def draw_debug_lines(self, lines, offset=20, colour=(255, 255, 255)):
+        """
+        Draws the given lines of text down the top left of the screen, with the given offset
+        """
+        line_height = self.font.get_linesize()
+        for i, line in enumerate(lines):
+            self.draw_string(line, (offset, offset + i * line_height), colour)
+
     def draw_string(self, string, pos, colour=(255, 0, 0), absolute=True):
         """
         Draws the given string to the screen
 
         :param absolute: If False, it is drawn in the world, otherwise on the screen
         """
-        surface = self.font.render(string, 1, colour)
-        self._window.blit(surface, self.camera.apply(pos) if not absolute else pos)
+        pos = self.camera.apply(pos) if not absolute else pos
+        colour = tuple(colour)
 
-    def blit(self, surface, pos=(0, 0), area=None):
+        # numbers change too often to be worth caching, so are made up of cached glyphs instead
+        if string and all(c in GameScreen.NUMERIC_CHARS for c in string):
+            self._draw_number(string, pos, colour)
+        else:
+            self._draw(pygame.Surface.blit, self.render_string(string, colour), pos)
+        self._draw_calls += 1
+
+    def render_string(self, string, colour):
+        """
+        :return: The given string rendered in the current font, which is cached until it is the least recently used
+        """
+        key = string, colour, self.font
+        surface = self._text_cache.pop(key, None)
+        if surface is None:
+            if len(self._text_cache) >= GameScreen.TEXT_CACHE_SIZE:
+                self._text_cache.popitem(last=False)
+            surface = self.font.render(string, 1, colour)
+
+        self._text_cache[key] = surface
+        return surface
+
+    def _draw_number(self, string, pos, colour):
+        """
+        Draws the given numeric string in a single batch from the cached glyphs of the current font
+        """
+        key = colour, self.font
+        glyphs = self._numeric_glyphs.get(key)
+        if not glyphs:
+            # each char is rendered separately, so antialiasing doesn't bleed into its neighbours
+            rendered = [(c, self.font.render(c, 1, colour)) for c in GameScreen.NUMERIC_CHARS]
+            width = sum(r.get_width() for _, r in rendered)
+            surface = pygame.Surface((width, self.font.get_height()), pygame.SRCALPHA, 32).convert_alpha()
+            surface.fill((0, 0, 0, 0))
+
+            areas = {}
+            x = 0
+            for c, r in rendered:
+                areas[c] = surface.blit(r, (x, 0), None, pygame.BLEND_RGBA_MAX)
+                x += r.get_width()
+            glyphs = surface, areas
+            self._numeric_glyphs[key] = glyphs
+
+        surface, areas = glyphs
+        x, y = pos
+        batch = []
+        for c in string:
+            area = areas[c]
+            batch.append((surface, (x, y), area))
+            x += area.width
+        self._draw(pygame.Surface.blits, batch, 0)
+
+    def blit(self, surface, pos=(0, 0), area=None, special_flags=0, volatile=False):
         """
         Blits the given surface onto the screen at the given position
+
+        :param volatile: True if the surface is drawn on in place, so if recording, the part of it on the screen is
+                         copied to show it as it is now
         """
-        self._window.blit(surface, pos, area)
+        if volatile and self._recorded is not None:
+            surface, pos, area = self._copy_visible(surface, pos, area)
+            if surface is None:
+                return
+
+        self._draw(pygame.Surface.blit, surface, pos, area, special_flags)
+        self._draw_calls += 1
+
+    def _copy_visible(self, surface, pos, area):
+        """
+        :return: A copy of the part of the given surface that blitting it would draw on the window, with the position
+                 and area to blit it at, otherwise (None, None, None) if none of it would be drawn
+        """
+        area = pygame.Rect(area).clip(surface.get_rect()) if area else surface.get_rect()
+        x, y = int(pos[0]), int(pos[1])
+        dest = pygame.Rect((x, y), area.size).clip(self._window.get_rect())
+        if not dest.width or not dest.height:
+            return None, None, None
+
+        visible = pygame.Rect(area.x + dest.x - x, area.y + dest.y - y, dest.width, dest.height)
+        return surface.subsurface(visible).copy(), dest.topleft, None
+
+    def draw_batch(self, blits):
+        """
+        Blits many surfaces onto the screen in a single batch
+
+        :param blits: List of (surface, pos) or (surface, pos, area)
+        """
+        if blits:
+            self._draw(pygame.Surface.blits, blits, 0)
+            self._draw_calls += 1
 
     def shake_camera(self, time=0.2, force=5):
         if self.camera:
@@ -166,7 +364,7 @@ class ConfigLoader:
 
     def _verify(self, config):
         def verify(s, clazz, *predicates):
-            x = config[s]
+            x = config.get(s)
             try:
                 assert isinstance(x, clazz)
                 for p in predicates:
@@ -177,16 +375,26 @@ class ConfigLoader:
 
         try:
             verify("debug.log-level", str, lambda x: isinstance(logging.getLevelName(x), int))
+            verify("debug.profiler", bool)
 
             verify("display.resolution", list, lambda x: len(x) == 2, lambda x: not any(y <= 0 for y in x))
             verify("display.borderless-fullscreen", bool)
+            verify("display.lighting", bool)
+            verify("display.minimap", bool)
+            verify("display.pipelined", bool)
 
             verify("game.humans.spawn-count", int, lambda x: x >= 0)
             verify("game.humans.wandering", bool)
+            verify("game.humans.avoidance", bool)
 
             verify("game.vehicles.spawn-count", int, lambda x: x >= 0)
+            verify("game.vehicles.traffic-count", int, lambda x: x >= 0)
 
             verify("game.buildings.strobe-lights", bool)
+
+            verify("ai.budget-ms", (int, float), lambda x: x > 0)
+            verify("ai.decision-interval.near", int, lambda x: x >= 1)
+            verify("ai.decision-interval.far", int, lambda x: x >= 1)
         except AssertionError as e:
             raise ParserError("Invalid config value: %s" % e.message)
 
@@ -371,9 +579,12 @@ class Camera:
         self.transform += self.velocity * DELTA
         self._check_boundaries()
 
-    def is_visible(self, position):
-        return self.transform.x <= position[0] < self.transform.x + self.view_size[0] and \
-               self.transform.y <= position[1] < self.transform.y + self.view_size[1]
+    def is_visible(self, position, margin=(0, 0)):
+        """
+        :param margin: Extra distance around each side of the view to include
+        """
+        return self.transform.x - margin[0] <= position[0] < self.transform.x + self.view_size[0] + margin[0] and \
+               self.transform.y - margin[1] <= position[1] < self.transform.y + self.view_size[1] + margin[1]
 
     def _check_boundaries(self):
         """
@@ -566,6 +777,17 @@ class Input:
     INTERACT = pygame.K_e
     RELEASE_CONTROL = pygame.K_TAB
     QUIT = pygame.K_ESCAPE
+    DEBUG_OVERLAY = pygame.K_F3
+    MINIMAP = pygame.K_F8
+    PROFILER = pygame.K_F9
+
+    # key: name of the world overlay it toggles, see overlay.OVERLAYS
+    DEBUG_WORLD_OVERLAYS = {
+        pygame.K_F4: "navigation",
+        pygame.K_F5: "collisions",
+        pygame.K_F6: "roads",
+        pygame.K_F7: "entity-grid"
+    }
 
     DIRECTIONAL_KEYS = [UP, LEFT, DOWN, RIGHT]
 
@@ -573,6 +795,7 @@ class Input:
 LOGGER = None
 CONFIG = None
 STATEMANAGER = None
+TIMERS = None
 SCREEN = GameScreen()
 
 RUNNING = True
@@ -1,18 +1,124 @@
+import Queue
 import os
+import threading
+import time
+from collections import deque
 
 import pygame
 
 import constants
+import event as event_module
+import profiler
 import state
+import util
+
+
+class FrameTimings:
+    """
+    Times when recent frames were simulated and drawn, to show how much they overlap
+    """
+
+    FRAMES = 60
+
+    def __init__(self):
+        # (start, end), each in order and appended to from both threads
+        self.simulating = deque(maxlen=FrameTimings.FRAMES)
+        self.drawing = deque(maxlen=FrameTimings.FRAMES)
+        self.waiting = deque(maxlen=FrameTimings.FRAMES)
+
+    def get_overlap(self):
+        """
+        :return: The total time spent simulating recent frames while drawing, and the total time spent simulating
+        """
+        drawing = list(self.drawing)
+
+        # both are in order, so each frame drawn only needs comparing with the simulations around it
+        overlap = total = 0
+        first = 0
+        for sim_start, sim_end in list(self.simulating):
+            total += sim_end - sim_start
+            while first < len(drawing) and drawing[first][1] <= sim_start:
+                first += 1
+
+            for i in xrange(first, len(drawing)):
+                draw_start, draw_end = drawing[i]
+                if draw_start >= sim_end:
+                    break
+                overlap += min(draw_end, sim_end) - max(draw_start, sim_start)
+        return overlap, total
+
+    def get_debug_lines(self):
+        def average_ms(intervals):
+            intervals = list(intervals)
+            return sum(end - start for start, end in intervals) * 1000 / max(1, len(intervals))
+
+        overlap, total = self.get_overlap()
+        return ["Pipeline: simulate %.1fms, draw %.1fms, wait %.1fms" %
+                (average_ms(self.simulating), average_ms(self.drawing), average_ms(self.waiting)),
+                "Simulation overlapped drawing: %d%%" % (overlap * 100 / total if total else 0)]
+
+
+class RenderThread(threading.Thread):
+    """
+    Draws the recorded frames of the screen on its own thread, so the next frame is simulated while the last is drawn.
+    Blitting releases the GIL, so it runs alongside simulation. The display is still flipped on the main thread, which
+    also handles window events, once each frame has been drawn.
+    Surfaces that are drawn on in place, such as world layers, are blitted as volatile, so frames show them as they were
+    when recorded
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="render")
+        self.daemon = True
+        self.timings = FrameTimings()
+
+        # holds a single frame, so simulation is never more than one frame ahead of drawing
+        self._frames = Queue.Queue(maxsize=1)
+
+    def submit(self, frame):
+        """
+        Waits for the last frame to be drawn and presents it, then queues the given recorded frame to be drawn
+        """
+        start = time.time()
+        self._frames.join()
+        self.timings.waiting.append((start, time.time()))
+
+        constants.SCREEN.present()
+        self._frames.put(frame)
+
+    def run(self):
+        while True:
+            frame = self._frames.get()
+            if frame is None:
+                break
+
+            start = time.time()
+            constants.SCREEN.replay(frame)
+            self.timings.drawing.append((start, time.time()))
+            self._frames.task_done()
+
+    def stop(self):
+        """
+        Draws and presents the last queued frame, then stops
+        """
+        self.submit(None)
+        self.join()
 
 
 class Game:
     def __init__(self):
         self.initiate()
         constants.SCREEN.create_window()
+        constants.SCREEN.show_minimap = constants.CONFIG["display.minimap"]
+        profiler.set_enabled(constants.CONFIG["debug.profiler"])
         constants.STATEMANAGER = state.StateManager()
         constants.STATEMANAGER.change_state(state.OutsideWorldState())
 
+        self.render_thread = None
+        if constants.CONFIG["display.pipelined"]:
+            constants.SCREEN.begin_recording()
+            self.render_thread = RenderThread()
+
     def initiate(self):
         # logger
         constants.LOGGER = constants.Logger()
@@ -21,26 +127,37 @@ class Game:
         constants.ConfigLoader.load_config()
         constants.set_window_size(constants.CONFIG["display.resolution"])
 
+        constants.TIMERS = util.TimerWheel()
+
     def start(self):
         """
         Sets up and runs the game
         """
         clock = pygame.time.Clock()
+        if self.render_thread:
+            self.render_thread.start()
+
         while constants.RUNNING:
             constants.LAST_DELTA = constants.DELTA
             constants.DELTA = (clock.tick(60) / 1000.0)
+            frame_start = time.time()
+            profiler.next_frame()
+            constants.TIMERS.advance(constants.DELTA)
             current_state = constants.STATEMANAGER.get_current()
 
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    constants.RUNNING = False
-                elif event.type == pygame.USEREVENT:
-                    constants.STATEMANAGER.handle_user_event(event)
-                else:
-                    current_state.handle_event(event)
+            with profiler.scope("events"):
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        constants.RUNNING = False
+                    else:
+                        current_state.handle_event(event)
+
+                event_module.BUS.dispatch()
 
             constants.SCREEN.fill(current_state.background_colour)
-            current_state.tick()
+            with profiler.scope("state"):
+                current_state.tick()
+            constants.SCREEN.flush_sprites()
 
             try:
                 constants.STATEMANAGER.tick_transition()
@@ -49,7 +166,25 @@ class Game:
                 pass
 
             constants.SCREEN.draw_fps(clock.get_fps())
-            pygame.display.flip()
+            if constants.SCREEN.debug_overlay:
+                lines = constants.STATEMANAGER.get_debug_lines()
+                if self.render_thread:
+                    lines += self.render_thread.timings.get_debug_lines()
+                constants.SCREEN.draw_debug_lines(lines)
+            profiler.render()
+            frame = constants.SCREEN.end_frame()
+
+            if self.render_thread:
+                self.render_thread.timings.simulating.append((frame_start, time.time()))
+                self.render_thread.submit(frame)
+            else:
+                with profiler.scope("present"):
+                    constants.SCREEN.present()
+
+        if self.render_thread:
+            self.render_thread.stop()
+            for line in self.render_thread.timings.get_debug_lines():
+                constants.LOGGER.info(line)
 
     def __setattr__(self, key, value):
         if key == "state":
@@ -8,6 +8,7 @@ from pygame.surface import Surface
 import ai
 import animation
 import constants
+import profiler
 import util
 from vec2d import Vec2d
 
@@ -137,6 +138,9 @@ class Entity(Sprite):
 
         self.velocity = Vec2d(0, 0)
 
+        # extra velocity from crowd avoidance, see ai.CrowdAvoidance
+        self.avoidance = Vec2d(0, 0)
+
         self.world_collisions = world_collisions
         self.collisions_enabled = True
         self.world_interactions = world_interactions
@@ -199,7 +203,7 @@ class Entity(Sprite):
             delta[1] += 1
         """
 
-        delta = self.velocity * constants.DELTA
+        delta = (self.velocity + self.avoidance) * constants.DELTA
         delta += self.aabb.centre
         self.move_entity(delta)
 
@@ -375,6 +379,7 @@ class Entity(Sprite):
             except ValueError:
                 constants.LOGGER.warning("Couldn't swap 2 entities (%r and %r)" % (self, other))
 
+    @profiler.profiled("collisions")
     def handle_collisions(self):
         """
         Corrects any collisions with the world
@@ -570,6 +575,9 @@ class Vehicle(Entity):
 
         self.controller = ai.VehicleController(self)
 
+        # driven by the world's traffic instead of its controller, see traffic.Traffic
+        self.autonomous = False
+
     def catchup_aab(self):
         self.rect.centre = self.aabb.midtop
 
@@ -603,6 +611,9 @@ class Vehicle(Entity):
         """
         :return: Whether or not the entering was successful
         """
+        if self.autonomous:
+            return False
+
         free_seat = self.get_first_free_seat()
         if free_seat < 0:
             return False
@@ -647,7 +658,12 @@ class Vehicle(Entity):
         return -1
 
     def tick(self, render, block_input=False):
-        Entity.tick(self, render)
+        # already moved by the traffic simulation
+        if self.autonomous:
+            if render:
+                self.render()
+        else:
+            Entity.tick(self, render)
 
         # passengers
         for human in self.passengers:
@@ -658,7 +674,7 @@ class Vehicle(Entity):
 
     def _render_seat(self, horizontal, front_seat):
         sprites = self.seats[0 if front_seat else 1][1]
-        sprite = sprites[self.direction]
+        atlas, sprite_area = sprites[self.direction]
 
         reversed_hor = self.direction == constants.Direction.EAST
 
@@ -675,8 +691,8 @@ class Vehicle(Entity):
         pos_offset = (0, 0) if not reversed_hor else offset
         pos = self.rect[0] + window_rect[0] + pos_offset[0], self.rect[1] + window_rect[1] + pos_offset[1] + (1 if self.animator.current_frame in (1, 2) else 0)
 
-        face_area = offset, window_rect.size()
-        constants.SCREEN.draw_sprite_from_pos(sprite, pos, face_area)
+        face_area = (sprite_area.x + offset[0], sprite_area.y + offset[1]), window_rect.size()
+        constants.SCREEN.draw_sprite_from_pos(atlas, pos, face_area)
 
         # dest: position to draw at, dimensions don't matter
         # area: portion of source surface to drawn
@@ -1,31 +1,133 @@
+from inspect import getmro
+import heapq
+
 import pygame
 
+import constants
+
+
+class Event:
+    """
+    Base event, which every type of event subclasses. Subscribers to a class receive all events of that class and its
+    subclasses
+    """
+    pass
 
-BUILDING_ENTER = 0
-BUILDING_EXIT = 1
 
-_TYPES = {
-    BUILDING_ENTER: "BuildingEnter",
-    BUILDING_EXIT: "BuildingExit"
-}
+class BuildingMovementEvent(Event):
+    def __init__(self, human, building, entered):
+        """
+        :param human: The entering or exiting human
+        :param building: The building
+        :param entered: True if entering, False if exiting
+        """
+        self.entity = human
+        self.building = building
+        self.entered = entered
 
 
-def call_event(eventtype, **args):
+class EventBus:
     """
-    Posts a user-event with the given arguments to the event queue
+    Publishes events directly to subscribers, without going through the pygame event queue.
+    Published events are batched, and delivered together once per frame by dispatch()
     """
-    pygame.event.post(pygame.event.Event(pygame.USEREVENT, dict({"eventtype": eventtype}.items() + args.items())))
+
+    def __init__(self):
+        self._subscribers = {}
+        self._handlers = {}
+
+        self._queue = []
+        self._deferred = []
+        self._deferred_count = 0
+        self.time = 0
+
+    def subscribe(self, event_cls, handler):
+        """
+        :param event_cls: Event class, whose subclasses are also delivered
+        :param handler: Function taking the event
+        """
+        self._subscribers.setdefault(event_cls, []).append(handler)
+        self._handlers.clear()
+
+    def unsubscribe(self, event_cls, handler):
+        handlers = self._subscribers.get(event_cls)
+        if handlers and handler in handlers:
+            handlers.remove(handler)
+            self._handlers.clear()
+
+    def _get_handlers(self, event_cls):
+        """
+        :return: All handlers subscribed to the given event class or any of its base classes, which are cached until the
+                 subscribers change
+        """
+        handlers = self._handlers.get(event_cls)
+        if handlers is None:
+            handlers = []
+            for cls in getmro(event_cls):
+                handlers.extend(self._subscribers.get(cls, ()))
+            self._handlers[event_cls] = handlers
+        return handlers
+
+    def publish(self, e, delay=0):
+        """
+        Queues the given event, to be delivered on the next dispatch
+
+        :param delay: Seconds to hold back the event for, if any
+        """
+        if delay > 0:
+            self._deferred_count += 1
+            heapq.heappush(self._deferred, (self.time + delay, self._deferred_count, e))
+        else:
+            self._queue.append(e)
+
+    def call(self, e):
+        """
+        Delivers the given event to its subscribers immediately
+        """
+        for handler in self._get_handlers(e.__class__):
+            handler(e)
+
+    def dispatch(self, delta=None):
+        """
+        Delivers all queued events, and any deferred events that are now due.
+        Events published during dispatch are delivered on the next dispatch
+
+        :param delta: Time since the last dispatch, defaults to the frame's delta time
+        """
+        self.time += constants.DELTA if delta is None else delta
+
+        deferred = self._deferred
+        while deferred and deferred[0][0] <= self.time:
+            self._queue.append(heapq.heappop(deferred)[2])
+
+        if not self._queue:
+            return
+
+        queue = self._queue
+        self._queue = []
+        for e in queue:
+            self.call(e)
+
+    def clear(self):
+        """
+        Drops all queued and deferred events
+        """
+        self._queue = []
+        self._deferred = []
+
+
+BUS = EventBus()
 
 
 def call_human_building_movement(human, building, entered):
     """
-    Helper function, to post a building entry event
+    Helper function, to publish a building entry event
 
     :param human: The entering human
     :param building: The building
     :param entered: True if entering, False if exiting
     """
-    call_event(BUILDING_ENTER if entered else BUILDING_EXIT, entity=human, building=building)
+    BUS.publish(BuildingMovementEvent(human, building, entered))
 
 
 def simplify_key_event(event):
@@ -34,4 +136,4 @@ def simplify_key_event(event):
     """
     if event.type == pygame.KEYDOWN or event.type == pygame.KEYUP:
         return event.type == pygame.KEYDOWN, event.key
-    return None
\ No newline at end of file
+    return None
@@ -0,0 +1,271 @@
+import pygame
+
+import constants
+import util
+import world as world_module
+
+
+class LightType:
+    WINDOW = 0
+    STREET_LAMP = 1
+    HEADLIGHT = 2
+
+    # light type: (radius in tiles, colour)
+    PROPERTIES = {
+        WINDOW: (1.5, (170, 150, 90)),
+        STREET_LAMP: (3.5, (200, 170, 110)),
+        HEADLIGHT: (3, (150, 150, 120))
+    }
+
+
+# (light type, scale, direction): mask surface
+_MASKS = {}
+
+
+def get_mask(light_type, scale, direction=None):
+    """
+    :param scale: World pixels per mask pixel
+    :param direction: The direction the light faces, only for headlights
+    :return: The light mask of the given type, which is only created the first time
+    """
+    key = light_type, scale, direction
+    mask = _MASKS.get(key)
+    if not mask:
+        radius, colour = LightType.PROPERTIES[light_type]
+        radius = max(1, int(radius * constants.TILE_SIZE / scale))
+
+        if light_type == LightType.HEADLIGHT:
+            mask = _create_beam_mask(radius, colour, direction)
+        else:
+            mask = _create_radial_mask(radius, colour)
+        _MASKS[key] = mask
+
+    return mask
+
+
+def _create_radial_mask(radius, colour, steps=16):
+    """
+    :return: A black surface with a circle of light that fades from the given colour in the centre
+    """
+    mask = pygame.Surface((radius * 2, radius * 2), 0, 32)
+    mask.fill((0, 0, 0))
+    for i in xrange(steps):
+        fraction = float(i + 1) / steps
+        c = util.lerp_colours((0, 0, 0), colour, fraction ** 2)
+        pygame.draw.circle(mask, map(int, c), (radius, radius), max(1, int(radius * (1 - fraction) + 1)))
+    return mask
+
+
+def _create_beam_mask(length, colour, direction, steps=12):
+    """
+    :return: A black surface with an oval of light that fades from the given colour, facing the given direction
+    """
+    mask = pygame.Surface((length * 2, length), 0, 32)
+    mask.fill((0, 0, 0))
+    for i in xrange(steps):
+        fraction = float(i + 1) / steps
+        c = util.lerp_colours((0, 0, 0), colour, fraction ** 2)
+        width = max(2, int(length * 2 * (1 - fraction)) + 2)
+        height = max(2, int(length * (1 - fraction)) + 2)
+        pygame.draw.ellipse(mask, map(int, c), (0, (length - height) / 2, width, height))
+
+    # faces east, with the source on the left
+    angles = {constants.Direction.EAST: 0, constants.Direction.NORTH: 90, constants.Direction.WEST: 180, constants.Direction.SOUTH: 270}
+    return pygame.transform.rotate(mask, angles[direction])
+
+
+class LightMap:
+    """
+    Darkens the world and lights it up with lights.
+    Static lights are blended into a low resolution light map, which is split into chunks that are only recomposed when
+    a light in them changes and they are next visible. The part around the screen is upscaled whenever it changes, and
+    every frame the visible part is multiplied over the screen, along with the headlights of visible vehicles
+    """
+
+    SCALE = 4
+    CHUNK_SIZE = 8
+
+    # tiles upscaled around each side of the screen, so the camera can move a little before upscaling again
+    MARGIN = 4
+    AMBIENT = (70, 70, 120)
+
+    def __init__(self, world):
+        self.world = world
+
+        # tile: light type
+        self._lights = {}
+        # chunk: tiles of lights that reach it
+        self._chunk_lights = {}
+        self._dirty = set()
+
+        scale = LightMap.SCALE
+        self._chunk_pixels = LightMap.CHUNK_SIZE * constants.TILE_SIZE
+        self._low_res = pygame.Surface((world.pixel_width / scale + 1, world.pixel_height / scale + 1), 0, 32)
+
+        # the upscaled area of the low resolution light map
+        self._upscaled = None
+        self._upscaled_area = None
+
+        self._frame = None
+
+        chunks_across = world.tile_width / LightMap.CHUNK_SIZE + 1
+        chunks_down = world.tile_height / LightMap.CHUNK_SIZE + 1
+        for x in xrange(chunks_across):
+            for y in xrange(chunks_down):
+                self._chunk_lights[(x, y)] = set()
+                self._dirty.add((x, y))
+
+        # switched on windows
+        for x, y, b in world.iterate_blocks(layer="overterrain"):
+            if b.blocktype == world_module.BlockType.BUILDING_WINDOW_ON:
+                self.add_light(LightType.WINDOW, (x, y))
+        world.add_block_listener(self._on_block_change)
+
+        # street lamps at the corner of every junction
+        for junction in world.roadmap.junctions:
+            road = junction.road
+            line = world.roadmap.move_line(road.line, junction.offset, road.road_direction)
+            self.add_light(LightType.STREET_LAMP, line[0])
+
+    def _on_block_change(self, x, y, block, layer):
+        if layer == "overterrain":
+            if block.blocktype == world_module.BlockType.BUILDING_WINDOW_ON:
+                self.add_light(LightType.WINDOW, (x, y))
+            elif block.blocktype == world_module.BlockType.BUILDING_WINDOW_OFF:
+                self.remove_light((x, y))
+
+    def _iterate_chunks(self, tile, light_type):
+        """
+        :return: Generator for all chunks that the light of the given type at the given tile reaches
+        """
+        radius = int(LightType.PROPERTIES[light_type][0]) + 1
+        size = LightMap.CHUNK_SIZE
+        for cx in xrange(max(0, tile[0] - radius) / size, (tile[0] + radius) / size + 1):
+            for cy in xrange(max(0, tile[1] - radius) / size, (tile[1] + radius) / size + 1):
+                if (cx, cy) in self._chunk_lights:
+                    yield cx, cy
+
+    def add_light(self, light_type, tile):
+        """
+        Adds a light that doesn't move at the given tile, replacing any other there
+        """
+        if self._lights.get(tile) == light_type:
+            return
+
+        self.remove_light(tile)
+        self._lights[tile] = light_type
+        for chunk in self._iterate_chunks(tile, light_type):
+            self._chunk_lights[chunk].add(tile)
+            self._dirty.add(chunk)
+
+    def remove_light(self, tile):
+        light_type = self._lights.pop(tile, None)
+        if light_type is None:
+            return
+
+        for chunk in self._iterate_chunks(tile, light_type):
+            self._chunk_lights[chunk].discard(tile)
+            self._dirty.add(chunk)
+
+    def _recompose(self, chunk):
+        """
+        Redraws the given chunk of the light map
+        """
+        scale = LightMap.SCALE
+        size = self._chunk_pixels / scale
+        area = pygame.Rect(chunk[0] * size, chunk[1] * size, size, size).clip(self._low_res.get_rect())
+        if not area.width or not area.height:
+            return
+
+        self._low_res.set_clip(area)
+        self._low_res.fill(LightMap.AMBIENT)
+        for tile in self._chunk_lights[chunk]:
+            mask = get_mask(self._lights[tile], scale)
+            centre = util.tile_to_pixel((tile[0] + 0.5, tile[1] + 0.5))
+            pos = centre[0] / scale - mask.get_width() / 2, centre[1] / scale - mask.get_height() / 2
+            self._low_res.blit(mask, pos, special_flags=pygame.BLEND_RGB_ADD)
+        self._low_res.set_clip(None)
+
+    def update(self, area):
+        """
+        Recomposes the chunks with changed lights in the given area of the low resolution light map
+
+        :return: True if any were recomposed
+        """
+        size = self._chunk_pixels / LightMap.SCALE
+        changed = False
+        for x in xrange(area.left / size, (area.right - 1) / size + 1):
+            for y in xrange(area.top / size, (area.bottom - 1) / size + 1):
+                if (x, y) in self._dirty:
+                    self._recompose((x, y))
+                    self._dirty.remove((x, y))
+                    changed = True
+        return changed
+
+    def _upscale(self, view):
+        """
+        Upscales the given area of the low resolution light map, and a margin around it, if it has changed or wasn't
+        upscaled already
+        """
+        area = self._upscaled_area
+        if area is not None and area.contains(view) and not self.update(area):
+            return
+
+        margin = LightMap.MARGIN * constants.TILE_SIZE / LightMap.SCALE
+        area = view.inflate(margin * 2, margin * 2).clip(self._low_res.get_rect())
+        self.update(area)
+
+        scale = LightMap.SCALE
+        size = area.width * scale, area.height * scale
+        if self._upscaled is None or self._upscaled.get_size() != size:
+            self._upscaled = pygame.Surface(size, 0, 32)
+        pygame.transform.smoothscale(self._low_res.subsurface(area), size, self._upscaled)
+        self._upscaled_area = area
+
+    def render(self):
+        """
+        Multiplies the visible light map, and the headlights of visible vehicles, over the screen
+        """
+        window_size = tuple(constants.WINDOW_SIZE)
+        if not self._frame or self._frame.get_size() != window_size:
+            self._frame = pygame.Surface(window_size, 0, 32)
+
+        # the visible part of the light map, with a pixel either side to cover the screen once upscaled
+        scale = LightMap.SCALE
+        camera = constants.SCREEN.camera
+        x, y = int(camera.transform.x) / scale, int(camera.transform.y) / scale
+        view = pygame.Rect(x, y, window_size[0] / scale + 2, window_size[1] / scale + 2).clip(self._low_res.get_rect())
+
+        if view.width and view.height:
+            self._upscale(view)
+            area = self._upscaled_area
+            pos = camera.apply((area.x * scale, area.y * scale))
+
+            # small worlds don't cover the whole screen
+            if not self._upscaled.get_rect(topleft=pos).contains(self._frame.get_rect()):
+                self._frame.fill(LightMap.AMBIENT)
+            self._frame.blit(self._upscaled, pos)
+        else:
+            self._frame.fill(LightMap.AMBIENT)
+
+        for e in self.world.entities:
+            if e.entitytype == constants.EntityType.VEHICLE and e.visible:
+                self._add_headlight(e, camera)
+
+        constants.SCREEN.blit(self._frame, special_flags=pygame.BLEND_RGB_MULT, volatile=True)
+
+    def _add_headlight(self, vehicle, camera):
+        mask = get_mask(LightType.HEADLIGHT, 1, vehicle.direction)
+        w, h = mask.get_size()
+        x, y = vehicle.rect.centre
+        half_width, half_height = vehicle.rect.width / 2, vehicle.rect.height / 2
+
+        # the beam starts at the front of the vehicle
+        pos = {
+            constants.Direction.NORTH: (x - w / 2, y - half_height - h),
+            constants.Direction.WEST: (x - half_width - w, y - h / 2),
+            constants.Direction.SOUTH: (x - w / 2, y + half_height),
+            constants.Direction.EAST: (x + half_width, y - h / 2)
+        }[vehicle.direction]
+
+        self._frame.blit(mask, camera.apply(pos), special_flags=pygame.BLEND_RGB_ADD)
@@ -0,0 +1,171 @@
+import pygame
+
+import constants
+import world as world_module
+
+
+class _ColourIndices(dict):
+    """
+    Block id: palette index of its average colour, added to the palette the first time each block is seen.
+    Blocks are old style instances, so they are looked up by id, which is much quicker to hash
+    """
+
+    def __init__(self, minimap):
+        dict.__init__(self)
+        self.minimap = minimap
+        self[id(None)] = 0
+
+        # keeps every block seen alive, so their ids can't be reused
+        self._blocks = []
+
+    def add_row(self, row):
+        """
+        Adds any blocks in the given row that haven't been seen yet
+        """
+        for block in row:
+            if id(block) not in self:
+                self.get_index(block)
+
+    def get_index(self, block):
+        key = id(block)
+        index = self.get(key)
+        if index is None:
+            index = self[key] = self.minimap.get_palette_index(block.render_id)
+            self._blocks.append(block)
+        return index
+
+
+class Minimap:
+    """
+    A tile-per-pixel image of the world, built in bulk from the block grid and kept up to date by block changes
+    """
+
+    MAX_SIZE = 200
+    MARGIN = 10
+    LAYERS = ("underterrain", "terrain", "objects", "overterrain")
+
+    def __init__(self, world):
+        self.world = world
+        self.layers = [l for l in Minimap.LAYERS if world.has_layer(l)]
+
+        # render id: palette index, with 0 left for empty tiles
+        self._palette_indices = {}
+        self._palette = [(0, 0, 0)]
+        self._colour_indices = _ColourIndices(self)
+
+        self.image = self._build_image()
+        self._image_palette_size = len(self._palette)
+        self._scaled = None
+        self._dots = {}
+
+        world.add_block_listener(self._on_block_change)
+
+    def get_palette_index(self, render_id):
+        """
+        :return: The palette index of the average colour of the given block image, which is added if it is not there yet.
+                 Invisible blocks, such as blanks, are treated as empty
+        """
+        index = self._palette_indices.get(render_id)
+        if index is None:
+            image = world_module.Block.HELPER.block_images[render_id]
+            colour = pygame.transform.average_color(image)
+            if len(colour) == 4 and colour[3] == 0:
+                self._palette_indices[render_id] = 0
+                return 0
+
+            index = len(self._palette)
+            if index > 255:
+                raise StandardError("Too many block types for the minimap palette")
+
+            self._palette.append(colour[:3])
+            self._palette_indices[render_id] = index
+        return index
+
+    def _build_image(self):
+        """
+        :return: A new 8-bit image of the world, with each layer converted to palette indices a row at a time and blitted
+                 on top of the last
+        """
+        width, height = self.world.tile_width, self.world.tile_height
+        colour_indices = self._colour_indices
+        lookup = colour_indices.__getitem__
+
+        layer_images = []
+        for name in self.layers:
+            layer = self.world.layers[name]
+            data = bytearray()
+
+            # rows are often repeated or empty, and comparing lists of the same instances is quick
+            last_row = [None] * width
+            last_indices = bytearray(width)
+            for y in xrange(height):
+                row = layer[y]
+                if row != last_row:
+                    ids = map(id, row)
+                    try:
+                        last_indices = map(lookup, ids)
+                    except KeyError:
+                        colour_indices.add_row(row)
+                        last_indices = map(lookup, ids)
+                    last_row = row
+                data.extend(last_indices)
+            layer_images.append(pygame.image.fromstring(str(data), (width, height), "P"))
+
+        image = pygame.Surface((width, height), 0, 8)
+        image.set_palette(self._palette)
+        for layer_image in layer_images:
+            layer_image.set_palette(self._palette)
+            layer_image.set_colorkey(0)
+            image.blit(layer_image, (0, 0))
+        return image
+
+    def _on_block_change(self, x, y, block, layer):
+        if layer not in self.layers:
+            return
+
+        # the uppermost visible block shows
+        index = 0
+        for name in reversed(self.layers):
+            index = self._colour_indices.get_index(self.world.get_block(x, y, name))
+            if index:
+                break
+
+        if index >= self._image_palette_size:
+            self.image.set_palette(self._palette)
+            self._image_palette_size = len(self._palette)
+        self.image.set_at((x, y), self._palette[index])
+
+        self._scaled = None
+
+    def _get_scaled(self):
+        """
+        :return: The image scaled to fit in the corner of the screen, which is only rescaled after the image changes
+        """
+        if not self._scaled:
+            width, height = self.image.get_size()
+            scale = float(Minimap.MAX_SIZE) / max(width, height)
+            self._scaled = pygame.transform.scale(self.image.convert(), (int(width * scale), int(height * scale)))
+        return self._scaled
+
+    def _get_dot(self, entitytype):
+        dot = self._dots.get(entitytype)
+        if not dot:
+            dot = pygame.Surface((2, 2))
+            dot.fill((255, 40, 40) if entitytype == constants.EntityType.VEHICLE else (255, 255, 255))
+            self._dots[entitytype] = dot
+        return dot
+
+    def render(self):
+        """
+        Draws the minimap in the top right corner of the screen, with a dot for every entity
+        """
+        scaled = self._get_scaled()
+        x = constants.WINDOW_SIZE[0] - scaled.get_width() - Minimap.MARGIN
+        y = Minimap.MARGIN
+        constants.SCREEN.blit(scaled, (x, y))
+
+        scale_x = float(scaled.get_width()) / self.world.pixel_width
+        scale_y = float(scaled.get_height()) / self.world.pixel_height
+        dots = [(self._get_dot(e.entitytype), (x + int(e.transform.x * scale_x), y + int(e.transform.y * scale_y)))
+                for e in self.world.entities if e.visible]
+        constants.SCREEN.draw_batch(dots)
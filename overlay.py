@@ -0,0 +1,257 @@
+import pygame
+
+import constants
+import util
+
+# names of the overlays that are shown, in every world
+ENABLED = set()
+
+
+def toggle(name):
+    """
+    Shows or hides the given overlay in every world
+    """
+    if name in ENABLED:
+        ENABLED.remove(name)
+    else:
+        ENABLED.add(name)
+
+
+class DebugOverlay:
+    """
+    A debug visualisation of a world that is drawn onto a surface a little bigger than the screen, and only redrawn when
+    what it shows changes or the camera moves out of the area drawn
+    """
+
+    # tiles drawn around each side of the screen, so the camera can move a little before redrawing
+    MARGIN = 4
+
+    def __init__(self, world):
+        self.world = world
+        self.surface = None
+        self._version = None
+
+        # area of the world drawn onto the surface, in pixels
+        self._area = None
+
+    def get_version(self):
+        """
+        :return: A value that changes whenever the overlay needs to be redrawn
+        """
+        return 0
+
+    def is_available(self):
+        """
+        :return: Whether or not there is anything to show in the world
+        """
+        return True
+
+    def draw(self, surface, area):
+        """
+        Draws everything in the given area of the world onto the given transparent surface, which is the size of the area
+        and positioned at its top left
+        """
+        pass
+
+    def get_tiles(self, area):
+        """
+        :return: The tiles of the world in the given area of pixels, as x1, y1, x2, y2
+        """
+        x1, y1 = util.pixel_to_tile(area.topleft)
+        x2, y2 = util.pixel_to_tile(area.bottomright)
+        return max(0, x1), max(0, y1), min(self.world.tile_width, x2 + 1), min(self.world.tile_height, y2 + 1)
+
+    def render(self):
+        camera = constants.SCREEN.camera
+        view = pygame.Rect((int(camera.transform.x), int(camera.transform.y)), camera.view_size)
+        version = self.get_version()
+
+        if self.surface is None or version != self._version or not self._area.contains(view):
+            margin = DebugOverlay.MARGIN * constants.TILE_SIZE
+            self._area = view.inflate(margin * 2, margin * 2)
+            if self.surface is None or self.surface.get_size() != self._area.size:
+                self.surface = pygame.Surface(self._area.size, pygame.SRCALPHA, 32).convert_alpha()
+
+            self.surface.fill((0, 0, 0, 0))
+            self.draw(self.surface, self._area)
+            self._version = version
+
+        constants.SCREEN.blit(self.surface, camera.apply(self._area.topleft), volatile=True)
+
+    def release(self):
+        """
+        Frees the cached surface while hidden
+        """
+        self.surface = None
+
+
+class NavigationOverlay(DebugOverlay):
+    """
+    Nodes of the navigation graph, and its edges coloured and labelled by weight
+    """
+
+    def get_version(self):
+        return self.world.nav_graph.version
+
+    def is_available(self):
+        return self.world.nav_graph is not None
+
+    def draw(self, surface, area):
+        nav_graph = self.world.nav_graph
+        for r in nav_graph.debug_rects:
+            r = pygame.Rect(r.as_tuple())
+            if area.colliderect(r):
+                pygame.draw.rect(surface, (255, 0, 0), r.move(-area.x, -area.y), 2)
+
+        weights = [w for neighbours in nav_graph.graph.values() for _, w in neighbours]
+        if not weights:
+            return
+        min_w = min(weights)
+        max_w = max(weights)
+
+        def get_centre(tile):
+            x, y = util.tile_to_pixel(tile)
+            return x + constants.TILE_SIZE / 2 - area.x, y + constants.TILE_SIZE / 2 - area.y
+
+        for node, neighbours in nav_graph.graph.items():
+            node_pos = util.tile_to_pixel(node)
+            if area.colliderect((node_pos, constants.TILE_DIMENSION)):
+                pygame.draw.rect(surface, (0, 180, 20), ((node_pos[0] - area.x, node_pos[1] - area.y), constants.TILE_DIMENSION), 2)
+
+            node_centre = get_centre(node)
+            for n, weight in neighbours:
+                # edges crossing the area are drawn too, even without an end in it
+                edge = get_centre(n)
+                x1, x2 = sorted((node_centre[0], edge[0]))
+                y1, y2 = sorted((node_centre[1], edge[1]))
+                if not surface.get_rect().colliderect((x1, y1, x2 - x1 + 1, y2 - y1 + 1)):
+                    continue
+
+                edge_c = util.lerp_colours((0, 0, 255), (255, 0, 0), util.convert_to_range((min_w, max_w), (0, 1), weight))
+                pygame.draw.line(surface, map(int, edge_c), node_centre, edge, 1)
+
+                label = constants.SCREEN.render_string(str(weight), (255, 255, 255))
+                surface.blit(label, util.midpoint(node_centre, edge))
+
+
+class CollisionOverlay(DebugOverlay):
+    """
+    Collision rects of all solid blocks
+    """
+
+    def __init__(self, world):
+        DebugOverlay.__init__(self, world)
+        self._blocks_changed = 0
+        world.add_block_listener(self._on_block_change)
+
+    def _on_block_change(self, x, y, block, layer):
+        # blocks drawn above entities never collide
+        if not self.world.layers[layer].draw_above:
+            self._blocks_changed += 1
+
+    def get_version(self):
+        return self._blocks_changed
+
+    def draw(self, surface, area):
+        for x, y, ((rx, ry), size) in self.world.iterate_blocks(*self.get_tiles(area), layer="rects"):
+            pygame.draw.rect(surface, (255, 0, 0), ((rx - area.x, ry - area.y), size), 1)
+
+
+class RoadOverlay(DebugOverlay):
+    """
+    Lanes of every road, and the nodes of the road graph
+    """
+
+    def get_version(self):
+        return len(self.world.roadmap.nodes)
+
+    def is_available(self):
+        return hasattr(self.world, "roadmap")
+
+    def draw(self, surface, area):
+        for road in self.world.roadmap.roads:
+            for lane in road.lanes:
+                colour = (255, 255, 0) if lane.forward else (0, 255, 255)
+                start = util.tile_to_pixel(lane.start_bound.centre)
+                end = util.tile_to_pixel(lane.end_bound.centre)
+                pygame.draw.line(surface, colour, (start[0] - area.x, start[1] - area.y), (end[0] - area.x, end[1] - area.y), 2)
+
+        radius = constants.TILE_SIZE / 4
+        nodes_area = area.inflate(radius * 2, radius * 2)
+        for node in self.world.roadmap.nodes.values():
+            centre = util.tile_to_pixel(map(lambda x: x + 0.5, node.point))
+            if nodes_area.collidepoint(centre):
+                pygame.draw.circle(surface, (0, 255, 100), (int(centre[0]) - area.x, int(centre[1]) - area.y), radius)
+
+
+class EntityGridOverlay(DebugOverlay):
+    """
+    Cells of the entity grid, shaded by how many entities are in each.
+    Occupancy changes nearly every frame, so instead of redrawing a whole surface, a pre-rendered cell is drawn for
+    each occupied cell on the screen
+    """
+
+    MAX_SHADE = 4
+
+    def __init__(self, world):
+        DebugOverlay.__init__(self, world)
+        self._cells = None
+
+    def render(self):
+        grid = self.world.entity_grid
+        size = grid.cell_size
+        if not self._cells:
+            self._cells = []
+            for count in xrange(1, EntityGridOverlay.MAX_SHADE + 1):
+                cell = pygame.Surface((size, size), pygame.SRCALPHA, 32).convert_alpha()
+                cell.fill((255, 140, 0, 40 + count * 40))
+                self._cells.append(cell)
+
+        camera = constants.SCREEN.camera
+        x1 = max(0, int(camera.transform.x) / size)
+        y1 = max(0, int(camera.transform.y) / size)
+        x2 = int(camera.transform.x + camera.view_size[0]) / size + 1
+        y2 = int(camera.transform.y + camera.view_size[1]) / size + 1
+
+        for y, row in enumerate(grid.grid[y1:y2], y1):
+            for x, entities in enumerate(row[x1:x2], x1):
+                if entities:
+                    cell = self._cells[min(len(entities), EntityGridOverlay.MAX_SHADE) - 1]
+                    constants.SCREEN.draw_sprite_from_pos(cell, (x * size, y * size))
+        constants.SCREEN.flush_sprites()
+
+    def release(self):
+        self._cells = None
+
+
+# name: overlay class
+OVERLAYS = {
+    "navigation": NavigationOverlay,
+    "collisions": CollisionOverlay,
+    "roads": RoadOverlay,
+    "entity-grid": EntityGridOverlay
+}
+
+
+class OverlayManager:
+    """
+    Renders the enabled debug overlays of a world, each created the first time it is shown
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self._overlays = {}
+
+    def render(self):
+        for name, overlay in self._overlays.items():
+            if name not in ENABLED:
+                overlay.release()
+
+        for name in ENABLED:
+            overlay = self._overlays.get(name)
+            if not overlay:
+                overlay = OVERLAYS[name](self.world)
+                self._overlays[name] = overlay
+
+            if overlay.is_available():
+                overlay.render()
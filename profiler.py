@@ -0,0 +1,279 @@
+import time
+from collections import deque
+
+import pygame
+
+import constants
+
+# whether or not scopes are being timed, see toggle
+ENABLED = False
+
+# number of frames that percentiles are taken over
+FRAMES = 120
+
+# (path, start) of the scopes that are currently open
+_stack = []
+
+# path: [total seconds, calls] of the current frame
+_frame_totals = {}
+
+# path: (deque of total seconds per frame, deque of calls per frame)
+_history = {}
+
+_frame_times = deque(maxlen=FRAMES)
+_frame_count = 0
+_frame_start = None
+_overlay = None
+
+
+class _Scope:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        begin(self.name)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end()
+
+
+class _NullScope:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_SCOPE = _NullScope()
+
+# name: scope
+_scopes = {}
+
+
+def set_enabled(enabled):
+    """
+    Starts or stops timing scopes, clearing everything timed so far
+    """
+    global ENABLED, _frame_start, _frame_count, _overlay
+    ENABLED = enabled
+
+    del _stack[:]
+    _frame_totals.clear()
+    _history.clear()
+    _frame_times.clear()
+    _frame_count = 0
+    _frame_start = None
+    _overlay = None
+
+
+def toggle():
+    set_enabled(not ENABLED)
+
+
+def begin(name):
+    """
+    Opens a scope with the given name, nested inside the scope that is currently open.
+    Must be followed by end, and does nothing if disabled
+    """
+    if ENABLED:
+        path = _stack[-1][0] + "/" + name if _stack else name
+        _stack.append((path, time.time()))
+
+
+def end():
+    """
+    Closes the scope that was last opened, adding the time since it was opened to its total for this frame
+    """
+    if ENABLED and _stack:
+        path, start = _stack.pop()
+        totals = _frame_totals.get(path)
+        if totals:
+            totals[0] += time.time() - start
+            totals[1] += 1
+        else:
+            _frame_totals[path] = [time.time() - start, 1]
+
+
+def scope(name):
+    """
+    :return: A context manager that times the enclosed block as a scope, which does nothing if disabled
+    """
+    if not ENABLED:
+        return _NULL_SCOPE
+
+    s = _scopes.get(name)
+    if not s:
+        s = _scopes[name] = _Scope(name)
+    return s
+
+
+def profiled(name):
+    """
+    Decorator that times every call to the decorated function as a scope with the given name
+    """
+
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+
+            begin(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end()
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    return decorator
+
+
+def next_frame():
+    """
+    Adds the scope totals of the frame that just finished to their history, then starts timing the next frame
+    """
+    global _frame_start, _frame_count
+    if not ENABLED:
+        return
+
+    now = time.time()
+    if _frame_start is not None:
+        _frame_times.append(now - _frame_start)
+        _frame_count += 1
+
+        # scopes that weren't opened this frame took no time
+        for path in _frame_totals:
+            if path not in _history:
+                _history[path] = deque(maxlen=FRAMES), deque(maxlen=FRAMES)
+        for path, (times, calls) in _history.iteritems():
+            total, count = _frame_totals.get(path, (0, 0))
+            times.append(total)
+            calls.append(count)
+
+    _frame_totals.clear()
+    _frame_start = now
+
+
+def _percentile(values, fraction):
+    """
+    :param values: Sorted values
+    :return: The value that the given fraction of the values are less than or equal to
+    """
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def get_stats():
+    """
+    :return: List of (path, mean calls, median ms, 95th percentile ms, max ms) per frame of every scope over recent
+             frames, with each scope followed by those nested inside it
+    """
+    stats = []
+    for path, (times, calls) in _history.iteritems():
+        times = sorted(times)
+        stats.append((path, float(sum(calls)) / len(calls),
+                      _percentile(times, 0.5) * 1000, _percentile(times, 0.95) * 1000, times[-1] * 1000))
+
+    stats.sort(key=lambda s: s[0].split("/"))
+    return stats
+
+
+def get_frame_times():
+    """
+    :return: The times of recent frames in ms, oldest first
+    """
+    return [t * 1000 for t in _frame_times]
+
+
+def render():
+    """
+    Draws the profiler overlay, if enabled
+    """
+    global _overlay
+    if ENABLED:
+        if not _overlay:
+            _overlay = ProfilerOverlay()
+        _overlay.render()
+
+
+class ProfilerOverlay:
+    """
+    A table of the percentiles of every scope, above a graph of recent frame times, in the bottom right corner of the
+    screen
+    """
+
+    GRAPH_SIZE = (FRAMES * 2, 80)
+    GRAPH_MAX_MS = 50.0
+    MARGIN = 20
+    INDENT = 16
+
+    # (heading, width)
+    COLUMNS = (("calls", 70), ("p50", 70), ("p95", 70), ("max", 70))
+    NAME_WIDTH = 300
+
+    def __init__(self):
+        self.graph = pygame.Surface(ProfilerOverlay.GRAPH_SIZE, 0, 32)
+        self.graph.fill((0, 0, 0))
+        self._graphed_count = 0
+
+    def _update_graph(self):
+        """
+        Scrolls the graph along by the frames since it was last updated, drawing a bar for each
+        """
+        frame_times = get_frame_times()
+        new_frames = min(len(frame_times), _frame_count - self._graphed_count)
+        self._graphed_count = _frame_count
+
+        width, height = ProfilerOverlay.GRAPH_SIZE
+        bar_width = width / FRAMES
+        for ms in frame_times[len(frame_times) - new_frames:]:
+            self.graph.scroll(-bar_width, 0)
+            self.graph.fill((0, 0, 0), (width - bar_width, 0, bar_width, height))
+
+            if ms < 1000 / 60.:
+                colour = (40, 200, 40)
+            elif ms < 1000 / 30.:
+                colour = (220, 200, 40)
+            else:
+                colour = (220, 40, 40)
+
+            bar_height = int(min(1, ms / ProfilerOverlay.GRAPH_MAX_MS) * height)
+            self.graph.fill(colour, (width - bar_width, height - bar_height, bar_width, bar_height))
+
+        # 60 fps
+        target_y = height - int(1000 / 60. / ProfilerOverlay.GRAPH_MAX_MS * height)
+        pygame.draw.line(self.graph, (120, 120, 120), (0, target_y), (width, target_y))
+
+    def render(self):
+        self._update_graph()
+
+        screen = constants.SCREEN
+        margin = ProfilerOverlay.MARGIN
+        line_height = screen.font.get_linesize()
+        stats = get_stats()
+
+        table_width = ProfilerOverlay.NAME_WIDTH + sum(w for _, w in ProfilerOverlay.COLUMNS)
+        x = constants.WINDOW_SIZE[0] - table_width - margin
+        graph_y = constants.WINDOW_SIZE[1] - ProfilerOverlay.GRAPH_SIZE[1] - margin
+        y = graph_y - (len(stats) + 1) * line_height - margin / 2
+        screen.blit(self.graph, (constants.WINDOW_SIZE[0] - ProfilerOverlay.GRAPH_SIZE[0] - margin, graph_y), volatile=True)
+
+        colour = (255, 255, 255)
+        column_x = x + ProfilerOverlay.NAME_WIDTH
+        for heading, width in ProfilerOverlay.COLUMNS:
+            screen.draw_string(heading, (column_x, y), colour)
+            column_x += width
+
+        # numbers are drawn separately from names, so they are composed from cached glyphs
+        for path, calls, p50, p95, max_ms in stats:
+            y += line_height
+            names = path.split("/")
+            screen.draw_string(names[-1], (x + (len(names) - 1) * ProfilerOverlay.INDENT, y), colour)
+
+            column_x = x + ProfilerOverlay.NAME_WIDTH
+            for value, (_, width) in zip(("%.1f" % calls, "%.2f" % p50, "%.2f" % p95, "%.2f" % max_ms),
+                                         ProfilerOverlay.COLUMNS):
+                screen.draw_string(value, (column_x, y), colour)
+                column_x += width
@@ -22,11 +22,21 @@ class Transition:
         :param tick_count: Number of times to tick
         """
         self.duration = duration
-        self._ticker = util.TimeTicker(float(duration) / tick_count)
+        self._timer = constants.TIMERS.schedule(float(duration) / tick_count, self._step, repeat=True)
         self.complete = False
         if not Transition.SCREEN_COVER:
             Transition.SCREEN_COVER = pygame.Surface(constants.WINDOW_SIZE).convert_alpha()
 
+    def _step(self):
+        """
+        Called at regular intervals until complete
+        """
+        raise NotImplemented("Empty transition")
+
+    def finish(self):
+        self.complete = True
+        self._timer.cancel()
+
     def tick(self):
         """
         Called per frame
@@ -43,15 +53,15 @@ class FadeTransition(Transition):
         Transition.__init__(self)
         self.alpha = 255
 
-    def tick(self):
-        if self._ticker.tick():
-            self.alpha -= 15
-            if self.alpha < 0:
-                self.alpha = 0
-                self.complete = True
+    def _step(self):
+        self.alpha -= 15
+        if self.alpha < 0:
+            self.alpha = 0
+            self.finish()
 
+    def tick(self):
         Transition.SCREEN_COVER.fill((State.BACKGROUND + (self.alpha,)))
-        constants.SCREEN.blit(Transition.SCREEN_COVER)
+        constants.SCREEN.blit(Transition.SCREEN_COVER, volatile=True)
 
 
 class ZoomTransition(Transition):
@@ -65,16 +75,16 @@ class ZoomTransition(Transition):
         self.dim = (constants.WINDOW_SIZE[0] / scale, constants.WINDOW_SIZE[1] / scale)
         self.space = util.Rect(constants.WINDOW_CENTRE, self.dim)
 
-    def tick(self):
-        if self._ticker.tick():
-            if self.space.width > constants.WINDOW_SIZE[0]:
-                self.complete = True
+    def _step(self):
+        if self.space.width > constants.WINDOW_SIZE[0]:
+            self.finish()
 
-            self.space.inflate(*self.dim)
+        self.space.inflate(*self.dim)
 
+    def tick(self):
         Transition.SCREEN_COVER.fill(State.BACKGROUND)
         pygame.draw.rect(Transition.SCREEN_COVER, (0, 0, 0, 0), self.space.as_tuple())
-        constants.SCREEN.blit(Transition.SCREEN_COVER)
+        constants.SCREEN.blit(Transition.SCREEN_COVER, volatile=True)
 
 
 class StateManager:
@@ -86,6 +96,9 @@ class StateManager:
         self._stack = util.Stack()
         self.transition = None
         self.controller = ai.InputController()
+        self.ai_scheduler = ai.AIScheduler()
+
+        event_module.BUS.subscribe(event_module.BuildingMovementEvent, self._on_building_movement)
 
     def change_state(self, new_state=None, transition_cls=None):
         """
@@ -97,6 +110,9 @@ class StateManager:
         if transition_cls is None:
             transition_cls = ZoomTransition if random.random() < 1.0 else FadeTransition
 
+        if self.transition:
+            self.transition.finish()
+
         try:
             self.transition = transition_cls()
         except TypeError:
@@ -121,22 +137,15 @@ class StateManager:
         # mouse visibility
         pygame.mouse.set_visible(current.mouse_visible)
 
-    def handle_user_event(self, e):
+    def _on_building_movement(self, e):
         """
-        Handles custom events, called from event.py
-
-        :param e: pygame event
+        :param e: event.BuildingMovementEvent
         """
+        # prevent world transfer flicker
+        e.entity.visible = True
 
-        if hasattr(e, "entity"):
-            # prevent world transfer flicker
-            e.entity.visible = True
-
-            if e.entity == self.controller.entity:
-                # building enter/exit
-                if hasattr(e, "building"):
-                    building = e.building if e.eventtype == event_module.BUILDING_ENTER else None
-                    self.switch_to_building(building)
+        if e.entity == self.controller.entity:
+            self.switch_to_building(e.building if e.entered else None)
 
     def switch_to_building(self, building):
         """
@@ -180,6 +189,19 @@ class StateManager:
     def is_controlling(self, an_entity):
         return self.controller.entity == an_entity
 
+    def get_debug_lines(self):
+        """
+        :return: Lines of text to show in the debug overlay
+        """
+        lines = constants.SCREEN.get_debug_lines()
+        lines.extend(self.ai_scheduler.get_debug_lines())
+
+        current = self.get_current()
+        if isinstance(current, OutsideWorldState):
+            lines.extend(current.world.traffic.get_debug_lines())
+
+        return lines
+
 
 class State:
     """
@@ -235,7 +257,9 @@ class BaseGameState(State):
         constants.SCREEN.camera.centre()
 
     def tick(self):
-        for w in world_module.WORLDS:
+        constants.STATEMANAGER.ai_scheduler.begin_frame()
+        # interiors may be created or released while ticking
+        for w in tuple(world_module.WORLDS):
             w.tick(render=(w == self.world))
         constants.STATEMANAGER.controller.tick()
 
@@ -250,14 +274,17 @@ class OutsideWorldState(BaseGameState):
 
     def __init__(self):
         BaseGameState.__init__(self)
-        self.building_timer = util.TimeTicker((0.5, 2))
+
+        # todo temporary building action
+        if constants.CONFIG["game.buildings.strobe-lights"]:
+            constants.TIMERS.schedule((0.5, 2), self._strobe_lights, repeat=True)
 
         # load entities
         entity.EntityLoader.load_all()
 
         # load main world, with all buildings
         self.world = world_module.World.load_tmx("world.tmx")
-        constants.LOGGER.info("Loaded %d worlds" % len(world_module.WORLDS))
+        constants.LOGGER.info("Loaded %d worlds and %d building interiors" % (len(world_module.WORLDS), world_module.InteriorTemplate.count()))
 
         constants.SCREEN.set_camera_world(self.world)
         constants.STATEMANAGER.controller.set_camera(constants.SCREEN.camera)
@@ -273,22 +300,24 @@ class OutsideWorldState(BaseGameState):
         for _ in xrange(constants.CONFIG["game.vehicles.spawn-count"]):
             entity.create_entity(self.world, constants.EntityType.VEHICLE)
 
+        # add some traffic
+        for _ in xrange(constants.CONFIG["game.vehicles.traffic-count"]):
+            vehicle = entity.create_entity(self.world, constants.EntityType.VEHICLE)
+            if not self.world.traffic.spawn(vehicle):
+                vehicle.kill()
+                break
+
         # centre on a random entity
         constants.SCREEN.camera.centre(random.choice(self.world.entity_buffer.keys()).transform)
 
         # move mouse to centre
         pygame.mouse.set_pos(constants.WINDOW_CENTRE)
 
-    def tick(self):
-        BaseGameState.tick(self)
-
-        # todo temporary building action
-        if constants.CONFIG["game.buildings.strobe-lights"]:
-            if self.building_timer.tick():
-                for w in (x for x in world_module.WORLDS if isinstance(x, world_module.World)):
-                    for b in w.buildings:
-                        window, active = random.choice(b.windows.items())
-                        b.set_window(window, not active)
+    @staticmethod
+    def _strobe_lights():
+        for w in (x for x in world_module.WORLDS if isinstance(x, world_module.World)):
+            changes = (b.toggle_random_window() for b in w.buildings)
+            w.set_blocks([c for c in changes if c], layer="overterrain")
 
 
 class BuildingState(BaseGameState):
@@ -299,4 +328,4 @@ class BuildingState(BaseGameState):
     def __init__(self, building):
         BaseGameState.__init__(self)
         self.building = building
-        self.world = building.inside
+        self.world = building.get_inside()
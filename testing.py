@@ -1,7 +1,24 @@
+import heapq
 import inspect
+import random
 
+import pygame
+
+import ai
 from ai import BaseController
+import animation
+import benchmark
+import citygen
+import constants
 from constants import *
+import core
+import entity
+import event
+import lighting
+import overlay
+import profiler
+import traffic
+import world
 
 
 def assert_equal(x, y):
@@ -17,6 +34,47 @@ def assert_true(x):
 def assert_false(x):
     assert_equal(x, False)
 
+
+def get_components(nodes, get_neighbours):
+    """
+    :return: Dict of node: lowest node in the same connected component
+    """
+    components = {}
+    for n in sorted(nodes):
+        if n not in components:
+            components[n] = n
+            stack = [n]
+            while stack:
+                for other in get_neighbours(stack.pop()):
+                    if other not in components:
+                        components[other] = n
+                        stack.append(other)
+    return components
+
+
+def get_pavement_groups(nav_graph, walk):
+    """
+    :param walk: If True, pavement tiles are grouped by flood filling all walkable tiles, otherwise by the nodes of the
+                 navigation graph that they can reach
+    :return: Set of groups of pavement tiles that are connected to each other
+    """
+    if walk:
+        weights = nav_graph._weights
+        walkable = set((x, y) for y, row in enumerate(weights) for x, w in enumerate(row) if w is not None)
+        components = get_components(walkable, lambda (x, y): [t for t in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1))
+                                                               if t in walkable])
+    else:
+        graph = nav_graph.graph
+        components = get_components(graph, lambda n: [other for other, _ in graph[n]])
+
+    groups = {}
+    for y, row in enumerate(nav_graph._rect_grid):
+        for x, rect_id in enumerate(row):
+            if rect_id is not None:
+                key = components[(x, y) if walk else nav_graph._find_nearest_node((x, y))]
+                groups.setdefault(key, set()).add((x, y))
+    return set(frozenset(g) for g in groups.values())
+
 # direction opposites
 assert_equal(Direction.opposite(Direction.NORTH), Direction.SOUTH)
 assert_equal(Direction.opposite(Direction.SOUTH), Direction.NORTH)
@@ -94,4 +152,532 @@ assert_false(heap.empty())
 assert_equal(map(int, util.lerp_colours((0, 0, 0), (255, 255, 255), 0.5)), [127, 127, 127])
 assert_equal(map(int, util.lerp_colours((255, 255, 255), (0, 0, 0), 0.5)), [127, 127, 127])
 
+# event bus
+bus = event.EventBus()
+received = []
+bus.subscribe(event.Event, lambda e: received.append(("any", e)))
+bus.subscribe(event.BuildingMovementEvent, lambda e: received.append(("building", e)))
+
+movement = event.BuildingMovementEvent(None, None, True)
+bus.publish(movement)
+assert_equal(received, [])
+bus.dispatch(0)
+assert_equal(received, [("building", movement), ("any", movement)])
+
+del received[:]
+bus.publish(movement, delay=1)
+bus.dispatch(0.5)
+assert_equal(received, [])
+bus.dispatch(0.5)
+assert_equal(len(received), 2)
+
+# timer wheel
+wheel = util.TimerWheel(resolution=0.1)
+fired = []
+wheel.schedule(0.25, lambda: fired.append(("once", wheel.ticks)))
+repeating = wheel.schedule(0.1, lambda: fired.append(("repeat", wheel.ticks)), repeat=True)
+wheel.schedule(1000, lambda: fired.append(("far", wheel.ticks)))
+wheel.schedule(5, lambda: fired.append(("cancelled", wheel.ticks))).cancel()
+
+wheel.advance(0.35)
+assert_equal(fired, [("repeat", 1), ("repeat", 2), ("once", 3), ("repeat", 3)])
+
+repeating.cancel()
+del fired[:]
+wheel.advance(999.7)
+assert_equal(fired, [("far", 10000)])
+
+# worlds
+benchmark.setup()
+
+# path finding, where a node is reached more cheaply while still in the frontier
+nav_graph = ai.NavigationGraph(world.World(4, 4))
+nav_graph.graph = {
+    (3, 2): {((2, 1), 9), ((1, 3), 1), ((0, 2), 8)},
+    (1, 3): {((2, 1), 1), ((3, 2), 1), ((0, 2), 3)},
+    (0, 2): {((3, 2), 8), ((1, 3), 3)},
+    (2, 1): {((1, 3), 1), ((3, 2), 9)}
+}
+assert_equal(nav_graph._find_path((3, 2), (2, 1)), [(3, 2), (1, 3), (2, 1)])
+
+# worlds are only rendered once they are shown, so can be wider than a single surface
+wide_world = world.World(600, 4)
+wide_world.post_load()
+assert_equal(wide_world.renderer, None)
+
+small_world = world.World(4, 4)
+small_world.post_load()
+assert_true(small_world.get_renderer() is small_world.get_renderer())
+
+# the navigation graph connects pavement tiles exactly when they can be walked between
+tmx_world = world.World.load_tmx("world.tmx")
+nav_graph = tmx_world.nav_graph
+assert_equal(get_pavement_groups(nav_graph, False), get_pavement_groups(nav_graph, True))
+assert_equal(sum(map(len, get_pavement_groups(nav_graph, False))), 676)
+
+# the nearest node to a tile shares its rectangle, or is in the nearest rectangle
+for x, y, block in tmx_world.iterate_blocks():
+    node = nav_graph._find_nearest_node((x, y))
+    rect_id = nav_graph._rect_grid[y][x]
+    if rect_id is not None:
+        assert_true(nav_graph._rects[rect_id].collidepoint(node))
+    assert_true(node in nav_graph.graph)
+
+# paths are the cheapest through the graph
+def get_path_cost(graph, path):
+    return sum(dict(graph[a])[b] for a, b in zip(path, path[1:]))
+
+nodes = sorted(nav_graph.graph)
+start = nodes[0]
+cheapest = {start: 0}
+frontier = [(0, start)]
+while frontier:
+    cost, node = heapq.heappop(frontier)
+    for other, weight in nav_graph.graph[node]:
+        if other not in cheapest or cost + weight < cheapest[other]:
+            cheapest[other] = cost + weight
+            heapq.heappush(frontier, (cost + weight, other))
+
+for goal in nodes[1:]:
+    assert_equal(get_path_cost(nav_graph.graph, nav_graph._find_path(start, goal)), cheapest[goal])
+
+# following a flow field from a tile that can't reach the destination fails, without walking to an old target
+entity.EntityLoader.load_all()
+human = entity.create_entity(tmx_world, EntityType.HUMAN)
+human.move_entity_to_tile((0, 0))
+tree = human.controller.behaviour_tree
+tree.blackboard["target"] = util.tile_to_pixel((5, 5))
+human.controller.flow_to_goal((20, 10))
+assert_false("target" in tree.blackboard)
+tree.tick()
+assert_true(tree.get_root() is ai.WANDER_TREE)
+
+# and from the destination succeeds straight away, without stepping off it
+human.move_entity_to_tile((20, 10))
+human.controller.flow_to_goal((20, 10))
+tree.tick()
+assert_true(tree.get_root() is ai.WANDER_TREE)
+assert_equal(human.get_current_tile(), (20, 10))
+assert_equal(tree.blackboard["field"], None)
+
+# ai scheduling, with a far away human that doesn't steer
+class CountTicks(ai.Action):
+    def process(self, tree):
+        tree.blackboard["ticks"] = tree.blackboard.get("ticks", 0) + 1
+        return ai.Task.RUNNING
+
+scheduler = ai.AIScheduler()
+controller = human.controller
+tree.set_root(ai.CompiledTree(CountTicks()))
+controller.ai_frames_waited = 0
+
+
+def schedule_frames(frames, used=0):
+    """
+    :param used: Seconds of the budget already used each frame
+    :return: Number of times the behaviour tree was ticked
+    """
+    ticks = tree.blackboard.get("ticks", 0)
+    for _ in xrange(frames):
+        scheduler.begin_frame()
+        scheduler._used = used
+        scheduler.tick(controller)
+    return tree.blackboard["ticks"] - ticks
+
+# decisions are only made every few frames
+assert_equal(schedule_frames(scheduler.far_interval * 3), 3)
+
+# over budget, decisions are put off until the entity has waited too long
+assert_equal(schedule_frames(scheduler.max_wait - 1, scheduler.budget), 0)
+assert_equal(schedule_frames(1, scheduler.budget), 1)
+assert_equal(scheduler._stats["forced"], 1)
+
+# steering entities are ticked every frame, even over budget, until their tree is changed
+controller.steering = True
+assert_equal(schedule_frames(5, scheduler.budget), 5)
+tree.set_root(ai.WANDER_TREE)
+assert_false(controller.steering)
+
+# a walk that is ticked after waiting only arrives if it is within a frame's movement of its target
+frame_delta = constants.DELTA
+constants.DELTA = 1 / 60.
+human.move_entity_to_tile((20, 10))
+tree.set_root(ai.CompiledTree(ai.HumanWalkToLocation()))
+tree.blackboard["target"] = (21 * constants.TILE_SIZE, 10 * constants.TILE_SIZE)
+for _ in xrange(scheduler.max_wait):
+    scheduler.begin_frame()
+    scheduler._used = scheduler.budget
+    scheduler.tick(controller)
+assert_equal(scheduler._stats["forced"], 1)
+assert_equal(human.get_current_tile(), (20, 10))
+assert_true(controller.steering)
+constants.DELTA = frame_delta
+tree.set_root(ai.WANDER_TREE)
+
+# crowd avoidance pushes humans apart, apart from the one being controlled
+crowd_world = world.World(8, 8)
+crowd_world.add_spawn(EntityType.HUMAN, 0, 0, "S")
+player = entity.create_entity(crowd_world, EntityType.HUMAN)
+npc = entity.create_entity(crowd_world, EntityType.HUMAN)
+crowd_world.tick_entities(False)
+player.move_entity((100, 100))
+npc.move_entity((108, 100))
+player.controller.suppress_ai(True)
+ai.CrowdAvoidance(crowd_world).tick()
+assert_equal(player.avoidance, (0, 0))
+assert_true(npc.avoidance.x > 0)
+
+# compiled behaviour trees call their actions in the same order as the tasks they were compiled from did
+class Script(ai.Action):
+    """
+    Returns each of the given results in turn, recording every call in the blackboard
+    """
+
+    def __init__(self, name, *results):
+        ai.Action.__init__(self)
+        self.name = name
+        self.results = results
+
+    def init(self, tree):
+        tree.blackboard.setdefault("calls", []).append("init " + self.name)
+
+    def end(self, tree):
+        tree.blackboard.setdefault("calls", []).append("end " + self.name)
+
+    def process(self, tree):
+        calls = tree.blackboard.setdefault("calls", [])
+        calls.append("process " + self.name)
+        return self.results[min(calls.count("process " + self.name), len(self.results)) - 1]
+
+
+def run_tree(compiled, ticks):
+    """
+    :return: The calls made to the actions of the given compiled tree, and whether or not it has finished
+    """
+    script_tree = ai.BehaviourTree(controller, compiled)
+    for _ in xrange(ticks):
+        script_tree.tick()
+    return script_tree.blackboard["calls"], script_tree._finished
+
+R, F, S = ai.Task.RUNNING, ai.Task.FAILURE, ai.Task.SUCCESS
+
+assert_equal(run_tree(ai.CompiledTree(ai.Sequence(Script("a", R, S), Script("b", S))), 3),
+             (["init a", "process a", "process a", "end a", "init b", "process b", "end b"], True))
+assert_equal(run_tree(ai.CompiledTree(ai.Sequence(Script("a", F), Script("b", S))), 1), (["init a", "process a"], True))
+
+assert_equal(run_tree(ai.CompiledTree(ai.Selector(Script("a", F), Script("b", R, S))), 1),
+             (["init a", "process a", "end a", "init b"], False))
+assert_equal(run_tree(ai.CompiledTree(ai.Selector(Script("a", F), Script("b", R, S))), 3),
+             (["init a", "process a", "end a", "init b", "process b", "process b"], True))
+
+repeater = ai.CompiledTree(ai.Repeater(Script("a", S), 2))
+assert_equal(run_tree(repeater, 2), (["init a", "process a", "end a", "init a", "process a"], True))
+
+# moving on to the next child of a selector is still running. It used to return None, which an inverter above it
+# took as a failure, and so succeeded
+inverted = ai.CompiledTree(ai.Inverter(ai.Selector(Script("a", F), Script("b", F))))
+assert_equal(run_tree(inverted, 1)[1], False)
+assert_equal(run_tree(inverted, 2), (["init a", "process a", "end a", "init b", "process b", "end b"], True))
+
+# repeat counts are kept by each entity, not shared through the tree
+run_tree(repeater, 1)
+assert_equal(run_tree(repeater, 1)[1], False)
+
+# paths are followed from corner to corner, a tile at a time
+path = [(0, 0), (1, 0), (2, 0), (2, 0), (2, 1), (2, 2), (4, 2)]
+corners = ai.NavigationGraph._corners_only(path)
+assert_equal(corners, [(0, 0), (2, 0), (2, 2), (4, 2)])
+
+walking_path = tmx_world.nav_graph.find_walking_path((1, 8), (50, 30))
+assert_equal((walking_path[0], walking_path[-1]), ((1, 8), (50, 30)))
+assert_equal(ai.NavigationGraph._corners_only(walking_path), walking_path)
+
+ai.HumanFollowPath.retarget(tree, corners)
+assert_equal((tree.blackboard["corner"], tree.blackboard["target_tile"]), (0, (0, 0)))
+assert_equal(tree.blackboard["target"], util.tile_to_pixel((0, 0)))
+
+walked = []
+next_tile = ai.HumanFollowPath._next_tile(tree.blackboard)
+while next_tile:
+    walked.append(next_tile)
+    tree.blackboard["target_tile"] = next_tile
+    next_tile = ai.HumanFollowPath._next_tile(tree.blackboard)
+assert_equal(walked, [(1, 0), (2, 0), (2, 1), (2, 2), (3, 2), (4, 2)])
+
+# retargeting part way along starts again from the first corner of the new path
+ai.HumanFollowPath.retarget(tree, [(4, 2), (4, 0)])
+assert_equal(ai.HumanFollowPath._next_tile(tree.blackboard), (4, 1))
+assert_equal(tree.blackboard["corner"], 1)
+
+# the navigation graph is repaired after terrain changes as if it were built again from scratch
+repair_world = world.World.load_tmx("world.tmx")
+nav_graph = repair_world.nav_graph
+rand = random.Random(5)
+blocktypes = (world.BlockType.PAVEMENT, world.BlockType.ROAD, world.BlockType.GRASS, world.BlockType.SAND)
+for _ in xrange(400):
+    repair_world.set_block_type(rand.randrange(repair_world.tile_width), rand.randrange(repair_world.tile_height),
+                                rand.choice(blocktypes))
+
+rebuilt = ai.NavigationGraph(repair_world)
+rebuilt.generate_graph(world.BlockType.PAVEMENT, {world.BlockType.ROAD: 5, world.BlockType.SAND: 20})
+assert_equal(nav_graph._weights, rebuilt._weights)
+
+# every pavement tile is in exactly one rectangle, which only holds pavement
+covered = set()
+for rect_id, rect in nav_graph._rects.items():
+    for x, y, block in repair_world.iterate_rectangle(rect):
+        assert_equal(block.blocktype, world.BlockType.PAVEMENT)
+        assert_equal(nav_graph._rect_grid[y][x], rect_id)
+        covered.add((x, y))
+assert_equal(covered, set((x, y) for x, y, b in repair_world.iterate_blocks() if b.blocktype == world.BlockType.PAVEMENT))
+assert_equal(set(nav_graph.graph), set(nav_graph._node_owners))
+
+# the same nodes connected from scratch have the same edges
+rebuilt._connect_nodes(set(nav_graph.graph))
+assert_equal(nav_graph.graph, rebuilt.graph)
+
+# roads are discovered from the start of the road in the world, as they were before searching runs of road tiles
+roadmap = world.RoadMap(tmx_world)
+roadmap.begin_discovery((0, 7))
+assert_equal([(road.line, tuple(road.road_direction), road.length, road.end_line) for road in roadmap.roads], [
+    ([(0, 7), (0, 8), (0, 9), (0, 10)], (1, 0), 29, ((29, 7), (29, 8), (29, 9), (29, 10))),
+    ([(14, 11), (15, 11)], (0, 1), 10, ((14, 21), (15, 21))),
+    ([(21, 6), (22, 6), (23, 6), (24, 6)], (0, -1), 6, ((21, 0), (22, 0), (23, 0), (24, 0)))
+])
+
+# lane routes run from the start node to the destination along the edges of the lane graph
+roadmap = tmx_world.roadmap
+road_nodes = sorted(roadmap.nodes.values(), key=lambda n: n.id)
+routes = {}
+for src in road_nodes:
+    for dest in road_nodes:
+        route = roadmap.find_route(src, dest)
+        routes[src, dest] = route
+        if route is not None:
+            assert_equal((route[0], route[-1]), (src, dest))
+            assert_true(all(b in a.edges for a, b in zip(route, route[1:])))
+assert_true(any(route is None for route in routes.values()))
+
+# cached routes are copies, so changing one doesn't change the cache
+src, dest = next(key for key, route in routes.items() if route and len(route) > 2)
+roadmap.find_route(src, dest).pop()
+assert_equal(roadmap.find_route(src, dest), routes[src, dest])
+
+# only the most recently used routes are kept
+assert_equal(len(roadmap._routes), world.RoadMap.ROUTE_CACHE_SIZE)
+assert_equal(next(reversed(roadmap._routes)), (src.id, dest.id))
+
+# and all are dropped when the graph is built again, as its nodes are replaced
+roadmap.build_graph()
+assert_equal(len(roadmap._routes), 0)
+assert_false(any(node in road_nodes for node in roadmap.nodes.values()))
+
+# the nearest node to a road tile is on the lane covering it
+for tile in roadmap._tile_roads:
+    node = roadmap.get_nearest_node(tile)
+    assert_true(node in roadmap.get_road(tile).get_lane(tile).nodes)
+assert_equal(roadmap.get_nearest_node((0, 0)), None)
+
+# cars never drive into or past the car in front of them on the same track
+random.seed(2)
+cars = traffic.Traffic(roadmap)
+for _ in xrange(30):
+    cars.spawn()
+assert_true(len(cars.cars) > 10)
+
+for _ in xrange(1000):
+    cars.step(traffic.Traffic.MAX_TIME_STEP)
+    for track in cars._tracks.values():
+        assert_true(all(b - a >= cars.car_length for a, b in zip(track.positions, track.positions[1:])))
+
+# cars that reach the end of their track move onto the next track of their route
+cars = traffic.Traffic(roadmap)
+car = cars.spawn()
+while car.next_track is None:
+    cars.remove(car)
+    car = cars.spawn()
+
+track, next_track, exit_index = car.track, car.next_track, car.exit_index
+car.track.positions[car.track.cars.index(car)] = car.exit_position
+cars._leave_track(car, 10., traffic.Traffic.MAX_TIME_STEP)
+assert_true(car.track is next_track)
+assert_false(car in track.cars)
+assert_equal(next_track.positions[next_track.cars.index(car)], next_track.position_of(car.route[exit_index + 1]) + 10)
+assert_true(car.exit_index > exit_index)
+
+# cloned sprite sheets have an atlas of their own, holding the same frames
+def get_pixels(frame):
+    surface, area = frame
+    return pygame.image.tostring(surface.subsurface(area), "RGBA")
+
+car_sheet = animation.get("car")
+car_clone = animation.clone(car_sheet)
+shared_surfaces = [atlas.surface for atlas in animation.SpriteAtlas.SHARED]
+assert_false(car_clone.atlas.surface in shared_surfaces)
+for sequence, cloned_sequence in zip(car_sheet.sprites, car_clone.sprites):
+    assert_true(all(surface is car_clone.atlas.surface for surface, area in cloned_sequence))
+    assert_equal(map(get_pixels, cloned_sequence), map(get_pixels, sequence))
+
+# so recolouring a clone leaves the shared frames alone
+shared_pixels = [pygame.image.tostring(surface, "RGBA") for surface in shared_surfaces]
+car_clone.set_colour((255, 0, 0))
+assert_false(map(get_pixels, car_clone.sprites[0]) == map(get_pixels, car_sheet.sprites[0]))
+assert_equal([pygame.image.tostring(surface, "RGBA") for surface in shared_surfaces], shared_pixels)
+
+# frames go into a new shared atlas once the last one is full
+shared_atlases = animation.SpriteAtlas.SHARED
+animation.SpriteAtlas.SHARED = [animation.SpriteAtlas((32, 32))]
+frame_surface = pygame.Surface((32, 32))
+assert_equal(animation.SpriteAtlas.add_shared(frame_surface)[0], animation.SpriteAtlas.SHARED[0].surface)
+frame = animation.SpriteAtlas.add_shared(frame_surface)
+assert_equal(len(animation.SpriteAtlas.SHARED), 2)
+assert_equal(frame, (animation.SpriteAtlas.SHARED[1].surface, pygame.Rect(0, 0, 32, 32)))
+animation.SpriteAtlas.SHARED = shared_atlases
+
+# rendered strings are cached until they are the least recently used
+text_cache_size = GameScreen.TEXT_CACHE_SIZE
+GameScreen.TEXT_CACHE_SIZE = 2
+SCREEN._text_cache.clear()
+rendered = SCREEN.render_string("a", (255, 0, 0))
+SCREEN.render_string("b", (255, 0, 0))
+SCREEN.render_string("a", (255, 0, 0))
+SCREEN.render_string("c", (255, 0, 0))
+assert_equal([key[0] for key in SCREEN._text_cache], ["a", "c"])
+assert_true(SCREEN.render_string("a", (255, 0, 0)) is rendered)
+GameScreen.TEXT_CACHE_SIZE = text_cache_size
+
+# numbers are drawn glyph by glyph, each as wide as the char rendered on its own
+SCREEN.begin_recording()
+SCREEN.draw_string("-12.5", (10, 20))
+(func, (batch, flags)), = SCREEN._recorded
+SCREEN._recorded = None
+widths = [SCREEN.font.size(c)[0] for c in "-12.5"]
+assert_equal([pos for surface, pos, area in batch], [(10 + sum(widths[:i]), 20) for i in xrange(5)])
+assert_equal([area.width for surface, pos, area in batch], widths)
+
+# overlays only draw the part of the world around the screen, until the camera moves out of it
+SCREEN.set_camera_world(tmx_world)
+camera = SCREEN.camera
+nav_overlay = overlay.NavigationOverlay(tmx_world)
+nav_overlay.render()
+margin = overlay.DebugOverlay.MARGIN * TILE_SIZE
+assert_equal(nav_overlay.surface.get_size(), (camera.view_size[0] + margin * 2, camera.view_size[1] + margin * 2))
+assert_equal(nav_overlay._area.topleft, (-margin, -margin))
+
+camera.transform.x += margin
+nav_overlay.render()
+assert_equal(nav_overlay._area.topleft, (-margin, -margin))
+
+camera.transform.x += 1
+nav_overlay.render()
+assert_equal(nav_overlay._area.topleft, (1, -margin))
+
+# lights are only recomposed and upscaled around the screen
+camera.transform.x = camera.transform.y = 0
+light_map = lighting.LightMap(tmx_world)
+light_map.render()
+upscaled_area = light_map._upscaled_area
+assert_equal(light_map._upscaled.get_size(), (upscaled_area.width * lighting.LightMap.SCALE,
+                                              upscaled_area.height * lighting.LightMap.SCALE))
+assert_true(upscaled_area.width < tmx_world.pixel_width / lighting.LightMap.SCALE)
+
+chunk_size = light_map._chunk_pixels / lighting.LightMap.SCALE
+assert_true(len(light_map._dirty) > 0)
+for x, y in light_map._dirty:
+    assert_false(upscaled_area.colliderect((x * chunk_size, y * chunk_size, chunk_size, chunk_size)))
+
+# the minimap shows the uppermost visible block of a tile when it changes, where invisible blocks are empty
+mini = tmx_world.minimap
+blank = world.Block.HELPER.get_shared_instance(world.BlockType.BLANK)
+assert_equal(mini.get_palette_index(blank.render_id), 0)
+
+x, y = 1, 1
+tmx_world.set_block(x, y, blank, "objects")
+tmx_world.set_block(x, y, blank, "overterrain")
+tmx_world.set_block_type(x, y, world.BlockType.SAND, "terrain")
+sand_index = mini._colour_indices.get_index(tmx_world.get_block(x, y))
+assert_equal(mini.image.get_at_mapped((x, y)), sand_index)
+assert_equal(mini.image.get_at((x, y))[:3], mini._palette[sand_index])
+
+tmx_world.set_block_type(x, y, world.BlockType.TREE, "objects")
+tree_index = mini._colour_indices.get_index(tmx_world.get_block(x, y, "objects"))
+assert_false(tree_index == sand_index)
+assert_equal(mini.image.get_at_mapped((x, y)), tree_index)
+
+tmx_world.set_block(x, y, blank, "objects")
+assert_equal(mini.image.get_at_mapped((x, y)), sand_index)
+
+# surfaces drawn on in place are copied when recorded, so frames show them as they were
+SCREEN.begin_recording()
+volatile = pygame.Surface((4, 4), 0, 32)
+volatile.fill((255, 0, 0))
+SCREEN.blit(volatile, (-2, -2), volatile=True)
+volatile.fill((0, 255, 0))
+(func, (copied, pos, area, flags)), = SCREEN._recorded
+SCREEN._recorded = None
+assert_equal((copied.get_size(), pos), ((1, 1), (0, 0)))
+assert_equal(copied.get_at((0, 0)), (255, 0, 0, 255))
+
+# the time spent simulating while the last frame was drawn
+def get_intervals(rand, count):
+    intervals = []
+    end = 0
+    for _ in xrange(count):
+        start = end + rand.random()
+        end = start + rand.random()
+        intervals.append((start, end))
+    return intervals
+
+timings = core.FrameTimings()
+rand = random.Random(3)
+timings.simulating.extend(get_intervals(rand, 60))
+timings.drawing.extend(get_intervals(rand, 60))
+overlap, total = timings.get_overlap()
+assert_equal(round(total, 9), round(sum(end - start for start, end in timings.simulating), 9))
+assert_equal(round(overlap, 9), round(sum(max(0, min(draw_end, sim_end) - max(draw_start, sim_start))
+                                          for sim_start, sim_end in timings.simulating
+                                          for draw_start, draw_end in timings.drawing), 9))
+
+# profiler scopes are timed per frame, with each scope followed by those nested inside it
+profiler.set_enabled(True)
+profiler.next_frame()
+for _ in xrange(2):
+    with profiler.scope("b"):
+        pass
+    with profiler.scope("a"):
+        with profiler.scope("b"):
+            pass
+        profiler.begin("a2")
+        profiler.end()
+profiler.next_frame()
+with profiler.scope("a"):
+    pass
+profiler.next_frame()
+stats = profiler.get_stats()
+assert_equal([s[0] for s in stats], ["a", "a/a2", "a/b", "b"])
+assert_equal([s[1] for s in stats], [1.5, 1.0, 1.0, 1.0])
+assert_equal(len(profiler.get_frame_times()), 2)
+
+# percentiles of the scope totals per frame, in ms
+profiler.set_enabled(True)
+profiler.next_frame()
+for ms in xrange(100, 0, -1):
+    profiler._frame_totals["a"] = [ms / 1000., 1]
+    profiler.next_frame()
+(path, calls, p50, p95, max_ms), = profiler.get_stats()
+assert_equal((calls, round(p50, 6), round(p95, 6), round(max_ms, 6)), (1.0, 51, 96, 100))
+assert_equal(profiler._percentile(range(10), 1), 9)
+profiler.set_enabled(False)
+assert_equal((profiler.get_stats(), profiler.scope("a")), ([], profiler._NULL_SCOPE))
+
+# city generation
+city = citygen.CityGenerator(120, 90, seed=3)
+assert_equal(city.layers, citygen.CityGenerator(120, 90, seed=3).layers)
+assert_equal(city.buildings, citygen.CityGenerator(120, 90, seed=3).buildings)
+assert_false(city.layers == citygen.CityGenerator(120, 90, seed=4).layers)
+
+road = city.palette.index(world.BlockType.ROAD + 1)
+assert_equal(city.layers["terrain"][0], bytearray([road]) * 120)
+assert_true(all(row[0] == road and row[-1] == road for row in city.layers["terrain"]))
+
 print("All passed!")
\ No newline at end of file
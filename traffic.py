@@ -0,0 +1,459 @@
+from bisect import bisect_left, bisect_right
+from math import ceil, sqrt
+import random
+
+import constants
+
+
+class Car:
+    """
+    A vehicle driven along the lanes of a road map by the traffic simulation
+    """
+
+    def __init__(self, vehicle, desired_speed):
+        """
+        :param vehicle: The vehicle entity to move, or None if simulating without entities
+        :param desired_speed: The speed this car accelerates towards on an empty road
+        """
+        self.vehicle = vehicle
+        self.desired_speed = desired_speed
+
+        self.route = None
+        self.track = None
+
+        # where the car leaves its current track
+        self.exit_index = 0
+        self.exit_position = 0
+
+        # where the car joins the next track of its route, if any
+        self.next_track = None
+        self.next_position = 0
+
+        # how long the car has been waiting to pull out at a junction
+        self.waiting_time = 0
+
+
+class Track:
+    """
+    All cars travelling in the same direction along the same line of lanes, which can belong to several (possibly
+    overlapping) roads. Cars are held as parallel lists sorted by their position along the track
+    """
+
+    def __init__(self, lane):
+        """
+        :param lane: Any RoadMap.Lane along the track
+        """
+        self.direction = lane.direction
+        self.travel_direction = lane.travel_direction
+        self.cars = []
+        self.positions = []
+        self.speeds = []
+
+        # positions are pixel coordinates along the track, negated if travelling towards 0 so they always increase
+        self._along = 1 if lane.road.vertical_road else 0
+        self._sign = self.travel_direction[self._along]
+        self._across = lane.start_bound.centre[1 - self._along] * constants.TILE_SIZE
+
+    @staticmethod
+    def get_key(lane):
+        """
+        :return: A key shared by all lanes on the same track
+        """
+        across = 0 if lane.road.vertical_road else 1
+        return lane.direction, lane.start_bound.centre[across]
+
+    def position_of(self, node):
+        """
+        :return: The position along the track of the given node on it
+        """
+        return (node.point[self._along] + 0.5) * constants.TILE_SIZE * self._sign
+
+    def get_pixel(self, position):
+        """
+        :return: The pixel position at the given position along the track
+        """
+        pixel = [0, 0]
+        pixel[self._along] = position * self._sign
+        pixel[1 - self._along] = self._across
+        return pixel
+
+    def has_room(self, position, space):
+        """
+        :return: True if no car is within the given space of the given position
+        """
+        i = bisect_left(self.positions, position)
+        if i < len(self.positions) and self.positions[i] - position < space:
+            return False
+        if i > 0 and position - self.positions[i - 1] < space:
+            return False
+        return True
+
+    def can_join(self, position, length, space):
+        """
+        :param length: Length of the joining car
+        :return: True if a car can pull out onto the track at the given position, which needs the given space clear in
+                 front of it and no moving cars close behind. Stopped cars behind, such as those waiting at the same
+                 junction, wait for the joining car instead, so only need to be clear of the joining car itself
+        """
+        i = bisect_right(self.positions, position)
+        if i < len(self.positions) and self.positions[i] - position < space:
+            return False
+        if i > 0:
+            gap = position - self.positions[i - 1]
+            if gap < length or (gap < space and self.speeds[i - 1] > Traffic.STOPPED_SPEED):
+                return False
+        return True
+
+    def insert(self, car, position, speed):
+        i = bisect_left(self.positions, position)
+        self.cars.insert(i, car)
+        self.positions.insert(i, position)
+        self.speeds.insert(i, speed)
+        car.track = self
+
+    def remove(self, car):
+        """
+        :return: The position and speed of the removed car
+        """
+        i = self.cars.index(car)
+        del self.cars[i]
+        car.track = None
+        return self.positions.pop(i), self.speeds.pop(i)
+
+
+class Traffic:
+    """
+    Drives cars around the road map using the Intelligent Driver Model, in which every car accelerates towards its
+    desired speed while keeping a safe time gap to the car in front.
+    The cars on each track are stepped together, using only the positions and speeds from the previous step
+    """
+
+    # in pixels per second squared
+    MAX_ACCELERATION = 160.
+    COMFORTABLE_BRAKING = 300.
+
+    # in seconds
+    TIME_HEADWAY = 0.8
+
+    # in tiles
+    MIN_GAP = 0.5
+    CAR_LENGTH = 2
+
+    # longer frames are split into steps of at most this length, up to the given number of steps per frame, after
+    # which simulated time falls behind rather than the model becoming unstable
+    MAX_TIME_STEP = 0.1
+    MAX_STEPS = 5
+
+    SPAWN_ATTEMPTS = 10
+
+    # in pixels per second, below which a car is considered stopped
+    STOPPED_SPEED = 1.
+
+    # in seconds, after which a car stuck at a junction gives up and is moved elsewhere, to break up gridlock
+    MAX_WAITING_TIME = 10
+
+    def __init__(self, roadmap):
+        self.roadmap = roadmap
+        self.cars = []
+
+        self.min_gap = Traffic.MIN_GAP * constants.TILE_SIZE
+        self.car_length = Traffic.CAR_LENGTH * constants.TILE_SIZE
+
+        self._tracks = {}
+        self._nodes = None
+
+        # cars that could not find a free spot on the road, to be tried again next tick
+        self._waiting = []
+
+    def _get_track(self, lane):
+        key = Track.get_key(lane)
+        track = self._tracks.get(key)
+        if track is None:
+            track = Track(lane)
+            self._tracks[key] = track
+        return track
+
+    def spawn(self, vehicle=None):
+        """
+        Adds a car to a random free spot on the road, which then drives itself to random destinations
+
+        :param vehicle: The vehicle entity to drive, or None to only simulate the car
+        :return: The new car, or None if no space could be found
+        """
+        if vehicle is not None:
+            desired_speed = vehicle.controller.engine.max_speed
+        else:
+            desired_speed = constants.Speed.VEHICLE_MAX * random.uniform(0.75, 1)
+
+        car = Car(vehicle, desired_speed)
+        if not self._place(car):
+            return None
+
+        if vehicle is not None:
+            vehicle.autonomous = True
+        self.cars.append(car)
+        return car
+
+    def remove(self, car):
+        """
+        Removes the given car from the simulation, leaving its vehicle where it is
+        """
+        if car.track is not None:
+            car.track.remove(car)
+        elif car in self._waiting:
+            self._waiting.remove(car)
+
+        self.cars.remove(car)
+        if car.vehicle is not None:
+            car.vehicle.autonomous = False
+
+    def _place(self, car):
+        """
+        Puts the car at a random free spot on a random lane, with a route from the next node along it
+        :return: True if successful
+        """
+        if self._nodes is None:
+            self._nodes = self.roadmap.nodes.values()
+        if not self._nodes:
+            return False
+
+        space = self.car_length + self.min_gap
+        for _ in xrange(Traffic.SPAWN_ATTEMPTS):
+            lane = random.choice(self._nodes).lane
+            track = self._get_track(lane)
+
+            first = track.position_of(lane.nodes[0])
+            last = track.position_of(lane.nodes[-1])
+            position = first + random.random() * (last - first)
+            if not track.has_room(position, space):
+                continue
+
+            node = next(n for n in lane.nodes if track.position_of(n) >= position)
+            if self._plan_route(car, node):
+                track.insert(car, position, 0.)
+                self._enter_track(car, 0)
+                return True
+
+        return False
+
+    def _plan_route(self, car, src):
+        """
+        Gives the car a route from the given node to a random destination
+        :return: True if a route was found
+        """
+        for _ in xrange(Traffic.SPAWN_ATTEMPTS):
+            dest = random.choice(self._nodes)
+            if dest is src:
+                continue
+
+            route = self.roadmap.find_route(src, dest)
+            if route:
+                car.route = route
+                return True
+
+        return False
+
+    def _enter_track(self, car, route_index):
+        """
+        Finds where the car will leave its track, having just joined it at the given node along its route
+        """
+        route = car.route
+        track = car.track
+
+        exit_index = route_index
+        while exit_index + 1 < len(route) and self._get_track(route[exit_index + 1].lane) is track:
+            exit_index += 1
+
+        car.exit_index = exit_index
+        car.exit_position = track.position_of(route[exit_index])
+
+        if exit_index + 1 < len(route):
+            next_node = route[exit_index + 1]
+            car.next_track = self._get_track(next_node.lane)
+            car.next_position = car.next_track.position_of(next_node)
+        else:
+            car.next_track = None
+
+    def tick(self, render):
+        """
+        Moves all cars along by the frame's delta time
+
+        :param render: If False, vehicle entities are left where they are until the next rendered tick
+        """
+        if self._waiting:
+            waiting = self._waiting
+            self._waiting = []
+            for car in waiting:
+                self._respawn(car)
+
+        delta = constants.DELTA
+        if delta > 0 and self.cars:
+            steps = min(int(ceil(delta / Traffic.MAX_TIME_STEP)), Traffic.MAX_STEPS)
+            time_step = min(delta / steps, Traffic.MAX_TIME_STEP)
+            for _ in xrange(steps):
+                self.step(time_step)
+
+        if render:
+            self.sync_vehicles()
+
+    def step(self, time_step):
+        """
+        Steps every track of cars forward by the given time, then moves cars that have reached the end of their track
+        onto the next track of their route
+        """
+        exits = []
+        for track in self._tracks.itervalues():
+            if track.cars:
+                self._step_track(track, time_step, exits)
+
+        for car, overshoot in exits:
+            self._leave_track(car, overshoot, time_step)
+
+    def _step_track(self, track, time_step, exits):
+        """
+        :param exits: List to add cars that have reached their exit to, with how far they would have driven past it
+        """
+        cars = track.cars
+        positions = track.positions
+        speeds = track.speeds
+        count = len(cars)
+
+        max_acceleration = Traffic.MAX_ACCELERATION
+        braking_term = 2 * sqrt(Traffic.MAX_ACCELERATION * Traffic.COMFORTABLE_BRAKING)
+        headway = Traffic.TIME_HEADWAY
+        min_gap = self.min_gap
+        car_length = self.car_length
+
+        new_positions = [0.] * count
+        new_speeds = [0.] * count
+
+        # the front car follows the last car on the track it is turning onto
+        leader_position, leader_speed = self._find_leader(cars[-1])
+
+        for i in xrange(count - 1, -1, -1):
+            if i < count - 1:
+                leader_position = positions[i + 1]
+                leader_speed = speeds[i + 1]
+
+            car = cars[i]
+            position = positions[i]
+            speed = speeds[i]
+
+            # free road
+            acceleration = 1 - (speed / car.desired_speed) ** 4
+
+            # interaction with the car in front
+            if leader_position is not None:
+                gap = max(leader_position - position - car_length, 1.)
+                desired_gap = min_gap + max(0., speed * headway + speed * (speed - leader_speed) / braking_term)
+                acceleration -= (desired_gap / gap) ** 2
+
+            new_speed = max(0., speed + max_acceleration * acceleration * time_step)
+            new_position = position + (speed + new_speed) * 0.5 * time_step
+
+            # never drive into the car in front
+            if leader_position is not None and new_position > leader_position - car_length:
+                new_position = max(position, leader_position - car_length)
+
+            # stop at the exit, or where the car is if it joined the track past it, so that no car is moved back
+            # once others have joined the track around it
+            if new_position >= car.exit_position:
+                exits.append((car, new_position - car.exit_position))
+                new_position = max(position, car.exit_position)
+
+            new_positions[i] = new_position
+            new_speeds[i] = new_speed
+
+        track.positions = new_positions
+        track.speeds = new_speeds
+
+    def _find_leader(self, car):
+        """
+        :return: The position and speed of the first car on the track that the given car is turning onto, relative to
+                 the given car's current track, otherwise (None, 0) if the road ahead is clear
+        """
+        next_track = car.next_track
+        if next_track is None:
+            return None, 0
+
+        # cars waiting at the junction itself are behind the turning car
+        i = bisect_right(next_track.positions, car.next_position)
+        if i == len(next_track.positions):
+            return None, 0
+
+        return car.exit_position + next_track.positions[i] - car.next_position, next_track.speeds[i]
+
+    def _leave_track(self, car, overshoot, time_step):
+        """
+        :param overshoot: How far the car would have driven past its exit, which it carries on by along its route
+        """
+        track = car.track
+
+        # wait at the junction until there is space to pull out, where the car will be once it has
+        if car.next_track is not None and not car.next_track.can_join(car.next_position + overshoot, self.car_length,
+                                                                      self.car_length + self.min_gap):
+            car.waiting_time += time_step
+            if car.waiting_time < Traffic.MAX_WAITING_TIME:
+                track.speeds[track.cars.index(car)] = 0.
+
+            else:
+                track.remove(car)
+                self._respawn(car)
+            return
+
+        car.waiting_time = 0
+        position, speed = track.remove(car)
+
+        # carry on along the route
+        if car.next_track is not None:
+            car.next_track.insert(car, car.next_position + overshoot, speed)
+            self._enter_track(car, car.exit_index + 1)
+
+        # reached the destination, so head somewhere else
+        elif self._plan_route(car, car.route[car.exit_index]):
+            track.insert(car, position, speed)
+            self._enter_track(car, 0)
+
+        # nowhere to go from here, such as the end of a road off the edge of the world
+        else:
+            self._respawn(car)
+
+    def _respawn(self, car):
+        car.waiting_time = 0
+        if not self._place(car):
+            self._waiting.append(car)
+
+    def sync_vehicles(self):
+        """
+        Moves every vehicle entity to its car's position on the road
+        """
+        dead = []
+        for track in self._tracks.itervalues():
+            direction = track.direction
+            dx, dy = track.travel_direction
+
+            for car, position, speed in zip(track.cars, track.positions, track.speeds):
+                vehicle = car.vehicle
+                if vehicle is None:
+                    continue
+
+                if vehicle.dead:
+                    dead.append(car)
+                    continue
+
+                if vehicle.direction != direction:
+                    vehicle.turn(direction)
+
+                vehicle.velocity.x = dx * speed
+                vehicle.velocity.y = dy * speed
+                vehicle.move_entity(track.get_pixel(position))
+
+        for car in dead:
+            self.remove(car)
+
+    def get_debug_lines(self):
+        """
+        :return: Lines of text to show in the debug overlay
+        """
+        moving = sum(1 for track in self._tracks.itervalues() for speed in track.speeds if speed > Traffic.STOPPED_SPEED)
+        return ["Traffic: %d cars, %d moving, %d waiting" % (len(self.cars), moving, len(self._waiting))]
@@ -1,5 +1,5 @@
 import colorsys
-from math import floor, sqrt
+from math import ceil, floor, sqrt
 import os
 import random
 import operator
@@ -682,46 +682,126 @@ class Heap:
             yield self._heap[i]
 
 
-class TimeTicker:
+class TimerWheel:
     """
-    Ticks independently of framerate
+    Calls back timers once they are due, independently of framerate.
+
+    Timers are held in a hierarchical timing wheel: each level has a ring of slots, and each slot of a level covers as
+    many ticks as a whole ring of the level below. A timer is put in the slot for its due tick in the lowest level that
+    reaches that far, then moved down a level whenever the ring below comes round to its slot. Timers are only touched
+    when they are scheduled, moved down or due, so waiting timers cost nothing per frame
     """
 
-    def __init__(self, limit_or_range_range):
+    SLOTS = 64
+    LEVELS = 4
+
+    class Timer:
+        def __init__(self, delay, callback, repeat):
+            self.delay = delay
+            self.callback = callback
+            self.repeat = repeat
+            self.due = 0
+            self.cancelled = False
+
+        def next_delay(self):
+            """
+            :return: Seconds until the timer is next due
+            """
+            return random.uniform(*self.delay) if isinstance(self.delay, tuple) else self.delay
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self, resolution=1 / 60.):
         """
-        :param limit_or_range_range: Either constant seconds, or a (min, max) range for random times
+        :param resolution: Seconds per tick of the wheel
         """
+        self.resolution = resolution
+        self.time = 0
+        self.ticks = 0
+        self._remainder = 0
 
-        def reset_gen():
-            if isinstance(limit_or_range_range, tuple):
-                while True:
-                    yield random.uniform(*limit_or_range_range)
-            else:
-                while True:
-                    yield limit_or_range_range
+        self._levels = [[[] for _ in xrange(TimerWheel.SLOTS)] for _ in xrange(TimerWheel.LEVELS)]
 
-        self._reset = reset_gen()
-        self.time = 0
-        self.limit = 0
-        self.reset()
+    def schedule(self, delay, callback, repeat=False):
+        """
+        :param delay: Either constant seconds, or a (min, max) range for random times, which is chosen again each time
+                      the timer repeats
+        :param callback: Function to call, with no arguments
+        :param repeat: If True, the timer is rescheduled every time it is called back, until cancelled
+        :return: The new timer, which can be cancelled
+        """
+        timer = TimerWheel.Timer(delay, callback, repeat)
+        timer.due = self.ticks + self._to_ticks(timer.next_delay())
+        self._insert(timer)
+        return timer
 
-    def tick(self):
+    def _to_ticks(self, delay):
         """
-        If target time has been reached, the ticker is reset
-        :return: True if the target time has been reached, otherwise false
+        :return: The number of whole ticks covering the given seconds, which is always at least 1
         """
-        self.time += constants.DELTA
-        complete = self.time >= self.limit
-        if complete:
-            self.reset()
-        return complete
+        return max(1, int(ceil(delay / self.resolution - 1e-9)))
+
+    def _insert(self, timer):
+        remaining = timer.due - self.ticks
+        slots = TimerWheel.SLOTS
+
+        level = 0
+        span = slots
+        while remaining >= span and level < TimerWheel.LEVELS - 1:
+            level += 1
+            span *= slots
 
-    def reset(self):
+        # timers beyond the top level are moved down early, and simply put back again
+        self._levels[level][(timer.due // (span / slots)) % slots].append(timer)
+
+    def advance(self, delta):
         """
-        Resets the ticker back to 0
+        Moves time forward by the given seconds, calling back every timer that is now due
         """
-        self.time = 0
-        self.limit = next(self._reset)
+        self.time += delta
+        self._remainder += delta
+
+        while self._remainder >= self.resolution:
+            self._remainder -= self.resolution
+            self._tick()
+
+    def _tick(self):
+        self.ticks += 1
+        ticks = self.ticks
+        slots = TimerWheel.SLOTS
+
+        # move timers down from the higher levels, whenever the level below comes round to the start of its ring
+        span = 1
+        for level in xrange(1, TimerWheel.LEVELS):
+            span *= slots
+            if ticks % span != 0:
+                break
+
+            ring = self._levels[level]
+            index = (ticks // span) % slots
+            timers = ring[index]
+            ring[index] = []
+            for timer in timers:
+                if not timer.cancelled:
+                    self._insert(timer)
+
+        ring = self._levels[0]
+        index = ticks % slots
+        due = ring[index]
+        if not due:
+            return
+
+        ring[index] = []
+        for timer in due:
+            if timer.cancelled:
+                continue
+
+            if timer.repeat:
+                timer.due = ticks + self._to_ticks(timer.next_delay())
+                self._insert(timer)
+
+            timer.callback()
 
 
 class Transform:
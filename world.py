@@ -1,4 +1,7 @@
+from bisect import bisect_right
 from collections import OrderedDict
+import copy
+import heapq
 import random
 import operator
 import sys
@@ -8,6 +11,11 @@ import pygame
 import ai
 import constants
 from building import Building
+import lighting
+import minimap
+import overlay
+import profiler
+import traffic
 import util
 from vec2d import Vec2d
 
@@ -28,33 +36,76 @@ class _WorldLayer:
         self.draw_above = draw_above
         self.solid_blanks = solid_blanks
         self._blocks = [[default_fill] * world.tile_width for _ in xrange(world.tile_height)]
+        self._shared_rows = set()
 
     def __getitem__(self, item):
         return self._blocks[item]
 
+    def set(self, x, y, block):
+        """
+        Sets the block at the given coords, first copying its row if it is still shared with another layer
+        """
+        row = self._blocks[y]
+        if y in self._shared_rows:
+            row = self._blocks[y] = list(row)
+            self._shared_rows.remove(y)
+        row[x] = block
+
+    def share(self, world):
+        """
+        :return: A copy of this layer for the given world, sharing all rows until they are written to
+        """
+        layer = copy.copy(self)
+        layer.world = world
+        layer._blocks = list(self._blocks)
+        layer._shared_rows = set(xrange(len(self._blocks)))
+        return layer
+
 
 class WorldRenderer:
     class _RenderLayer:
-        def __init__(self, world, layer_func):
+        def __init__(self, world, layer_func, shared_surface=None):
             """
             :param layer_func: Predicate for choosing all world layers that this holds for
+            :param shared_surface: Pre-rendered surface to share until it is drawn on; if None, a new one is created
             """
             self.world = world
             self.layers = [(n, l) for n, l in world.layers.items() if layer_func(n, l)]
-            self.surface = pygame.Surface((world.pixel_width, world.pixel_height)).convert_alpha()
-            self.surface.fill((0, 0, 0, 0))
+            self.shared = shared_surface is not None
+            if self.shared:
+                self.surface = shared_surface
+            else:
+                self.surface = pygame.Surface((world.pixel_width, world.pixel_height)).convert_alpha()
+                self.surface.fill((0, 0, 0, 0))
 
         def render(self):
-            constants.SCREEN.blit(self.surface, (-constants.SCREEN.camera.transform.x, -constants.SCREEN.camera.transform.y))
+            constants.SCREEN.blit(self.surface, (-constants.SCREEN.camera.transform.x, -constants.SCREEN.camera.transform.y),
+                                  volatile=True)
 
-    def __init__(self, world):
+        def own_surface(self):
+            """
+            :return: The surface to draw on, first copied if it is still shared
+            """
+            if self.shared:
+                self.surface = self.surface.copy()
+                self.shared = False
+            return self.surface
+
+    def __init__(self, world, template=None):
+        """
+        :param template: Renderer whose pre-rendered surfaces should be shared, see InteriorTemplate
+        """
+        shared_surfaces = [rl.surface for rl in template.layers] if template else [None, None]
         self.layers = []
         self.world = world
-        self.layers.append(self._RenderLayer(world, lambda n, l: not l.draw_above and n != "rects"))
-        self.layers.append(self._RenderLayer(world, lambda _, l: l.draw_above))
+        self.layers.append(self._RenderLayer(world, lambda n, l: not l.draw_above and n != "rects", shared_surfaces[0]))
+        self.layers.append(self._RenderLayer(world, lambda _, l: l.draw_above, shared_surfaces[1]))
 
-        # self.night = pygame.Surface(constants.WINDOW_SIZE).convert_alpha()
-        # self.night.fill((5,5,60,160))
+        # world layer name -> render layer
+        self._rlayers = {}
+        for rl in self.layers:
+            for n, _ in rl.layers:
+                self._rlayers.setdefault(n, rl)
 
     def initial_render(self):
         """
@@ -67,12 +118,14 @@ class WorldRenderer:
                     if block:
                         constants.SCREEN.draw_block(block, (util.tile_to_pixel((x, y)), constants.TILE_DIMENSION), surface=rlayer.surface)
 
+    @profiler.profiled("render_sandwich")
     def render_sandwich(self, sandwiched_draw_function, args):
         """
         Renders the base layer, runs the given function with the given args, then renders all remaining layers
         """
         self.layers[0].render()
         sandwiched_draw_function(*args)
+        constants.SCREEN.flush_sprites()
         for i in xrange(1, len(self.layers)):
             self.layers[i].render()
 
@@ -83,16 +136,21 @@ class WorldRenderer:
         :param world_layer: World layer to render to
         """
         rlayer = self._find_rlayer(world_layer)
-        constants.SCREEN.draw_block(block, (util.tile_to_pixel(pos), constants.TILE_DIMENSION), surface=rlayer.surface)
+        constants.SCREEN.draw_block(block, (util.tile_to_pixel(pos), constants.TILE_DIMENSION), surface=rlayer.own_surface())
+
+    def render_blocks(self, blocks, world_layer):
+        """
+        :param blocks: List of (x, y, block) to render
+        :param world_layer: World layer to render to
+        """
+        rlayer = self._find_rlayer(world_layer)
+        constants.SCREEN.draw_blocks([(b, util.tile_to_pixel((x, y))) for x, y, b in blocks], surface=rlayer.own_surface())
 
     def _find_rlayer(self, wlayer):
         """
         :return: The RenderLayer that matches the given name
         """
-        for rl in self.layers:
-            for n, _ in rl.layers:
-                if n == wlayer:
-                    return rl
+        return self._rlayers.get(wlayer)
 
 
 class EntityGrid:
@@ -192,6 +250,11 @@ class BaseWorld:
         self.renderer = None
 
         self.nav_graph = None
+        self._block_listeners = []
+        self.overlays = overlay.OverlayManager(self)
+        self.lighting = None
+
+        self.crowd_avoidance = ai.CrowdAvoidance(self) if constants.CONFIG["game.humans.avoidance"] else None
 
         WORLDS.append(self)
 
@@ -199,8 +262,16 @@ class BaseWorld:
         """
         Finishes off the loading of the world
         """
-        self.renderer = WorldRenderer(self)
-        self.renderer.initial_render()
+        pass
+
+    def get_renderer(self):
+        """
+        :return: The renderer, which is only created, and renders the whole world, the first time the world is rendered
+        """
+        if not self.renderer:
+            self.renderer = WorldRenderer(self)
+            self.renderer.initial_render()
+        return self.renderer
 
     def _reg_layer(self, name, draw_above=False, solid_blanks=False):
         """
@@ -211,6 +282,15 @@ class BaseWorld:
         else:
             self.layers[name] = _WorldLayer(self, name, draw_above=draw_above, solid_blanks=solid_blanks)
 
+    def add_block_listener(self, listener):
+        """
+        :param listener: Function called with (x, y, block, layer) every time a block is set
+        """
+        self._block_listeners.append(listener)
+
+    def remove_block_listener(self, listener):
+        self._block_listeners.remove(listener)
+
     def has_layer(self, layer):
         return layer in self.layers.keys()
 
@@ -264,7 +344,48 @@ class BaseWorld:
 
         :param overwrite_collisions: Whether or not this new block should affect the collidability of the block
         """
-        self.layers[layer][y][x] = block
+        self._store_block(x, y, block, layer, overwrite_collisions)
+
+        if constants.SCREEN.camera and self.renderer:
+            self.renderer.render_block(block, (x, y), layer)
+
+        for listener in self._block_listeners:
+            listener(x, y, block, layer)
+
+    def set_blocks(self, changes, layer, overwrite_collisions=True):
+        """
+        Sets many blocks in the given layer at once, then renders them all together
+
+        :param changes: Iterable of (x, y, blocktype), whose shared block instances are set
+        :param overwrite_collisions: Whether or not the new blocks should affect the collidability of the blocks
+        """
+        get_shared_instance = Block.HELPER.get_shared_instance
+        instances = {}
+        blocks = []
+        for x, y, blocktype in changes:
+            block = instances.get(blocktype)
+            if block is None:
+                block = get_shared_instance(blocktype)
+                instances[blocktype] = block
+
+            self._store_block(x, y, block, layer, overwrite_collisions)
+            blocks.append((x, y, block))
+
+        if not blocks:
+            return
+
+        if constants.SCREEN.camera and self.renderer:
+            self.renderer.render_blocks(blocks, layer)
+
+        for listener in self._block_listeners:
+            for x, y, block in blocks:
+                listener(x, y, block, layer)
+
+    def _store_block(self, x, y, block, layer, overwrite_collisions):
+        """
+        Sets the block in the given layer, and its collision rect if necessary, without rendering it
+        """
+        self.layers[layer].set(x, y, block)
 
         if BlockType.is_interactable(block.blocktype):
             self.interact_rects.append((util.tile_to_pixel((x, y)), constants.TILE_DIMENSION))
@@ -275,10 +396,7 @@ class BaseWorld:
                 pos = util.tile_to_pixel((x, y))
                 pos = pos[0] + offset[0], pos[1] + offset[1]
                 new_value = pos, collision_rect
-                self.layers["rects"][y][x] = new_value
-
-        if constants.SCREEN.camera:
-            self.renderer.render_block(block, (x, y), layer)
+                self.layers["rects"].set(x, y, new_value)
 
     def set_block_type(self, x, y, blocktype, layer, overwrite_collisions=True):
         """
@@ -326,6 +444,7 @@ class BaseWorld:
                 print(self.get_block(x, y, layer)),
             print
 
+    @profiler.profiled("tick_entities")
     def tick_entities(self, render, boundaries=None):
         """
         Ticks all entities
@@ -334,6 +453,10 @@ class BaseWorld:
         # sort by depth
         self.depth_sort_entities()
 
+        if self.crowd_avoidance:
+            with profiler.scope("crowd_avoidance"):
+                self.crowd_avoidance.tick()
+
         # draw entities
         for e in self.entities:
             if e.dead:
@@ -352,6 +475,7 @@ class BaseWorld:
                 self.entities.append(e)
         self.entity_buffer.clear()
 
+    @profiler.profiled("depth_sort")
     def depth_sort_entities(self):
         util.insert_sort(self.entities, lambda a, b: util.compare(a.transform.y, b.transform.y))
 
@@ -402,7 +526,10 @@ class BaseWorld:
 
         entity_tick_args = (render, (x1, y1, x2, y2) if render else None)
         if render:
-            self.renderer.render_sandwich(self.tick_entities, entity_tick_args)
+            self.get_renderer().render_sandwich(self.tick_entities, entity_tick_args)
+            if self.lighting:
+                self.lighting.render()
+            self.overlays.render()
         else:
             self.tick_entities(*entity_tick_args)
 
@@ -609,9 +736,6 @@ class BaseWorld:
             layer_name = terrain_layer.attrib["name"]
             x = y = 0
 
-            draw_above = not world.layers[layer_name].draw_above
-            solid_blanks = world.layers[layer_name].solid_blanks
-
             for c in data.strip().split(','):
                 # new row
                 if c[0].isspace():
@@ -620,36 +744,7 @@ class BaseWorld:
                     c = c[1:]
 
                 if c.isdigit():
-                    block_id = char_to_id(c)
-                    real_id = block_id
-                    block = Block.HELPER.get_shared_instance(block_id)
-
-                    # rotated
-                    if not block:
-                        real_id, rot, hor, ver = Block.HELPER.get_rotation(block_id)
-
-                        try:
-                            old_surface = Block.HELPER.block_images[real_id]
-                            surface = pygame.transform.flip(old_surface, hor, ver)
-                            if rot:
-                                surface = pygame.transform.rotate(surface, 90)
-                        except KeyError:
-                            raise StandardError("Unknown rotation of block id %d" % block_id)
-
-                        # register rotated surface under new blockid
-                        block = Block.HELPER.register_block(real_id, surface, render_id=block_id)
-
-                    # each interactable instance must be unique
-                    if BlockType.is_interactable(real_id):
-                        block = Block.HELPER.create_new_instance(block)
-
-                    # should blanks be collidable
-                    if block_id == BlockType.BLANK:
-                        colls = solid_blanks
-                    else:
-                        colls = draw_above
-
-                    world.set_block(x, y, block, layer_name, colls)
+                    world.set_tmx_block(x, y, char_to_id(c), layer_name)
                     x += 1
 
         tileset_res = constants.TILESET_RESOLUTION
@@ -703,6 +798,42 @@ class BaseWorld:
         constants.LOGGER.debug("Successfully loaded world %s" % filename)
         return world
 
+    def set_tmx_block(self, x, y, block_id, layer):
+        """
+        Sets the block of the given tile id from a tmx file, registering it first if it is rotated or flipped
+
+        :param block_id: Tile id, which is one less than its gid in the tmx file
+        """
+        real_id = block_id
+        block = Block.HELPER.get_shared_instance(block_id)
+
+        # rotated
+        if not block:
+            real_id, rot, hor, ver = Block.HELPER.get_rotation(block_id)
+
+            try:
+                old_surface = Block.HELPER.block_images[real_id]
+                surface = pygame.transform.flip(old_surface, hor, ver)
+                if rot:
+                    surface = pygame.transform.rotate(surface, 90)
+            except KeyError:
+                raise StandardError("Unknown rotation of block id %d" % block_id)
+
+            # register rotated surface under new blockid
+            block = Block.HELPER.register_block(real_id, surface, render_id=block_id)
+
+        # each interactable instance must be unique
+        if BlockType.is_interactable(real_id):
+            block = Block.HELPER.create_new_instance(block)
+
+        # should blanks be collidable
+        if block_id == BlockType.BLANK:
+            colls = self.layers[layer].solid_blanks
+        else:
+            colls = not self.layers[layer].draw_above
+
+        self.set_block(x, y, block, layer, colls)
+
     def add_spawn(self, entitytype, x, y, o=None, w=None, h=None):
         """
         :param entitytype: Spawn type
@@ -733,6 +864,8 @@ class World(BaseWorld):
 
         self.buildings = []
         self.roadmap = RoadMap(self)
+        self.traffic = traffic.Traffic(self.roadmap)
+        self.minimap = None
 
         _BlockHelper.init_helper()
 
@@ -744,6 +877,15 @@ class World(BaseWorld):
         self.nav_graph.generate_graph(BlockType.PAVEMENT, {BlockType.ROAD: 5, BlockType.SAND: 20})
         constants.LOGGER.debug("Generation navigation graph of %d nodes" % len(self.nav_graph.graph))
 
+        # connect roads
+        self.roadmap.build_graph()
+        constants.LOGGER.debug("Generated road graph of %d nodes and %d junctions" % (len(self.roadmap.nodes), len(self.roadmap.junctions)))
+
+        if constants.CONFIG["display.lighting"]:
+            self.lighting = lighting.LightMap(self)
+
+        self.minimap = minimap.Minimap(self)
+
     def get_block(self, x, y, layer="terrain"):
         return BaseWorld.get_block(self, x, y, layer)
 
@@ -753,9 +895,31 @@ class World(BaseWorld):
     def set_block_type(self, x, y, blocktype, layer="terrain", overwrite_collisions=True):
         BaseWorld.set_block_type(self, x, y, blocktype, layer, overwrite_collisions)
 
+    def set_lights(self, on):
+        """
+        Switches every building window in the city on or off, in a single block update
+        """
+        self.set_windows(lambda b: bytearray([on]) * len(b.window_positions))
+
+    def set_windows(self, get_states):
+        """
+        Sets the window statuses of every building in a single block update
+
+        :param get_states: Function that returns the new window statuses of the given building, see Building.set_windows
+        """
+        changes = []
+        for b in self.buildings:
+            changes.extend(b.set_windows(get_states(b)))
+        self.set_blocks(changes, layer="overterrain")
+
     def tick(self, render=True):
+        with profiler.scope("traffic"):
+            self.traffic.tick(render)
         BaseWorld.tick(self, render)
 
+        if render and constants.SCREEN.show_minimap:
+            self.minimap.render()
+
         # debug terrible rendering of lanes
         # if render:
         # for road in self.roadmap.roads:
@@ -771,10 +935,6 @@ class World(BaseWorld):
         #     for node in self.roadmap.nodes.values():
         #         constants.SCREEN.draw_circle_in_tile(util.tile_to_pixel(node.point))
 
-        # debug beautiful rendering of navigation graph
-        if render:
-            self.nav_graph.debug_render()
-
 
 class BuildingWorld(BaseWorld):
     def __init__(self, width, height):
@@ -784,6 +944,68 @@ class BuildingWorld(BaseWorld):
         self._reg_layer("objects")
         self._reg_layer("rects")
 
+        self.building = None
+
+    def tick(self, render=True):
+        BaseWorld.tick(self, render)
+
+        # nobody is inside or looking, so the interior can be returned to its template
+        if not render and not self.entities and not self.entity_buffer and self.building:
+            self.building.release_inside()
+
+
+class InteriorTemplate:
+    """
+    A building interior loaded once, whose tiles and pre-rendered surfaces are shared by every building using it
+    """
+
+    _TEMPLATES = {}
+
+    def __init__(self, filename):
+        self.world = BuildingWorld.load_tmx(filename)
+        WORLDS.remove(self.world)
+
+        # entrance mats, each linked to a building when instantiated
+        self.entrances = [(x, y) for x, y, b in self.world.iterate_blocks() if b.blocktype == BlockType.ENTRANCE_MAT]
+        for x, y in self.entrances:
+            self.world.add_spawn(constants.EntityType.HUMAN, *util.tile_to_pixel((x + 1, y)))
+
+    @staticmethod
+    def get(filename):
+        """
+        :return: The template loaded from the given file, which is only loaded the first time
+        """
+        template = InteriorTemplate._TEMPLATES.get(filename)
+        if not template:
+            template = InteriorTemplate(filename)
+            InteriorTemplate._TEMPLATES[filename] = template
+        return template
+
+    @staticmethod
+    def count():
+        return len(InteriorTemplate._TEMPLATES)
+
+    def instantiate(self, building):
+        """
+        :return: A new interior world for the given building, copying tiles and surfaces only when they are changed
+        """
+        template = self.world
+        world = BuildingWorld(template.tile_width, template.tile_height)
+        world.building = building
+        world.layers = OrderedDict((n, l.share(world)) for n, l in template.layers.items())
+        world.interact_rects = list(template.interact_rects)
+        world._spawns = dict((k, list(v)) for k, v in template._spawns.items())
+        world.renderer = WorldRenderer(world, template.get_renderer())
+
+        # each building needs its own entrance mats
+        terrain = world.layers["terrain"]
+        for x, y in self.entrances:
+            mat = Block.clone(terrain[y][x])
+            mat.building = building
+            terrain.set(x, y, mat)
+
+        return world
+
 
 # noinspection PyShadowingNames
 # todo this is horrible, I think a rethink and re-everything would be a good idea
@@ -814,6 +1036,7 @@ class RoadMap:
             self.length = 0
             self.is_spawn = False
             self._bounds = []
+            self.lanes = []
 
             self.set_road_length(road_length)
 
@@ -886,26 +1109,138 @@ class RoadMap:
         def right_lane_end(self):
             return self._bounds[1 if self.oneway else 3]
 
-    class Intersection:
-        def __init__(self, roads):
-            self.roads = [[None] * 4]
-            print("intersection", roads)
+        def offset_of(self, tile):
+            """
+            :return: How far along the road the given tile is
+            """
+            axis = 1 if self.vertical_road else 0
+            return (tile[axis] - self.line[0][axis]) * self.direction
+
+        def iterate_tiles(self):
+            """
+            :return: Generator for all tiles covered by the road
+            """
+            dx, dy = self.road_direction
+            for offset in xrange(self.length + 1):
+                for x, y in self.line:
+                    yield x + dx * offset, y + dy * offset
+
+        def get_contact_lines(self):
+            """
+            :return: The lines of tiles just before the start and just after the end of the road
+            """
+            return self.roadmap.move_line(self.line, -1, self.road_direction), \
+                   self.roadmap.move_line(self.line, self.length + 1, self.road_direction)
+
+        def create_lanes(self, drive_on_left):
+            """
+            Creates a lane for each direction of travel, or a single lane if one way
+            """
+            starts = [self.left_lane_start()]
+            ends = [self.left_lane_end()]
+            if not self.oneway:
+                starts.append(self.right_lane_start())
+                ends.append(self.right_lane_end())
+
+            # which side of the road each lane is on, compared to the middle
+            axis = 0 if self.vertical_road else 1
+            middle = sum(r.centre[axis] for r in starts) / len(starts)
+
+            self.lanes = []
+            for start, end in zip(starts, ends):
+                if self.oneway:
+                    travel = tuple(self.road_direction)
+                else:
+                    side = [0, 0]
+                    side[axis] = 1 if start.centre[axis] > middle else -1
+
+                    # the side of the road is on the left of the direction of travel
+                    travel = (-side[1], side[0]) if drive_on_left else (side[1], -side[0])
+
+                self.lanes.append(RoadMap.Lane(self, start, end, travel))
+
+        def get_lane(self, tile):
+            """
+            :return: The lane covering the given tile
+            """
+            axis = 0 if self.vertical_road else 1
+            centre = tile[axis] + 0.5
+            for lane in self.lanes:
+                start = lane.start_bound.x if axis == 0 else lane.start_bound.y
+                width = lane.start_bound.width if axis == 0 else lane.start_bound.height
+                if start <= centre < start + width:
+                    return lane
+            return self.lanes[0]
+
+    class Lane:
+        """
+        A single direction of travel along a road, split into nodes at each junction along it
+        """
+
+        def __init__(self, road, start_bound, end_bound, travel_direction):
+            """
+            :param start_bound: Lane rectangle at the start of the road
+            :param end_bound: Lane rectangle at the end of the road
+            :param travel_direction: Offset in which vehicles travel along the lane
+            """
+            self.road = road
+            self.start_bound = start_bound
+            self.end_bound = end_bound
+            self.travel_direction = travel_direction
+            self.direction = util.SURROUNDING_OFFSETS.index(travel_direction)
+            self.forward = travel_direction == tuple(road.road_direction)
+            self.nodes = []
+
+        def get_point(self, offset):
+            """
+            :return: The tile at the corner of the lane, the given distance along the road
+            """
+            dx, dy = self.road.road_direction
+            return int(self.start_bound.x) + dx * offset, int(self.start_bound.y) + dy * offset
+
+    class Junction:
+        """
+        Where two roads meet
+        """
+
+        def __init__(self, road, offset, other, other_offset):
+            """
+            :param offset: Distance along the road to the junction
+            :param other_offset: Distance along the other road to the junction
+            """
+            self.road = road
+            self.offset = offset
+            self.other = other
+            self.other_offset = other_offset
+
+    # cost of turning onto another road, compared to travelling a tile
+    TURN_COST = 2
+    ROUTE_CACHE_SIZE = 256
+    DRIVE_ON_LEFT = True
 
     def __init__(self, world):
         self.world = world
         self.nodes = {}
         self.roads = []
-        # self.intersections = []
+        self.junctions = []
+
+        self._tile_roads = {}
+        self._routes = OrderedDict()
+
+        # runs of road tiles in each row and column, see _build_road_runs
+        self._row_runs = None
+        self._column_runs = None
 
     # todo: take a list of startpos, then wrap all this into a loop through them
     def begin_discovery(self, startpos):
         """
-        Recursively finds all roads connected to the given start position
+        Finds all roads connected to the given start position
         """
+        self._build_road_runs()
+
         stack = util.Stack(startpos)
         road_regions = []
-        connected_roads = []
-        # intersections = []
+        claimed_tiles = set()
 
         while stack:
             pos = stack.pop()
@@ -941,53 +1276,126 @@ class RoadMap:
                 setattr(rect, order[(i + (1 if road.vertical_road else 0)) % 2], rwidth if i == 1 else rlength)
 
             # filter forks, to remove repetitions and find road widths/directions
-            forks = self._filter_forks(forks, road_regions)
+            forks = self._filter_forks(forks, claimed_tiles)
 
-            # find intersections, and shorten roads if necessary
-            # intersection_positions = self._find_intersections(road, forks, road_regions)
-            # if intersection_positions:
-            # intersections.extend(intersection_positions)
-
-            connected_roads.append((pos, forks))
             for f in forks:
                 stack.push(f)
             road_regions.append(rect)
 
+            for y in xrange(rect.y, rect.y + rect.height):
+                for x in xrange(rect.x, rect.x + rect.width):
+                    claimed_tiles.add((x, y))
+
         # debug
         self.temp_regions = road_regions
 
-        # build intersections
-        # self._construct_intersections(intersections)
-
-        # connect nodes
-        self._build_graph(connected_roads)
-
         # precalculate paths between spawns todo
         # dict: spawn: otherspawn
         # otherspawn: reversed ^
 
-        # roads need to know about their ends, and lanes
+    def _build_road_runs(self):
+        """
+        Run-length encodes the road tiles of every row and column, as a (starts, ends) pair of sorted lists for each
+        """
+        width = self.world.tile_width
+        height = self.world.tile_height
+        terrain = self.world.layers["terrain"]
+
+        self._row_runs = []
+        self._column_runs = [([], []) for _ in xrange(width)]
+        column_starts = [None] * width
 
-    def _find_road_width(self, startpos, max_road_width=8):
+        for y in xrange(height):
+            row = terrain[y]
+            starts = []
+            ends = []
+            start = None
+
+            for x in xrange(width):
+                block = row[x]
+                if block is not None and block.blocktype == BlockType.ROAD:
+                    if start is None:
+                        start = x
+                    if column_starts[x] is None:
+                        column_starts[x] = y
+
+                else:
+                    if start is not None:
+                        starts.append(start)
+                        ends.append(x - 1)
+                        start = None
+
+                    if column_starts[x] is not None:
+                        self._column_runs[x][0].append(column_starts[x])
+                        self._column_runs[x][1].append(y - 1)
+                        column_starts[x] = None
+
+            if start is not None:
+                starts.append(start)
+                ends.append(width - 1)
+            self._row_runs.append((starts, ends))
+
+        for x, start in enumerate(column_starts):
+            if start is not None:
+                self._column_runs[x][0].append(start)
+                self._column_runs[x][1].append(height - 1)
+
+    def _get_runs(self, tile, offset):
         """
-        :return: The road width at the given position
+        :return: The runs of road tiles along the given tile's row or column, depending on the direction of the offset,
+                 and the position of the tile along it, or None if outside the world
         """
+        x, y = tile
+        if not self.world.is_in_range(x, y):
+            return None, None
+        return (self._row_runs[y], x) if offset[1] == 0 else (self._column_runs[x], y)
 
-        def _recurse(world, pos, offset, current_width, max_road_width):
-            tile = map(operator.add, pos, offset)
-            block = world.get_block(*tile)  # guaranteed to be in range
-            if block.blocktype == BlockType.ROAD and current_width < max_road_width:
-                return _recurse(world, tile, offset, current_width + 1, max_road_width)
-            else:
-                return current_width
+    def _road_run(self, tile, offset):
+        """
+        :return: The number of consecutive road tiles from the given tile in the direction of the given offset, including
+                 the tile itself
+        """
+        runs, pos = self._get_runs(tile, offset)
+        if runs is None:
+            return 0
+
+        starts, ends = runs
+        i = bisect_right(starts, pos) - 1
+        if i < 0 or ends[i] < pos:
+            return 0
+
+        return ends[i] - pos + 1 if sum(offset) > 0 else pos - starts[i] + 1
+
+    def _road_distances(self, tile, offset, first, last):
+        """
+        :return: Generator for each distance between first and last inclusive, at which the tile that distance from the
+                 given tile in the direction of the given offset is a road tile
+        """
+        runs, pos = self._get_runs(tile, offset)
+        if runs is None:
+            return
+
+        step = sum(offset)
+        low, high = sorted((pos + step * first, pos + step * last))
+        starts, ends = runs
 
+        i = max(0, bisect_right(starts, low) - 1)
+        while i < len(starts) and starts[i] <= high:
+            for p in xrange(max(starts[i], low), min(ends[i], high) + 1):
+                yield (p - pos) * step
+            i += 1
+
+    def _find_road_width(self, startpos, max_road_width=8):
+        """
+        :return: The road width at the given position
+        """
         min_width = max_road_width
         max_width = 0
         width_direction = road_direction = None
         for b, pos, offset in self.world.get_surrounding_blocks(startpos):
             btype = b.blocktype
             if btype == BlockType.ROAD:
-                width = _recurse(self.world, startpos, offset, 1, max_road_width)
+                width = min(1 + self._road_run(pos, offset), max_road_width)
                 if 0 < width < min_width:  # does not allow 1 wide roads
                     min_width = width
                     width_direction = offset
@@ -1016,10 +1424,11 @@ class RoadMap:
                 return False
         return True
 
-    def _add_fork(self, road_regions, fork_list, line, width_direction, road_direction):
+    def _add_fork(self, claimed_tiles, fork_list, line, width_direction, road_direction):
         """
         Registers a fork
 
+        :param claimed_tiles: Set of tiles in the regions of already processed roads
         :param fork_list: List to add the processed fork to
         :param line: Fork tile line
         :param width_direction: Direction of the fork span
@@ -1031,10 +1440,9 @@ class RoadMap:
             return
 
         # check if already processed
-        for rect in road_regions:
-            for tile in line:
-                if rect.collidepoint(tile):
-                    return
+        for tile in line:
+            if tile in claimed_tiles:
+                return
         fork_list.append((line, width_direction, road_direction))
 
     def _traverse_road(self, startpos, width, width_direction, road_direction, start_line):
@@ -1049,36 +1457,29 @@ class RoadMap:
             s = sorted(line, key=key)
             return [tuple(map(operator.sub, s[0], width_direction)), tuple(map(operator.add, s[-1], width_direction))]
 
-        def _recurse(world, line, road_direction, forks):
-            # move line forward
-            moved_line = self.move_line(line, 1, road_direction)
-
-            # find forks
-            ends = get_line_ends(moved_line, width_direction)
-            for e in ends:
-                if world.is_in_range(*e) and world.get_block(*e).blocktype == BlockType.ROAD:
-                    which_end = -1 if min(ends) == e else 1
-                    forks.append((which_end, e))
-
-            # verify the road line is still valid
-            if not self.valid_road_line(moved_line):
-                return line, forks
-
-            return _recurse(world, moved_line, road_direction, forks)
-
         # generates the line of coords for the road
         if start_line is None:
-            line = map(lambda x: map(operator.add, x, startpos), [map(lambda x: x * i, width_direction) for i in xrange(width)])
+            line = [(startpos[0] + width_direction[0] * i, startpos[1] + width_direction[1] * i) for i in xrange(width)]
         else:
             line = start_line
 
+        # the road continues for as long as every tile in the line can move forward onto another road tile
+        road_length = min(self._road_run((x + road_direction[0], y + road_direction[1]), road_direction) for x, y in line)
+
+        # forks are road tiles beside the road, including just past its end
         forks = []
-        recurse = _recurse(self.world, line, road_direction, forks)
-        road = RoadMap.Road(self, line, road_direction, util.find_difference(line[0], recurse[0][0], True)[1])
-        return road, recurse
+        ends = get_line_ends(line, width_direction)
+        for e in ends:
+            which_end = -1 if min(ends) == e else 1
+            for distance in self._road_distances(e, road_direction, 1, road_length + 1):
+                forks.append((which_end, (e[0] + road_direction[0] * distance, e[1] + road_direction[1] * distance)))
+
+        road = RoadMap.Road(self, line, road_direction, road_length)
+        return road, (self.move_line(line, road_length, road_direction), forks)
 
-    def _filter_forks(self, forks, processed_road_regions):
+    def _filter_forks(self, forks, claimed_tiles):
         """
+        :param claimed_tiles: Set of tiles in the regions of already processed roads
         :return: Fork line, width direction, road direction
         """
 
@@ -1094,7 +1495,7 @@ class RoadMap:
             if which_end < 0:
                 road_direction = map(lambda x: x * -1, road_direction)
 
-            self._add_fork(processed_road_regions, fork_list, line, width_direction, road_direction)
+            self._add_fork(claimed_tiles, fork_list, line, width_direction, road_direction)
 
         # no forks
         if not forks:
@@ -1124,99 +1525,168 @@ class RoadMap:
         add_fork(current, last_diff, last_which_end, consecutive_forks)
         return consecutive_forks
 
-    def _find_intersections(self, road, forks, road_regions):
-
-        extra_forks = []
-        intersection_positions = []
-        for fork, wdir, fdir in forks:
-            for other, _, odir in forks:
-                if fork <= other or len(fork) != len(other):
-                    continue
-
-                # not facing opposite directions
-                if abs(max(fdir)) == abs(max(odir)):
-                    continue
-
-                # they don't vary on a single axis
-                diff = map(operator.sub, fork[0], other[0])
-                if min(diff) != 0:
-                    continue
-
-                # shorten road
-                index = 1 if road.vertical_road else 0
-                road_begin = road.line[0][index]
-                intersection_begin = fork[0][index]
-                road.set_road_length(intersection_begin - road_begin - 1)
-
-                # add road opposite to list of forks
-                new_fork = self.move_line(road.line, road.length + len(fork) + 1, road.road_direction)
-                self._add_fork(road_regions, extra_forks, new_fork, wdir, road.road_direction)
-
-                # add intersection
-                intersection_positions.append((fork, other, road.end_line, new_fork))
-
-        forks.extend(extra_forks)
-        return intersection_positions
-
-    def _construct_intersections(self, intersections):
-        print(len(intersections))
-        for road_lines in intersections:
-            for line in road_lines:
-                print(line)
-            print
-
     class Node:
         """
-        Graph search node
+        Graph search node, at a junction or the end of a lane
         """
 
-        def __init__(self, point, node_id):
+        def __init__(self, point, node_id, lane, offset):
+            """
+            :param offset: Distance along the lane's road
+            """
             self.point = point
             self.id = node_id
-            self.edges = set()
+            self.lane = lane
+            self.offset = offset
+            self.edges = {}
 
         def __repr__(self):
             return "Node %d" % self.id
 
-    def _build_graph(self, connected_roads):
+    def build_graph(self):
         """
-        Builds a search graph out of all the discovered roads
+        Builds a directed lane graph out of all the discovered roads.
+        Every lane is split into nodes at each junction along its road, and the nodes of all lanes meeting at a junction
+        are connected to each other
         """
-
-        def add_edge(node, other):
-            from itertools import permutations
-
-            for a, b in permutations((node, other)):
-                a.edges.add(b)
-
-        def find_node_from_points(points):
-            for point in points:
-                for n in self.nodes.values():
-                    if point == n.point:
-                        return n
-
         self.nodes = {}
-        node_id = 0
-
-        # create nodes
-        for point, _ in connected_roads:
-            self.nodes[node_id] = RoadMap.Node(point, node_id)
-            node_id += 1
+        self.junctions = []
+        self._tile_roads = {}
+        self._routes.clear()
+
+        # index all road tiles, finding roads that cross each other
+        crossed = set()
+        for road in self.roads:
+            road.create_lanes(RoadMap.DRIVE_ON_LEFT)
+
+            for tile in road.iterate_tiles():
+                other = self._tile_roads.get(tile)
+                if other is None:
+                    self._tile_roads[tile] = road
+                elif (other.id, road.id) not in crossed:
+                    crossed.add((other.id, road.id))
+                    self.junctions.append(RoadMap.Junction(road, road.offset_of(tile), other, other.offset_of(tile)))
+
+        # roads that start or end at the side of another
+        for road in self.roads:
+            for offset, line in zip((0, road.length), road.get_contact_lines()):
+                for tile in line:
+                    other = self._tile_roads.get(tile)
+                    if other is not None and other is not road:
+                        self.junctions.append(RoadMap.Junction(road, offset, other, other.offset_of(tile)))
+                        break
+
+        # split lanes at their ends and junctions
+        offsets = dict((road, {0, road.length}) for road in self.roads)
+        for junction in self.junctions:
+            offsets[junction.road].add(junction.offset)
+            offsets[junction.other].add(junction.other_offset)
+
+        for road in self.roads:
+            road_offsets = sorted(offsets[road])
+            for lane in road.lanes:
+                lane.nodes = [self._get_node(lane, o) for o in (road_offsets if lane.forward else reversed(road_offsets))]
+
+                # nodes can be shared with overlapping roads, so their offsets may be along a different road
+                for node, next_node in zip(lane.nodes, lane.nodes[1:]):
+                    (x1, y1), (x2, y2) = node.point, next_node.point
+                    node.edges[next_node] = abs(x2 - x1) + abs(y2 - y1)
+
+        # turning in either direction at junctions
+        for junction in self.junctions:
+            for lane in junction.road.lanes:
+                node = self._get_node(lane, junction.offset)
+                for other_lane in junction.other.lanes:
+                    other = self._get_node(other_lane, junction.other_offset)
+                    node.edges[other] = RoadMap.TURN_COST
+                    other.edges[node] = RoadMap.TURN_COST
+
+    def _get_node(self, lane, offset):
+        """
+        :return: The node on the given lane at the given distance along its road, which is created if necessary
+        """
+        point = lane.get_point(offset)
+        key = point, lane.direction
+        node = self.nodes.get(key)
+        if node is None:
+            node = RoadMap.Node(point, len(self.nodes), lane, offset)
+            self.nodes[key] = node
+        return node
+
+    def get_road(self, tile):
+        """
+        :return: The road covering the given tile, otherwise None
+        """
+        return self._tile_roads.get(tuple(tile))
+
+    def get_nearest_node(self, tile, ahead=True):
+        """
+        :param ahead: If True, the next node in the direction of travel, otherwise the last one passed
+        :return: The nearest node on the lane covering the given tile, or None if the tile is not on a road
+        """
+        road = self.get_road(tile)
+        if road is None:
+            return None
+
+        lane = road.get_lane(tile)
+        offset = road.offset_of(tile)
+        nodes = lane.nodes if ahead else lane.nodes[::-1]
+        for node in nodes:
+            before = node.offset < offset if lane.forward == ahead else node.offset > offset
+            if not before:
+                return node
+
+        return nodes[-1]
+
+    @profiler.profiled("find_route")
+    def find_route(self, src, dest):
+        """
+        :param src: Start node
+        :param dest: Destination node
+        :return: List of nodes from src to dest, or None if there is no route
+        """
+        key = src.id, dest.id
+        route = self._routes.pop(key, False)
+
+        if route is False:
+            route = self._search(src, dest)
+            if len(self._routes) >= RoadMap.ROUTE_CACHE_SIZE:
+                self._routes.popitem(last=False)
+
+        # most recently used goes to the back
+        self._routes[key] = route
+        return list(route) if route else None
+
+    def _search(self, src, dest):
+        """
+        Dijkstra's search through the lane graph
+        :return: Tuple of nodes from src to dest, or None if there is no route
+        """
+        costs = {src: 0}
+        came_from = {src: None}
+        frontier = [(0, src.id, src)]
+
+        while frontier:
+            cost, _, node = heapq.heappop(frontier)
+            if node is dest:
+                route = []
+                while node is not None:
+                    route.append(node)
+                    node = came_from[node]
+                return tuple(reversed(route))
 
-        # link nodes
-        for nid, (point, all_forks) in enumerate(connected_roads):
-
-            # no forks
-            if not all_forks:
+            # already found a cheaper way here
+            if cost > costs[node]:
                 continue
 
-            node = self.nodes[nid]
-            for fork_points, _, _ in all_forks:
-                add_edge(node, find_node_from_points(fork_points))
+            for other, weight in node.edges.iteritems():
+                new_cost = cost + weight
+                if new_cost < costs.get(other, new_cost + 1):
+                    costs[other] = new_cost
+                    came_from[other] = node
+                    heapq.heappush(frontier, (new_cost, other.id, other))
 
-        # convert node edges to list: order must be kept now
-        for n in self.nodes.values():
-            n.edges = sorted(list(n.edges))
+        return None
 
 
 class _BlockHelper: